@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the memory used by the series of counters and gauges, comparing
+   the SeriesIndex storage with the previous one (a dict of label values ->
+   value per metric), and the time needed to update them.
+   Prints the results as JSON, for example:
+
+   python3 benchmarks/counter_memory.py --datasources 20000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.histogram_memory import measure  # noqa: E402
+from druid_exporter.collector import DruidCollector  # noqa: E402
+
+
+METRICS = ('segment/used', 'segment/count', 'segment/size')
+
+METRICS_CONFIG = {
+    'historical': {
+        metric: {
+            'type': 'gauge',
+            'labels': ['dataSource', 'tier'],
+            'prometheus_metric_name': 'druid_historical_' + metric.replace('/', '_'),
+            'description': metric,
+        }
+        for metric in METRICS
+    },
+}
+
+
+def make_datapoints(datasources):
+    # Every datapoint is decoded from JSON separately, so its strings are
+    # distinct objects even when they are equal.
+    return [
+        json.loads(json.dumps({
+            'feed': 'metrics', 'service': 'druid/historical', 'metric': metric,
+            'dataSource': 'datasource{}'.format(index), 'tier': '_default_tier',
+            'value': index}))
+        for metric in METRICS for index in range(datasources)]
+
+
+def store_in_dicts(datapoints):
+    """The previous storage of the counters."""
+    counters = {}
+    for datapoint in datapoints:
+        series = counters.setdefault(datapoint['metric'], {}).setdefault('historical', {})
+        label_values = tuple([str(datapoint[label]) for label in ('dataSource', 'tier')])
+        series[label_values] = float(datapoint['value'])
+    return counters
+
+
+def store_in_collector(collector, datapoints):
+    for datapoint in datapoints:
+        collector.store_counter(datapoint)
+    return collector.counters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasources', type=int, default=20000,
+                        help='Number of dataSources (series of every metric)')
+    args = parser.parse_args()
+    series = args.datasources * len(METRICS)
+
+    datapoints = make_datapoints(args.datasources)
+    _, dict_bytes = measure(lambda: store_in_dicts(make_datapoints(args.datasources)))
+    collector = DruidCollector(METRICS_CONFIG)
+    collector.stop_running_threads()
+    _, index_bytes = measure(
+        lambda: store_in_collector(collector, make_datapoints(args.datasources)))
+
+    # Updates of existing series, the steady state of an exporter.
+    started_at = time.perf_counter()
+    store_in_collector(collector, datapoints)
+    index_seconds = time.perf_counter() - started_at
+
+    print(json.dumps({
+        'series': series,
+        'index_bytes_per_series': round(index_bytes / series, 1),
+        'dict_bytes_per_series': round(dict_bytes / series, 1),
+        'index_update_microseconds': round(index_seconds / series * 1e6, 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
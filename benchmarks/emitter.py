@@ -0,0 +1,91 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Synthetic Druid emitter, generating streams of datapoints like the ones
+   the Druid daemons send for the metrics of a config file.
+"""
+
+import json
+import os
+import random
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_CONFIG_FILE = os.path.join(ROOT, 'conf', 'example_druid_v_0_17_0.json')
+
+HISTOGRAM_TYPES = ('histogram', 'exponential_histogram', 'summary')
+
+
+class SyntheticEmitter(object):
+    """Generate datapoints of the metrics of a config. Every label takes one
+       of cardinality values, and histogram_ratio is the fraction of the
+       datapoints of histogram metrics (the others being gauges or
+       counters). The stream is deterministic for a given seed.
+    """
+
+    def __init__(self, metrics_config, cardinality=100, histogram_ratio=0.5, seed=42):
+        self.random = random.Random(seed)
+        self.cardinality = cardinality
+        self.histogram_ratio = histogram_ratio
+        self.histogram_metrics = []
+        self.other_metrics = []
+        for daemon, metrics in sorted(metrics_config.items()):
+            for metric_name, metric_config in sorted(metrics.items()):
+                metric = (daemon, metric_name, tuple(metric_config['labels']))
+                if metric_config['type'] in HISTOGRAM_TYPES:
+                    self.histogram_metrics.append(metric)
+                else:
+                    self.other_metrics.append(metric)
+        self.hosts = ['druid{}.example.org:8083'.format(index) for index in range(8)]
+
+    @classmethod
+    def from_config_file(cls, path=DEFAULT_CONFIG_FILE, **kwargs):
+        with open(path) as config_file:
+            return cls(json.load(config_file), **kwargs)
+
+    def label_value(self, label):
+        index = self.random.randrange(self.cardinality)
+        if label == 'dataSource':
+            return 'datasource{}'.format(index)
+        if label == 'tier':
+            return 'tier{}'.format(index % 3)
+        return '{}{}'.format(label, index)
+
+    def datapoint(self):
+        histogram = self.histogram_metrics and (
+            not self.other_metrics or self.random.random() < self.histogram_ratio)
+        metrics = self.histogram_metrics if histogram else self.other_metrics
+        daemon, metric_name, labels = self.random.choice(metrics)
+        if histogram:
+            value = round(self.random.lognormvariate(4, 1.5), 3)
+        else:
+            value = self.random.randrange(100000)
+        datapoint = {
+            'feed': 'metrics', 'timestamp': '2020-01-01T00:00:00.000Z',
+            'service': 'druid/' + daemon, 'host': self.random.choice(self.hosts),
+            'version': '0.17.0', 'metric': metric_name, 'value': value,
+        }
+        for label in labels:
+            datapoint[label] = self.label_value(label)
+        return datapoint
+
+    def datapoints(self, count):
+        return [self.datapoint() for _ in range(count)]
+
+    def batches(self, count, batch_size):
+        """Return the JSON bodies of the POSTs sending count datapoints in
+           batches of batch_size.
+        """
+        return [json.dumps(self.datapoints(min(batch_size, count - start))).encode()
+                for start in range(0, count, batch_size)]
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the memory used by the histogram series of the collector, and
+   compare it with the previous storage (a dict of bucket name -> count per
+   series). Prints the results as JSON, for example:
+
+   python3 benchmarks/histogram_memory.py --series 50000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from druid_exporter.collector import DruidCollector  # noqa: E402
+
+
+METRICS_CONFIG = {
+    'broker': {
+        'query/time': {
+            'type': 'histogram',
+            'buckets': ['10', '100', '500', '1000', '2000', '3000', '5000', '7000',
+                        '10000', 'inf', 'sum'],
+            'labels': ['dataSource'],
+            'prometheus_metric_name': 'druid_broker_query_time_ms',
+            'description': 'Milliseconds taken to complete a query.',
+        },
+    },
+}
+
+
+def measure(build):
+    """Return the bytes allocated (and still alive) by build()'s result."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return result, allocated
+
+
+def build_collector(series):
+    collector = DruidCollector(METRICS_CONFIG)
+    collector.stop_running_threads()
+    datapoints = [
+        (collector.metrics_plan[('broker', 'query/time')],
+         {'feed': 'metrics', 'service': 'druid/broker', 'metric': 'query/time',
+          'dataSource': 'datasource{}'.format(index), 'value': index % 12000})
+        for index in range(series)]
+    for start in range(0, len(datapoints), 1000):
+        collector.process_datapoints_batch(datapoints[start:start + 1000])
+    return collector
+
+
+def dict_series(collector):
+    """The same series, stored as {bucket: count, ..., 'sum': sum} dicts."""
+    metric_plan = collector.metrics_plan[('broker', 'query/time')]
+    return {
+        label_values: metric_plan.histogram_values_dict(values)
+        for label_values, values in collector.histograms['query/time']['broker'].items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--series', type=int, default=20000,
+                        help='Number of histogram series to store')
+    args = parser.parse_args()
+
+    collector = build_collector(args.series)
+    series = collector.histograms['query/time']['broker']
+    _, array_bytes = measure(
+        lambda: {label_values: values[:] for label_values, values in series.items()})
+    _, dict_bytes = measure(lambda: dict_series(collector))
+
+    started_at = time.perf_counter()
+    collector.generate_latest()
+    render_seconds = time.perf_counter() - started_at
+
+    print(json.dumps({
+        'series': args.series,
+        'array_bytes_per_series': round(array_bytes / args.series, 1),
+        'dict_bytes_per_series': round(dict_bytes / args.series, 1),
+        'render_seconds': round(render_seconds, 4),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
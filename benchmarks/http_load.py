@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test of the HTTP servers of the exporter (gevent and asyncio), with
+   a simulator of the Druid HTTP emitters: every emitter POSTs batches of
+   datapoints over a persistent connection, waiting for each response
+   before sending the next batch (as Druid does). Prints the results as
+   JSON, for example:
+
+   python3 benchmarks/http_load.py --emitters 32 --duration 10
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.emitter import DEFAULT_CONFIG_FILE, ROOT, SyntheticEmitter  # noqa: E402
+
+
+async def read_response(reader):
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    content_length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            content_length = int(value)
+    await reader.readexactly(content_length)
+    return status
+
+
+async def emitter(port, batch, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request = (b'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+               b'Content-Length: ' + str(len(batch)).encode() + b'\r\n\r\n' + batch)
+    while time.monotonic() < deadline:
+        started_at = time.monotonic()
+        writer.write(request)
+        if await read_response(reader) != 200:
+            errors.append(1)
+        latencies.append(time.monotonic() - started_at)
+    writer.close()
+
+
+async def run_emitters(port, emitters, batch, duration):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[
+        emitter(port, batch, deadline, latencies, errors) for _ in range(emitters)])
+    return latencies, errors
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('The exporter is not listening on port {}'.format(port))
+
+
+def load_test(server, port, emitters, batch_size, duration):
+    exporter = subprocess.Popen(
+        [sys.executable, '-m', 'druid_exporter.exporter', DEFAULT_CONFIG_FILE,
+         '--listen', '127.0.0.1:{}'.format(port), '--server', server,
+         '--max-connections', str(emitters + 16)],
+        cwd=ROOT)
+    try:
+        wait_for_port(port)
+        latencies, errors = asyncio.run(
+            run_emitters(port, emitters,
+                         SyntheticEmitter.from_config_file().batches(batch_size, batch_size)[0],
+                         duration))
+    finally:
+        exporter.terminate()
+        exporter.wait()
+
+    latencies.sort()
+    return {
+        'requests_per_second': round(len(latencies) / duration, 1),
+        'datapoints_per_second': round(len(latencies) * batch_size / duration, 1),
+        'latency_p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'latency_p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--emitters', type=int, default=32,
+                        help='Number of concurrent emitters (connections)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Number of datapoints POSTed by every request')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds of load for every server')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--servers', nargs='+', default=['gevent', 'asyncio'],
+                        choices=('gevent', 'asyncio'))
+    args = parser.parse_args()
+
+    results = {
+        'emitters': args.emitters,
+        'batch_size': args.batch_size,
+        'duration': args.duration,
+    }
+    for server in args.servers:
+        results[server] = load_test(
+            server, args.port, args.emitters, args.batch_size, args.duration)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ingestion and scrape benchmark of the exporter, fed by the synthetic
+   Druid emitter. Two scenarios are available:
+   * direct: DruidCollector.register_datapoint is called for every
+     datapoint, in a separate process.
+   * http: the exporter runs as a separate process, and the datapoints are
+     POSTed to it by a number of concurrent emitters.
+   For each of them it reports the datapoints/s ingested (until all of
+   them are processed), the latency of the POSTs, the time needed to scrape
+   the metrics and the memory used. The results can be saved as JSON, and
+   compared with the ones of a previous run, for example:
+
+   python3 benchmarks/ingest.py --output before.json
+   git checkout my-branch
+   python3 benchmarks/ingest.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.emitter import DEFAULT_CONFIG_FILE, ROOT, SyntheticEmitter  # noqa: E402
+from benchmarks.http_load import read_response, wait_for_port  # noqa: E402
+
+REGISTERED_METRIC = b'druid_exporter_datapoints_registered_total '
+
+
+def rss_bytes(pid='self'):
+    """Return the resident set size of a process (Linux only)."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, quantile):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * quantile))]
+
+
+def time_scrapes(scrape, count=5):
+    """Return the duration of the first scrape and the median of the
+       following ones (served mostly from the exposition cache).
+    """
+    durations = []
+    for _ in range(count):
+        started_at = time.perf_counter()
+        scrape()
+        durations.append(time.perf_counter() - started_at)
+    return durations[0], percentile(durations[1:], 0.5)
+
+
+def run_direct(args, results):
+    from druid_exporter.collector import DruidCollector
+
+    with open(args.config) as config_file:
+        metrics_config = json.load(config_file)
+    emitter = SyntheticEmitter(metrics_config, args.cardinality, args.histogram_ratio,
+                               args.seed)
+    datapoints = emitter.datapoints(args.datapoints)
+    collector = DruidCollector(metrics_config)
+
+    started_at = time.perf_counter()
+    for datapoint in datapoints:
+        collector.register_datapoint(datapoint)
+    while collector.datapoints_registered < len(datapoints):
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - started_at
+
+    first_scrape, cached_scrape = time_scrapes(collector.generate_latest)
+    collector.stop_running_threads()
+    results.put({
+        'datapoints_per_second': round(len(datapoints) / elapsed, 1),
+        'scrape_seconds': round(first_scrape, 4),
+        'cached_scrape_seconds': round(cached_scrape, 4),
+        'rss_bytes': rss_bytes(),
+        'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+
+
+def direct_scenario(args):
+    # A separate process, so that the memory used is only the one of the
+    # collector (and of the datapoints generated).
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=run_direct, args=(args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+async def post_batches(port, batches, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    while batches:
+        body = batches.pop()
+        request = (b'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                   b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        started_at = time.perf_counter()
+        writer.write(request)
+        status = await read_response(reader)
+        latencies.append(time.perf_counter() - started_at)
+        if status != 200:
+            raise RuntimeError('POST failed with status {}'.format(status))
+    writer.close()
+
+
+async def post_all(port, batches, emitters):
+    latencies = []
+    await asyncio.gather(*[post_batches(port, batches, latencies) for _ in range(emitters)])
+    return latencies
+
+
+def scrape(port):
+    with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(port)) as response:
+        return response.read()
+
+
+def registered_datapoints(output):
+    for line in output.split(b'\n'):
+        if line.startswith(REGISTERED_METRIC):
+            return float(line[len(REGISTERED_METRIC):])
+    return 0
+
+
+def http_scenario(args):
+    emitter = SyntheticEmitter.from_config_file(
+        args.config, cardinality=args.cardinality, histogram_ratio=args.histogram_ratio,
+        seed=args.seed)
+    batches = emitter.batches(args.datapoints, args.batch_size)
+    exporter = subprocess.Popen(
+        [sys.executable, '-m', 'druid_exporter.exporter', args.config,
+         '--listen', '127.0.0.1:{}'.format(args.port), '--server', args.server],
+        cwd=ROOT)
+    try:
+        wait_for_port(args.port)
+        started_at = time.perf_counter()
+        latencies = asyncio.run(post_all(args.port, list(reversed(batches)), args.emitters))
+        deadline = time.monotonic() + 300
+        while registered_datapoints(scrape(args.port)) < args.datapoints:
+            if time.monotonic() > deadline:
+                raise RuntimeError('Timed out waiting for the datapoints to be processed')
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started_at
+        first_scrape, cached_scrape = time_scrapes(lambda: scrape(args.port))
+        rss = rss_bytes(exporter.pid)
+    finally:
+        exporter.terminate()
+        exporter.wait()
+
+    return {
+        'datapoints_per_second': round(args.datapoints / elapsed, 1),
+        'post_latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'post_latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'scrape_seconds': round(first_scrape, 4),
+        'cached_scrape_seconds': round(cached_scrape, 4),
+        'rss_bytes': rss,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Return the relative change of every numeric result from the baseline."""
+    changes = {}
+    for scenario, metrics in results['scenarios'].items():
+        baseline_metrics = baseline.get('scenarios', {}).get(scenario, {})
+        for name, value in metrics.items():
+            baseline_value = baseline_metrics.get(name)
+            if value is not None and baseline_value:
+                changes['{}.{}'.format(scenario, name)] = '{:+.1f}%'.format(
+                    (value - baseline_value) / baseline_value * 100)
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=DEFAULT_CONFIG_FILE,
+                        help='Metrics config file, used to generate the datapoints')
+    parser.add_argument('--scenarios', nargs='+', default=['direct', 'http'],
+                        choices=('direct', 'http'))
+    parser.add_argument('--datapoints', type=int, default=200000,
+                        help='Number of datapoints of every scenario')
+    parser.add_argument('--cardinality', type=int, default=100,
+                        help='Number of values of every label')
+    parser.add_argument('--histogram-ratio', type=float, default=0.5,
+                        help='Fraction of datapoints of histogram metrics')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Number of datapoints of every POST')
+    parser.add_argument('--emitters', type=int, default=8,
+                        help='Number of concurrent emitters (connections) POSTing')
+    parser.add_argument('--server', default='gevent', choices=('gevent', 'asyncio'),
+                        help='HTTP server of the exporter')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Save the results in this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Compare the results with the ones saved in this JSON file')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'parameters': {
+            'config': os.path.basename(args.config),
+            'datapoints': args.datapoints,
+            'cardinality': args.cardinality,
+            'histogram_ratio': args.histogram_ratio,
+            'batch_size': args.batch_size,
+            'emitters': args.emitters,
+            'server': args.server,
+            'seed': args.seed,
+        },
+        'scenarios': {},
+    }
+    for scenario in args.scenarios:
+        if scenario == 'direct':
+            results['scenarios'][scenario] = direct_scenario(args)
+        else:
+            results['scenarios'][scenario] = http_scenario(args)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            results['changes'] = compare(results, json.load(baseline_file))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
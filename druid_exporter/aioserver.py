@@ -0,0 +1,221 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal HTTP/1.1 server based on asyncio, alternative to gevent's
+   WSGIServer. It supports persistent (keep-alive) connections and request
+   pipelining and limits the number of connections served at the same time.
+
+   Like gevent's WSGIServer, it calls the exporter's WSGI app in the event
+   loop: the app only decodes the datapoints and hands them over to the
+   processing thread, and running it in a thread pool instead made the
+   throughput worse because of the contention on the GIL.
+"""
+
+import asyncio
+import io
+import logging
+
+from collections import namedtuple
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 1024
+# Seconds an idle connection is kept open, waiting for the next request.
+DEFAULT_KEEPALIVE_TIMEOUT = 75
+# Maximum size of the request line and headers.
+MAX_HEAD_SIZE = 64 * 1024
+
+HTTPRequest = namedtuple(
+    'HTTPRequest', ['method', 'path', 'query_string', 'version', 'headers', 'body'])
+
+
+class BadRequest(Exception):
+    """Raised when a request can't be parsed."""
+
+
+class AsyncHTTPServer(object):
+    """Serve a WSGI app with asyncio. The requests of every connection are
+       handled one at a time, in order, so the pipelined ones are answered
+       in the order they were sent.
+    """
+
+    def __init__(self, app, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        self.app = app
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.connections = 0
+        self.server = None
+
+    async def read_chunked_body(self, reader):
+        chunks = []
+        while True:
+            size_line = await reader.readuntil(b'\r\n')
+            try:
+                size = int(size_line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise BadRequest('invalid chunk size {!r}'.format(size_line))
+            if size == 0:
+                # Skip the trailer headers, if any.
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            if await reader.readexactly(2) != b'\r\n':
+                raise BadRequest('chunk not terminated by CRLF')
+
+    async def read_request(self, reader, writer):
+        """Read the next request of a connection, returning None if the
+           client closed it.
+        """
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+        except asyncio.IncompleteReadError as e:
+            if e.partial.strip():
+                raise BadRequest('connection closed in the middle of a request')
+            return None
+        except asyncio.LimitOverrunError:
+            raise BadRequest('request line and headers bigger than {} bytes'
+                             .format(MAX_HEAD_SIZE))
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise BadRequest('invalid request line {!r}'.format(lines[0]))
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, separator, value = line.partition(':')
+            if not separator:
+                raise BadRequest('invalid header {!r}'.format(line))
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = await asyncio.wait_for(
+                self.read_chunked_body(reader), self.keepalive_timeout)
+        else:
+            try:
+                content_length = int(headers.get('content-length') or 0)
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                raise BadRequest('invalid Content-Length {!r}'
+                                 .format(headers['content-length']))
+            body = await asyncio.wait_for(
+                reader.readexactly(content_length), self.keepalive_timeout)
+
+        path, _, query_string = target.partition('?')
+        return HTTPRequest(method, path, query_string, version, headers, body)
+
+    def call_app(self, request):
+        """Call the WSGI app for a request, returning the status, headers
+           and body of the response.
+        """
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'PATH_INFO': request.path,
+            'QUERY_STRING': request.query_string,
+            'SERVER_PROTOCOL': request.version,
+            'CONTENT_TYPE': request.headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(request.body)),
+            'wsgi.input': io.BytesIO(request.body),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            if name not in ('content-type', 'content-length'):
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        body = b''.join(self.app(environ, start_response))
+        return response['status'], response['headers'], body
+
+    @staticmethod
+    def render_response(status, headers, body, keep_alive):
+        head = ['HTTP/1.1 {}'.format(status)]
+        head.extend('{}: {}'.format(name, value) for name, value in headers
+                    if name.lower() not in ('content-length', 'connection'))
+        head.append('Content-Length: {}'.format(len(body)))
+        head.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+        return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+    @staticmethod
+    def keep_alive(request):
+        connection = request.headers.get('connection', '').lower()
+        if request.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    async def handle_connection(self, reader, writer):
+        if self.connections >= self.max_connections:
+            log.warning('Too many connections (%d), rejecting a new one', self.connections)
+            writer.write(self.render_response('503 Service Unavailable', [], b'', False))
+            writer.close()
+            return
+
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader, writer)
+                except BadRequest as e:
+                    log.warning('Bad request: %s', e)
+                    writer.write(self.render_response('400 Bad Request', [], b'', False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                status, headers, body = self.call_app(request)
+                keep_alive = self.keep_alive(request)
+                writer.write(self.render_response(status, headers, body, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            # Idle or broken connection.
+            pass
+        except Exception:
+            log.exception('Error while serving a connection')
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def start(self, host, port):
+        """Start listening, returning the asyncio Server."""
+        self.server = await asyncio.start_server(
+            self.handle_connection, host or None, port, limit=MAX_HEAD_SIZE)
+        return self.server
+
+    async def serve(self, host, port):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self, host, port):
+        asyncio.run(self.serve(host, port))
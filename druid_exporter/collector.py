@@ -13,14 +13,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import array
+import bisect
+import copy
 import logging
+import math
+import operator
 import queue
 import threading
+import time
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from druid_exporter import compression, decoding, histograms, protobuf, quantiles, relabel
+from druid_exporter.histograms import ExponentialHistogram, ExponentialHistogramMetricFamily
+from druid_exporter.quantiles import QuantileSummary
+from druid_exporter.series import SeriesIndex, intern_label_values
+from prometheus_client import generate_latest
+from prometheus_client.utils import floatToGoString
 from prometheus_client.core import (CounterMetricFamily, GaugeMetricFamily,
-                                    HistogramMetricFamily, Summary)
+                                    HistogramMetricFamily, Summary, SummaryMetricFamily)
 
 
 log = logging.getLogger(__name__)
@@ -30,16 +41,283 @@ try:
 except ImportError:
     KafkaConsumer = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Label value of the series collecting the datapoints exceeding the
+# series budget of a metric, when its overflow policy is 'fold'.
+OVERFLOW_LABEL_VALUE = '__overflow__'
+
+# Metric types whose series (distributions of samples) are stored in
+# DruidCollector.histograms.
+HISTOGRAM_TYPES = ('histogram', 'exponential_histogram', 'summary')
+
+# Fields of a metric's config defining how its series are stored: when one
+# of them changes on reload the series of the metric are dropped, while the
+# other fields (description, TTL, budgets, etc..) can change keeping them.
+STORAGE_FIELDS = ('type', 'labels', 'relabel', 'buckets', 'schema', 'zero_threshold',
+                  'max_buckets', 'quantiles', 'relative_accuracy', 'max_age', 'age_buckets')
+
+# Minimum number of samples of a histogram series, within a batch, for which
+# binning them with NumPy (when available) is faster than with bisect.
+NUMPY_MIN_SAMPLES = 64
+
+
+class MetricPlan(object):
+    """Pre-compiled view of a single (daemon, metric) entry of the metrics
+       config, built once at startup so that the hot path processing
+       datapoints doesn't need to walk the config dictionary (or parse
+       bucket strings) for every sample.
+    """
+    __slots__ = ('daemon', 'metric_name', 'key', 'type', 'labels', 'label_getter',
+                 'relabeler', 'sum_merged', 'prometheus_labels',
+                 'prometheus_metric_name', 'description', 'buckets', 'bucket_positions',
+                 'bucket_bounds', 'schema', 'zero_threshold', 'max_buckets', 'quantiles',
+                 'relative_accuracy', 'max_age', 'age_buckets', 'ttl', 'max_series',
+                 'overflow', 'overflow_label_values', 'config', 'retired')
+
+    def __init__(self, daemon, metric_name, metric_config, series_ttl=None):
+        self.daemon = daemon
+        self.metric_name = metric_name
+        self.key = (daemon, metric_name)
+        self.type = metric_config['type']
+        self.labels = tuple(metric_config['labels'])
+        # Return the values of the labels of a datapoint as a tuple, as
+        # they are (without converting them to strings), raising KeyError
+        # if one of them is missing.
+        if len(self.labels) > 1:
+            self.label_getter = operator.itemgetter(*self.labels)
+        elif self.labels:
+            self.label_getter = lambda datapoint, label=self.labels[0]: (datapoint[label],)
+        else:
+            self.label_getter = lambda datapoint: ()
+        # The relabel rules of the metric (see the relabel module) replace
+        # the label getter, that returns None for the datapoints to drop.
+        # The series merged by dropping labels are summed if sum_merged.
+        self.relabeler = None
+        self.sum_merged = False
+        exported_labels = self.labels
+        if metric_config.get('relabel'):
+            self.relabeler = relabel.Relabeler(self.labels, metric_config['relabel'])
+            self.label_getter = self.relabeler.label_values
+            self.sum_merged = relabel.merged_aggregation(metric_config) == 'sum'
+            exported_labels = self.relabeler.labels
+        self.prometheus_labels = tuple(label.lower() for label in exported_labels)
+        self.prometheus_metric_name = metric_config['prometheus_metric_name']
+        self.description = metric_config['description']
+        # List of (bucket_name, upper_bound) pairs, the 'sum' pseudo-bucket
+        # is handled separately by store_histogram.
+        self.buckets = tuple(
+            (bucket, float(bucket))
+            for bucket in metric_config.get('buckets', []) if bucket != 'sum')
+        # The same buckets sorted by upper bound, to bin samples with a
+        # binary search, and their positions in the series values (see
+        # new_histogram_values).
+        sorted_positions = sorted(range(len(self.buckets)),
+                                  key=lambda position: self.buckets[position][1])
+        self.bucket_positions = tuple(sorted_positions)
+        self.bucket_bounds = tuple(self.buckets[position][1] for position in sorted_positions)
+        # Resolution of the exponential histograms (see the histograms module).
+        self.schema = metric_config.get('schema', histograms.DEFAULT_SCHEMA)
+        self.zero_threshold = metric_config.get(
+            'zero_threshold', histograms.DEFAULT_ZERO_THRESHOLD)
+        # Quantiles of the summaries, estimated with a sketch of up to
+        # max_buckets bins (see the quantiles module).
+        self.quantiles = tuple(metric_config.get('quantiles', quantiles.DEFAULT_QUANTILES))
+        self.relative_accuracy = metric_config.get(
+            'relative_accuracy', quantiles.DEFAULT_RELATIVE_ACCURACY)
+        self.max_age = metric_config.get('max_age', quantiles.DEFAULT_MAX_AGE)
+        self.age_buckets = metric_config.get('age_buckets', quantiles.DEFAULT_AGE_BUCKETS)
+        if self.type == 'summary':
+            self.max_buckets = metric_config.get('max_buckets', quantiles.DEFAULT_MAX_BINS)
+        else:
+            self.max_buckets = metric_config.get('max_buckets', histograms.DEFAULT_MAX_BUCKETS)
+        # Seconds after which a series not updated is dropped (None means
+        # never), the metric's config overrides the exporter's default.
+        self.ttl = metric_config.get('ttl', series_ttl)
+        # Maximum number of series of the metric (None means unlimited),
+        # and what to do with the datapoints of the series exceeding it:
+        # 'drop' them or 'fold' them into a single overflow series.
+        self.max_series = metric_config.get('max_series')
+        self.overflow = metric_config.get('overflow', 'drop')
+        self.overflow_label_values = tuple(OVERFLOW_LABEL_VALUE for _ in exported_labels)
+        # The config the plan was compiled from, to find out what changed
+        # when the config is reloaded, and whether the plan was replaced (or
+        # removed) by a reload since then.
+        self.config = metric_config
+        self.retired = False
+
+    def same_storage(self, other):
+        """Return True if the series stored for another plan of the same
+           metric family can be kept by this one, i.e. if the changes between
+           their configs don't affect how the series are stored.
+        """
+        return all(self.config.get(field) == other.config.get(field)
+                   for field in STORAGE_FIELDS)
+
+    def new_histogram_values(self):
+        """Return the values of a new series of a (classic) histogram: a
+           fixed size array with the counts of the buckets, in the order of
+           self.buckets, followed by the sum of the samples.
+        """
+        return array.array('d', bytes(8 * (len(self.buckets) + 1)))
+
+    def histogram_values_dict(self, values):
+        """Return the values of a histogram series as a dictionary of
+           {bucket: count, ..., 'sum': sum}, like the buckets of the config.
+        """
+        values_dict = {bucket: values[position]
+                       for position, (bucket, _) in enumerate(self.buckets)}
+        values_dict['sum'] = values[-1]
+        return values_dict
+
+    def label_values(self, datapoint):
+        """Return the tuple of label values for the datapoint (None if it's
+           dropped by the relabel rules), raising KeyError if one of the
+           configured labels is missing.
+        """
+        if self.relabeler is not None:
+            return self.relabeler.label_values(datapoint)
+        return tuple([str(datapoint[label]) for label in self.labels])
+
+
+def bin_histogram_samples(bucket_bounds, values):
+    """Return, for each of the (sorted) bucket upper bounds, the number of
+       values lower or equal to it, like the cumulative buckets of a
+       Prometheus histogram.
+    """
+    if numpy is not None and len(values) >= NUMPY_MIN_SAMPLES:
+        # NaN values are sorted after any bound, so they end up in the last
+        # bin (not counted in any bucket) as with bisect.
+        bins = numpy.bincount(numpy.searchsorted(bucket_bounds, values, side='left'),
+                              minlength=len(bucket_bounds) + 1)
+        return numpy.cumsum(bins[:len(bucket_bounds)]).tolist()
+
+    bins = [0] * (len(bucket_bounds) + 1)
+    for value in values:
+        if value != value:
+            # NaN is not lower or equal to any bound.
+            bins[-1] += 1
+        else:
+            bins[bisect.bisect_left(bucket_bounds, value)] += 1
+    cumulative_counts = []
+    count = 0
+    for bin_count in bins[:-1]:
+        count += bin_count
+        cumulative_counts.append(count)
+    return cumulative_counts
+
+
+def compile_metrics_config(metrics_config, series_ttl=None, previous_plan=None):
+    """Flatten the metrics config into a dictionary keyed by
+       (daemon, druid_metric_name) with MetricPlan values. The plans of
+       previous_plan whose config didn't change are reused as they are.
+    """
+    metrics_plan = {}
+    for daemon, metrics in metrics_config.items():
+        for metric_name, metric_config in metrics.items():
+            metric_plan = (previous_plan or {}).get((daemon, metric_name))
+            if metric_plan is None or metric_plan.config != metric_config:
+                metric_plan = MetricPlan(daemon, metric_name, metric_config, series_ttl)
+            metrics_plan[(daemon, metric_name)] = metric_plan
+    return metrics_plan
+
+
+class StaticRegistry(object):
+    """Minimal registry-like wrapper, used to render a given list of metric
+       families with prometheus_client's generate_latest.
+    """
+
+    def __init__(self, metric_families):
+        self.metric_families = list(metric_families)
+
+    def collect(self):
+        return iter(self.metric_families)
+
+
+class CachedMetricFamily(object):
+    """A metric family built by a scrape, with its text exposition rendered
+       lazily (only when requested) and reused by following scrapes until
+       the family is modified.
+    """
+    __slots__ = ('family_key', 'metric_family', 'rendered_at', '_text', '_protobuf',
+                 '_compressed')
+
+    def __init__(self, family_key, metric_family, rendered_at):
+        self.family_key = family_key
+        self.metric_family = metric_family
+        self.rendered_at = rendered_at
+        self._text = None
+        self._protobuf = None
+        # {(use_protobuf, content_encoding): compressed exposition}
+        self._compressed = {}
+
+    def text(self):
+        if self._text is None:
+            self._text = generate_latest(StaticRegistry([self.metric_family]))
+        return self._text
+
+    def protobuf(self):
+        """Return the MetricFamily protobuf message (not delimited)."""
+        if self._protobuf is None:
+            self._protobuf = protobuf.encode_metric_family(self.metric_family)
+        return self._protobuf
+
+    def compressed(self, use_protobuf, content_encoding):
+        """Return the exposition of the family (the delimited protobuf one
+           if use_protobuf is True) compressed with the content encoding, as
+           a gzip member or zstd frame that can be concatenated to others.
+        """
+        key = (use_protobuf, content_encoding)
+        if key not in self._compressed:
+            if use_protobuf:
+                exposition = protobuf.delimited(self.protobuf())
+            else:
+                exposition = self.text()
+            self._compressed[key] = compression.compress(exposition, content_encoding)
+        return self._compressed[key]
+
+
+class DurationHistogram(object):
+    """Minimal histogram of durations (in seconds) used for the exporter's
+       own metrics. Unlike the prometheus_client ones its values can be
+       exported via exporter_stats() and merged among shards.
+    """
+    buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+               float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+        self.sum += value
+
+
+class QueueFullError(Exception):
+    """Raised when a payload is rejected because the ingestion queue is full."""
+
 
 class DruidCollector(object):
     scrape_duration = Summary(
             'druid_scrape_duration_seconds', 'Druid scrape duration')
 
-    def __init__(self, metrics_config, kafka_config=None):
+    def __init__(self, metrics_config, kafka_config=None,
+                 scrape_cache_max_staleness=0, series_ttl=None, max_series=None,
+                 shard_router=None, queue_size=None, queue_overflow='reject',
+                 host_liveness_window=None, max_payload_size=decoding.MAX_PAYLOAD_SIZE):
 
         # The ingestion of the datapoints is separated from their processing,
         # to separate concerns and avoid unnecessary slowdowns for Druid
         # daemons sending data.
+        # Every item of the queue is a batch of datapoints (a whole POST body
+        # or Kafka message), to limit the locking overhead of the queue.
         # Only one thread de-queues and process datapoints, in this way we
         # don't really need any special locking to guarantee consistency.
         # Since this thread is not I/O bound it doesn't seem the case to
@@ -47,25 +325,48 @@ class DruidCollector(object):
         self.datapoints_queue = queue.Queue()
         self.stop_threads = threading.Event()
 
-        threading.Thread(
-                target=self.process_queued_datapoints,
-                args=(self.stop_threads,)).start()
+        # The queue can be bounded to queue_size datapoints (not batches).
+        # When it is full, depending on queue_overflow:
+        # * 'reject': new HTTP payloads are refused (returning a 503 to
+        #   the Druid emitter, that will retry later), while the Kafka
+        #   consumer waits for the queue to have room again.
+        # * 'drop-oldest': the oldest batches are removed from the queue.
+        # * 'sample': only an evenly spaced subset of the new batch is kept.
+        # The accounting is protected by queue_lock (via queue_not_full).
+        self.queue_size = queue_size
+        self.queue_overflow = queue_overflow
+        self.queue_not_full = threading.Condition(threading.Lock())
+        self.queued_datapoints = 0
+        self.queue_high_watermark = 0
+        self.payloads_rejected = 0
+        self.datapoints_shed = defaultdict(int)
 
-        # if a Kafka config is provided, create a dedicated thread
-        # that pulls datapoints from a Kafka topic.
-        # The thread will then push datapoints to the same queue that
-        # the HTTP server uses. In this way the exporter allows a mixed
-        # configuration for Druid Brokers between HTTPEmitter and
-        # KafkaEmitter (for daemons emitting too many datapoints/s).
-        if kafka_config:
-            if KafkaConsumer:
-                threading.Thread(
-                    target=self.pull_datapoints_from_kafka,
-                    args=(kafka_config, self.stop_threads)).start()
-            else:
-                log.error('A Kafka configuration was provided, but it seems '
-                          'that the Kafka client library is not available. '
-                          'Please install the correct dependencies.')
+        # The datapoints of a streamed payload are held in memory until it
+        # has been entirely decoded (see register_stream), so the payloads
+        # bigger than max_payload_size bytes (once decompressed) are refused.
+        self.max_payload_size = max_payload_size
+
+        # Bookkeeping for the exporter's own metrics, updated by multiple
+        # threads (HTTP, Kafka and processing ones) under stats_lock:
+        # * the time spent in every stage of the pipeline (reading and
+        #   decoding payloads, waiting in the queue, processing batches
+        #   and rendering metrics).
+        # * the datapoints dropped before being stored, by reason.
+        # The datapoints stored for each (daemon, metric_name) are counted
+        # in datapoints_ingested by the processing thread (under the
+        # storage lock).
+        self.stats_lock = threading.Lock()
+        self.stage_durations = defaultdict(DurationHistogram)
+        self.datapoints_dropped = defaultdict(int)
+        self.payloads_skipped = 0
+        self.datapoints_ingested = defaultdict(int)
+
+        # The processing thread applies a whole batch of datapoints while
+        # holding this lock, and collect() holds it only for the time needed
+        # to copy the stored values. In this way a scrape always sees a
+        # consistent view (no torn histograms) and rendering the metrics
+        # doesn't block ingestion.
+        self.storage_lock = threading.Lock()
 
         # Datapoints successfully registered
         self.datapoints_registered = 0
@@ -75,25 +376,209 @@ class DruidCollector(object):
         self.histograms = defaultdict(lambda: {})
 
         # Data structure holding counters data
-        # Format: {daemon: {label_name: {label2_name: value}}
+        # Format: {metric_name: {daemon: SeriesIndex}}, every SeriesIndex
+        # mapping the label values of a series to its value
         # The order of the labels listed in supported_metric_names is important
         # since it is reflected in this data structure. The layering is not
         # strictly important for the final prometheus metrics but
         # it is simplifies the code that creates them (collect method).
         self.counters = defaultdict(lambda: {})
 
-        # List of metrics to collect/expose via the exporter
+        # List of metrics to collect/expose via the exporter. The config can
+        # be replaced at runtime by reload_metrics_config, swapping these
+        # attributes (without pausing ingestion).
+        self.series_ttl = series_ttl
         self.metrics_config = metrics_config
         self.supported_daemons = list(self.metrics_config.keys())
+        self.metrics_plan = compile_metrics_config(self.metrics_config, series_ttl)
+        self.payload_filter = self.new_payload_filter(self.metrics_plan)
+
+        # Series of metrics with a TTL are tracked in insertion order of
+        # their last update, one OrderedDict per metric family:
+        # {(daemon, metric_name): OrderedDict({label_values: last_update})}
+        # so that the expired ones can be found from the head of each dict
+        # without scanning all the series.
+        self.series_last_update = defaultdict(OrderedDict)
+        self.sweeper_thread = None
+
+        # The counters and gauges whose series are merged by dropping some
+        # labels (see MetricPlan.sum_merged) export the sum of the last
+        # values of the merged datapoints, kept for each series as:
+        # {family_key: {label_values: [sum, OrderedDict({
+        #     dropped_label_values: (value, last_update)})]}}
+        # in order of last update, so that the values not updated for longer
+        # than the metric's TTL can be removed from the sum like the series.
+        self.merged_series = defaultdict(dict)
+
+        # Liveness of the Druid daemons emitting datapoints, for each
+        # (daemon, host): the last time one of its datapoints was processed
+        # (time.monotonic()) and the number of its datapoints, updated by the
+        # processing thread under the storage lock.
+        # When host_liveness_window is set, every series is also indexed by
+        # the (daemon, host) that updated it last, so that all the series of
+        # a host not emitting for longer than the window can be dropped in one
+        # go (for example the ones of a coordinator that lost the leadership):
+        # * host_series: {(daemon, host): {family_key: {label_values, ...}}}
+        # * series_hosts: {family_key: {label_values: (daemon, host)}}
+        self.host_liveness_window = host_liveness_window
+        self.host_last_seen = {}
+        self.host_datapoints = defaultdict(int)
+        self.host_series = defaultdict(lambda: defaultdict(set))
+        self.series_hosts = defaultdict(dict)
+
+        # Series budgets: besides the per-metric max_series of the config,
+        # max_series limits the total number of series stored by the exporter.
+        # The datapoints that would have created a new series beyond these
+        # limits are counted, for each metric family, in series_dropped.
+        self.max_series = max_series
+        self.series_count = 0
+        self.series_dropped = defaultdict(int)
+
+        # Every metric family is rendered only when some of its series
+        # changed since the last scrape, otherwise the cached version is used.
+        # The (daemon, metric_name) keys of the families modified by the
+        # processing thread are tracked in dirty_families (protected by the
+        # storage lock). A dirty family is re-rendered at most once every
+        # scrape_cache_max_staleness seconds (zero means at every scrape).
+        self.dirty_families = set()
+        self.summary_families = {
+            family_key for family_key, metric_plan in self.metrics_plan.items()
+            if metric_plan.type == 'summary'}
+        self.families_cache = {}
+        self.families_cache_lock = threading.Lock()
+        self.scrape_cache_max_staleness = scrape_cache_max_staleness
+
+        # When the exporter runs multiple processes, each one of them stores
+        # only a shard of the series, and the router forwards the datapoints
+        # belonging to the other shards (see the sharding module).
+        self.shard_router = shard_router
+
+        threading.Thread(
+                target=self.process_queued_datapoints,
+                args=(self.stop_threads,)).start()
+
+        self.start_stale_series_sweeper()
+
+        # Consumer lag of the Kafka partitions assigned to the consumers
+        # of this process: {(topic, partition): lag} (under stats_lock).
+        self.kafka_consumer_lag = {}
+
+        if kafka_config:
+            self.start_kafka_consumers(kafka_config)
+
+    def start_kafka_consumers(self, kafka_config):
+        """Create dedicated threads that pull datapoints from a Kafka topic.
+           The threads will then push datapoints to the same queue that
+           the HTTP server uses. In this way the exporter allows a mixed
+           configuration for Druid Brokers between HTTPEmitter and
+           KafkaEmitter (for daemons emitting too many datapoints/s).
+           All the consumers are part of the same consumer group, so the
+           partitions of the topic are split among them.
+        """
+        if KafkaConsumer:
+            for _ in range(kafka_config.get('consumers', 1)):
+                threading.Thread(
+                    target=self.pull_datapoints_from_kafka,
+                    args=(kafka_config, self.stop_threads)).start()
+        else:
+            log.error('A Kafka configuration was provided, but it seems '
+                      'that the Kafka client library is not available. '
+                      'Please install the correct dependencies.')
+
+    def start_stale_series_sweeper(self):
+        """Evict the expired series (and the ones of the hosts not emitting
+           anymore) periodically, checking a few times during the shortest TTL
+           or liveness window configured (if any, and if not done already).
+        """
+        ttls = [plan.ttl for plan in self.metrics_plan.values() if plan.ttl]
+        if self.host_liveness_window:
+            ttls.append(self.host_liveness_window)
+        if ttls and self.sweeper_thread is None:
+            self.sweeper_thread = threading.Thread(
+                target=self.expire_stale_series,
+                args=(min(60, max(1, min(ttls) / 4)), self.stop_threads))
+            self.sweeper_thread.start()
+
+    def reload_metrics_config(self, metrics_config):
+        """Replace the metrics config (already validated) at runtime.
+           Only the metric definitions that changed are compiled again, and
+           the series stored are kept unless the changes affect how they are
+           stored (see STORAGE_FIELDS): the series of the metrics removed from
+           the config, or whose storage changed, are dropped.
+           The batches already queued may still reference the replaced plans,
+           they are marked as retired so that the processing thread looks up
+           their current version (see process_datapoints_batch).
+        """
+        metrics_plan = compile_metrics_config(
+            metrics_config, self.series_ttl, self.metrics_plan)
+        # Same locking order of refresh_families_cache.
+        with self.families_cache_lock:
+            with self.storage_lock:
+                now = time.monotonic()
+                for family_key, old_plan in self.metrics_plan.items():
+                    new_plan = metrics_plan.get(family_key)
+                    if new_plan is old_plan:
+                        continue
+                    old_plan.retired = True
+                    self.families_cache.pop(family_key, None)
+                    if new_plan is None or not new_plan.same_storage(old_plan):
+                        self.remove_family(old_plan)
+                    elif not new_plan.ttl:
+                        self.series_last_update.pop(family_key, None)
+                    elif not old_plan.ttl:
+                        # Start counting the TTL of the existing series now.
+                        self.series_last_update[family_key] = OrderedDict(
+                            (label_values, now)
+                            for label_values in self.family_series(old_plan))
+                    if new_plan is not None:
+                        self.dirty_families.add(family_key)
+
+                self.metrics_config = metrics_config
+                self.supported_daemons = list(metrics_config.keys())
+                self.metrics_plan = metrics_plan
+                self.payload_filter = self.new_payload_filter(metrics_plan)
+                self.summary_families = {
+                    family_key for family_key, metric_plan in metrics_plan.items()
+                    if metric_plan.type == 'summary'}
+        self.start_stale_series_sweeper()
+        log.info('Metrics config reloaded (%d metrics)', len(metrics_plan))
 
     def stop_running_threads(self):
         self.stop_threads.set()
+        # Unblock the processing thread, that might be waiting for a batch.
+        self.datapoints_queue.put((None, []))
+
+    def observe_stage(self, stage, duration):
+        with self.stats_lock:
+            self.stage_durations[stage].observe(duration)
+
+    def count_dropped(self, reason, count=1):
+        with self.stats_lock:
+            self.datapoints_dropped[reason] += count
+
+    @staticmethod
+    def new_payload_filter(metrics_plan):
+        return decoding.PayloadFilter({metric_name for _, metric_name in metrics_plan})
+
+    def skip_unsupported_payload(self, payload, encoding='utf-8'):
+        """Return True if the payload holds only datapoints that would be
+           dropped anyway (see decoding.PayloadFilter), counting them as
+           dropped without decoding the payload.
+        """
+        dropped = self.payload_filter.dropped_datapoints(payload, encoding)
+        if dropped is None:
+            return False
+        with self.stats_lock:
+            self.payloads_skipped += 1
+            self.datapoints_dropped['unsupported_feed'] += dropped[0]
+            self.datapoints_dropped['unknown_metric'] += dropped[1]
+        return True
 
     @staticmethod
     def sanitize_field(datapoint_field):
         return datapoint_field.replace('druid/', '').lower()
 
-    def store_counter(self, datapoint):
+    def store_counter(self, datapoint, metric_plan=None):
         """ This function adds data to the self.counters dictiorary
             following its convention, creating on the fly
             the missing bits. For example, given:
@@ -105,191 +590,1036 @@ class DruidCollector(object):
             This function will creates the following:
             self.counters = {
                 'segment/size': {
-                    'broker':
-                        { ('test'): 10 }
+                    'broker': SeriesIndex({('test',): 10.0})
                     }
                 }
 
+            Every SeriesIndex maps the label values of the series of a metric
+            family to an integer ID, their position in an array of values.
             The algorithm is generic enough to support all metrics handled by
             self.counters without caring about the number of labels needed.
         """
-        daemon = DruidCollector.sanitize_field(str(datapoint['service']))
-        metric_name = str(datapoint['metric'])
+        if metric_plan is None:
+            metric_plan = self.get_metric_plan(datapoint)
         metric_value = float(datapoint['value'])
 
-        metrics_storage = self.counters[metric_name]
-        metric_labels = self.metrics_config[daemon][metric_name]['labels']
+        try:
+            raw_label_values = metric_plan.label_getter(datapoint)
+        except KeyError as e:
+            log.error('Missing label {} for datapoint {} (expected labels: {}), '
+                      'dropping it. Please check your metric configuration file.'
+                      .format(e, datapoint, metric_plan.labels))
+            self.count_dropped('missing_label')
+            return
+        if raw_label_values is None:
+            self.count_dropped('relabel')
+            return
 
-        metrics_storage.setdefault(daemon, {})
+        series_storage = self.counter_series(metric_plan)
+        series_id = series_storage.lookup(raw_label_values)
+        if series_id is None:
+            label_values = self.admit_series(
+                metric_plan, series_storage, intern_label_values(raw_label_values))
+            if label_values is None:
+                return
+            series_id = series_storage.ids.get(label_values)
+            if series_id is None:
+                series_id = series_storage.add(label_values)
+        if metric_plan.sum_merged:
+            metric_value = self.sum_merged_series(
+                metric_plan, series_storage.labels[series_id], datapoint, metric_value)
+        series_storage.values[series_id] = metric_value
+        self.touch_series(metric_plan, series_storage.labels[series_id],
+                          host=datapoint.get('host'))
+        log.debug("The datapoint %s modified the counters dictionary to: \n%s",
+                  datapoint, self.counters)
 
-        label_values = []
-        if metric_labels:
-            for label in metric_labels:
-                try:
-                    label_values.append(str(datapoint[label]))
-                except KeyError as e:
-                    log.error('Missing label {} for datapoint {} (expected labels: {}), '
-                              'dropping it. Please check your metric configuration file.'
-                              .format(label, datapoint, metric_labels))
-                    return
-
-        # Convert the list of labels to a tuple to allow indexing
-        metrics_storage[daemon][tuple(label_values)] = metric_value
-        log.debug("The datapoint {} modified the counters dictionary to: \n{}"
-                  .format(datapoint, self.counters))
-
-    def store_histogram(self, datapoint):
-        """ Store datapoints that will end up in histogram buckets using a dictiorary.
-            This function is highly customized for the only histograms configured
-            so far, rather than being generic like store_counter. Example of how
-            it works:
+    def sum_merged_series(self, metric_plan, label_values, datapoint, value):
+        """Return the new value of a series merging, by dropping some labels,
+           the ones of multiple datapoints: the sum of their last values. To
+           be called while holding the storage lock.
+        """
+        family_merged_series = self.merged_series[metric_plan.key]
+        merged = family_merged_series.get(label_values)
+        if merged is None:
+            merged = family_merged_series[label_values] = [0.0, OrderedDict()]
+        dropped_label_values = metric_plan.relabeler.dropped_label_values(datapoint)
+        previous = merged[1].pop(dropped_label_values, None)
+        merged[0] += value - (previous[0] if previous is not None else 0.0)
+        merged[1][dropped_label_values] = (value, time.monotonic())
+        return merged[0]
+
+    def expire_merged_values(self, metric_plan, now):
+        """Remove from the sums of the merged series of a metric family the
+           values not updated for longer than its TTL, to be called while
+           holding the storage lock. Return the number of values removed.
+        """
+        expired = 0
+        series_storage = self.family_series(metric_plan)
+        for label_values, merged in self.merged_series.get(metric_plan.key, {}).items():
+            values = merged[1]
+            expired_before = expired
+            while values:
+                dropped_label_values, (_, updated_at) = next(iter(values.items()))
+                if now - updated_at < metric_plan.ttl:
+                    break
+                del values[dropped_label_values]
+                expired += 1
+            if expired > expired_before:
+                # Summing the remaining values again avoids accumulating
+                # rounding errors.
+                merged[0] = math.fsum(value for value, _ in values.values())
+                series_id = series_storage.ids.get(label_values)
+                if series_id is not None:
+                    series_storage.values[series_id] = merged[0]
+                self.dirty_families.add(metric_plan.key)
+        return expired
+
+    def counter_series(self, metric_plan):
+        """Return the SeriesIndex of a counter or gauge metric family,
+           creating it if needed.
+        """
+        daemon_storage = self.counters[metric_plan.metric_name]
+        series_storage = daemon_storage.get(metric_plan.daemon)
+        if series_storage is None:
+            series_storage = daemon_storage[metric_plan.daemon] = SeriesIndex()
+        return series_storage
+
+    def store_histogram(self, datapoint, metric_plan=None):
+        """ Store datapoints that will end up in histogram buckets.
+            Every series is a fixed size array with the count of each bucket
+            (in the order of the config) followed by the sum, the bucket
+            boundaries being shared in the MetricPlan. Example of how it works:
             self.histograms = {}
             datapoint = {'service': 'druid/broker', 'metric'='query/time',
                          'datasource': 'test', 'value': 10}
+            buckets = ["10", "100", ..., "inf", "sum"]
 
             This function will creates the following:
             self.histograms = {
                 'query/time': {
                     'broker': {
-                        ('test'): {'10': 1, '100': 1, etc.., 'sum': 10 }
+                        ('test'): array('d', [1.0, 1.0, etc.., 10.0])
                     }
                 }
             }
         """
-        daemon = DruidCollector.sanitize_field(str(datapoint['service']))
-        metric_name = str(datapoint['metric'])
+        if metric_plan is None:
+            metric_plan = self.get_metric_plan(datapoint)
         metric_value = float(datapoint['value'])
-        metric_labels = self.metrics_config[daemon][metric_name]['labels']
-        metric_buckets = self.metrics_config[daemon][metric_name]['buckets']
 
-        self.histograms.setdefault(metric_name, {daemon: {}})
-        self.histograms[metric_name].setdefault(daemon, {})
+        try:
+            label_values = metric_plan.label_values(datapoint)
+        except KeyError as e:
+            log.error('Missing label {} for datapoint {} (expected labels: {}), '
+                      'dropping it. Please check your metric configuration file.'
+                      .format(e, datapoint, metric_plan.labels))
+            self.count_dropped('missing_label')
+            return
+        if label_values is None:
+            self.count_dropped('relabel')
+            return
 
-        label_values = []
-        if metric_labels:
-            for label in metric_labels:
-                try:
-                    label_values.append(str(datapoint[label]))
-                except KeyError as e:
-                    log.error('Missing label {} for datapoint {} (expected labels: {}), '
-                              'dropping it. Please check your metric configuration file.'
-                              .format(label, metric_labels, datapoint))
-                    return
-
-        # Convert the list of labels to a tuple to allow indexing
-        self.histograms[metric_name][daemon].setdefault(tuple(label_values), {})
-
-        stored_buckets = self.histograms[metric_name][daemon][tuple(label_values)]
-        for bucket in metric_buckets:
-            if bucket not in stored_buckets:
-                stored_buckets[bucket] = 0
-            if bucket != 'sum' and metric_value <= float(bucket):
-                stored_buckets[bucket] += 1
-        stored_buckets['sum'] += metric_value
-
-        log.debug("The datapoint {} modified the histograms dictionary to: \n{}"
-                  .format(datapoint, self.histograms))
+        series = self.histogram_series(metric_plan, label_values)
+        if series is None:
+            return
+        self.add_histogram_samples(metric_plan, series[0], series[1], [metric_value],
+                                   datapoint.get('host'))
 
-    @scrape_duration.time()
-    def collect(self):
-        # Loop through all metrics configured, and get datapoints
-        # for them saved by the exporter.
-        for daemon in self.metrics_config.keys():
-            for druid_metric_name in self.metrics_config[daemon]:
-                metric_type = self.metrics_config[daemon][druid_metric_name]['type']
+        log.debug("The datapoint %s modified the histograms dictionary to: \n%s",
+                  datapoint, self.histograms)
 
-                if metric_type == 'gauge' or metric_type == 'counter':
-                    try:
-                        self.counters[druid_metric_name]
-                        self.counters[druid_metric_name][daemon]
-                    except KeyError:
-                        continue
+    def store_histograms(self, batch):
+        """Store a batch of (metric_plan, datapoint) couples of histogram
+           metrics like store_histogram, but grouping the samples of every
+           series first, so that its buckets are updated only once per batch.
+        """
+        series_samples = {}
+        for metric_plan, datapoint in batch:
+            metric_value = float(datapoint['value'])
 
-                    if metric_type == 'gauge':
-                        metric_family_obj = GaugeMetricFamily
-                    else:
-                        metric_family_obj = CounterMetricFamily
-
-                    prometheus_metric = metric_family_obj(
-                        self.metrics_config[daemon][druid_metric_name]['prometheus_metric_name'],
-                        self.metrics_config[daemon][druid_metric_name]['description'],
-                        labels=map(
-                            lambda x: x.lower(),
-                            self.metrics_config[daemon][druid_metric_name]['labels']))
-                    label_values = list(self.counters[druid_metric_name][daemon].keys())
-                    for label_value in label_values:
-                        value = self.counters[druid_metric_name][daemon][label_value]
-                        prometheus_metric.add_metric(label_value, value)
-
-                elif metric_type == 'histogram':
-                    try:
-                        self.histograms[druid_metric_name]
-                        self.histograms[druid_metric_name][daemon]
-                    except KeyError:
+            try:
+                label_values = metric_plan.label_values(datapoint)
+            except KeyError as e:
+                log.error('Missing label {} for datapoint {} (expected labels: {}), '
+                          'dropping it. Please check your metric configuration file.'
+                          .format(e, datapoint, metric_plan.labels))
+                self.count_dropped('missing_label')
+                continue
+            if label_values is None:
+                self.count_dropped('relabel')
+                continue
+
+            samples = series_samples.get((metric_plan.key, label_values))
+            if samples is None:
+                series = self.histogram_series(metric_plan, label_values)
+                if series is None:
+                    continue
+                samples = series_samples[(metric_plan.key, label_values)] = [
+                    metric_plan, series[0], series[1], [], None]
+            samples[3].append(metric_value)
+            # The series is owned by the last host that updated it.
+            samples[4] = datapoint.get('host')
+
+        for metric_plan, label_values, stored_buckets, values, host in series_samples.values():
+            self.add_histogram_samples(metric_plan, label_values, stored_buckets, values, host)
+
+    def histogram_series(self, metric_plan, label_values):
+        """Return the (label_values, buckets) of the histogram series to
+           update, creating it if needed (after checking the series budgets),
+           or None if the datapoint needs to be dropped. To be called while
+           holding the storage lock.
+        """
+        daemon_storage = self.histograms.setdefault(metric_plan.metric_name, {})
+        series_storage = daemon_storage.setdefault(metric_plan.daemon, {})
+        stored_buckets = series_storage.get(label_values)
+        if stored_buckets is None:
+            label_values = self.admit_series(metric_plan, series_storage, label_values)
+            if label_values is None:
+                return None
+            stored_buckets = series_storage.get(label_values)
+        if stored_buckets is None:
+            if metric_plan.type == 'exponential_histogram':
+                stored_buckets = ExponentialHistogram(
+                    metric_plan.schema, metric_plan.zero_threshold, metric_plan.max_buckets)
+            elif metric_plan.type == 'summary':
+                stored_buckets = QuantileSummary(
+                    metric_plan.quantiles, metric_plan.relative_accuracy,
+                    metric_plan.max_buckets, metric_plan.max_age, metric_plan.age_buckets)
+            else:
+                stored_buckets = metric_plan.new_histogram_values()
+            series_storage[label_values] = stored_buckets
+        return label_values, stored_buckets
+
+    def add_histogram_samples(self, metric_plan, label_values, stored_buckets, values,
+                              host=None):
+        """Add a list of samples (emitted by host) to the buckets of a
+           histogram series.
+        """
+        if metric_plan.type in ('exponential_histogram', 'summary'):
+            stored_buckets.observe(values)
+            self.touch_series(metric_plan, label_values, len(values), host)
+            return
+        cumulative_counts = bin_histogram_samples(metric_plan.bucket_bounds, values)
+        for position, count in zip(metric_plan.bucket_positions, cumulative_counts):
+            stored_buckets[position] += count
+        stored_buckets[-1] += sum(values)
+        self.touch_series(metric_plan, label_values, len(values), host)
+
+    def admit_series(self, metric_plan, series_storage, label_values):
+        """Check the series budgets before creating a new series, to be called
+           while holding the storage lock. Return the label values of the
+           series to update, or None if the datapoint needs to be dropped.
+        """
+        if ((metric_plan.max_series is None or
+                len(series_storage) < metric_plan.max_series) and
+                (self.max_series is None or self.series_count < self.max_series)):
+            self.series_count += 1
+            return label_values
+
+        self.series_dropped[metric_plan.key] += 1
+        if metric_plan.overflow != 'fold':
+            log.debug('Series budget exceeded for metric %s of daemon %s, '
+                      'dropping series %s', metric_plan.metric_name,
+                      metric_plan.daemon, label_values)
+            return None
+
+        # The overflow series is created even if it exceeds the budget,
+        # since there can be only one for each metric family.
+        if metric_plan.overflow_label_values not in series_storage:
+            self.series_count += 1
+        return metric_plan.overflow_label_values
+
+    def touch_series(self, metric_plan, label_values, datapoints=1, host=None):
+        """Record that a series has been updated (by a number of datapoints
+           emitted by host), to be called while holding the storage lock.
+        """
+        self.dirty_families.add(metric_plan.key)
+        self.datapoints_ingested[metric_plan.key] += datapoints
+        if metric_plan.ttl:
+            last_update = self.series_last_update[metric_plan.key]
+            last_update[label_values] = time.monotonic()
+            last_update.move_to_end(label_values)
+        if self.host_liveness_window and host is not None:
+            host_key = (metric_plan.daemon, host)
+            owners = self.series_hosts[metric_plan.key]
+            owner = owners.get(label_values)
+            if owner != host_key:
+                if owner is not None:
+                    self.host_series[owner][metric_plan.key].discard(label_values)
+                owners[label_values] = host_key
+                self.host_series[host_key][metric_plan.key].add(label_values)
+
+    def remove_series(self, metric_plan, label_values):
+        """Drop a series from the storage, to be called while holding the
+           storage lock.
+        """
+        series_storage = self.family_series(metric_plan)
+        if series_storage.pop(label_values, None) is not None:
+            self.series_count -= 1
+        self.series_last_update.get(metric_plan.key, {}).pop(label_values, None)
+        self.merged_series.get(metric_plan.key, {}).pop(label_values, None)
+        owner = self.series_hosts.get(metric_plan.key, {}).pop(label_values, None)
+        if owner is not None and owner in self.host_series:
+            self.host_series[owner][metric_plan.key].discard(label_values)
+        self.dirty_families.add(metric_plan.key)
+
+    def family_series(self, metric_plan):
+        """Return the series stored for the given metric family (not a
+           copy), to be called while holding the storage lock.
+        """
+        if metric_plan.type in HISTOGRAM_TYPES:
+            storage = self.histograms
+        else:
+            storage = self.counters
+        return storage.get(metric_plan.metric_name, {}).get(metric_plan.daemon, {})
+
+    def remove_family(self, metric_plan):
+        """Drop all the series of a metric family from the storage, to be
+           called while holding the storage lock.
+        """
+        if metric_plan.type in HISTOGRAM_TYPES:
+            storage = self.histograms
+        else:
+            storage = self.counters
+        daemon_storage = storage.get(metric_plan.metric_name, {})
+        series_storage = daemon_storage.pop(metric_plan.daemon, None)
+        if series_storage is not None:
+            self.series_count -= len(series_storage)
+        if not daemon_storage:
+            storage.pop(metric_plan.metric_name, None)
+        self.series_last_update.pop(metric_plan.key, None)
+        self.merged_series.pop(metric_plan.key, None)
+        for owner in set(self.series_hosts.pop(metric_plan.key, {}).values()):
+            self.host_series[owner].pop(metric_plan.key, None)
+        self.dirty_families.discard(metric_plan.key)
+
+    def expire_stale_series_once(self, now=None):
+        """Remove the series not updated for longer than their metric's TTL,
+           returning the number of series removed.
+        """
+        if now is None:
+            now = time.monotonic()
+        expired = 0
+        for family_key in list(self.series_last_update.keys()):
+            with self.storage_lock:
+                # The family might have been removed by a config reload.
+                metric_plan = self.metrics_plan.get(family_key)
+                last_update = self.series_last_update.get(family_key)
+                if metric_plan is None or not metric_plan.ttl or last_update is None:
+                    continue
+                while last_update:
+                    label_values, updated_at = next(iter(last_update.items()))
+                    if now - updated_at < metric_plan.ttl:
+                        break
+                    self.remove_series(metric_plan, label_values)
+                    expired += 1
+                if metric_plan.sum_merged:
+                    self.expire_merged_values(metric_plan, now)
+        if expired:
+            log.debug('Expired %d stale series', expired)
+        return expired
+
+    def expire_stale_hosts_once(self, now=None):
+        """Forget the hosts that didn't emit any datapoint for longer than
+           the liveness window, removing all the series they updated last.
+           Return the number of series removed.
+        """
+        if not self.host_liveness_window:
+            return 0
+        if now is None:
+            now = time.monotonic()
+        expired = 0
+        with self.storage_lock:
+            stale_hosts = [host_key for host_key, last_seen in self.host_last_seen.items()
+                           if now - last_seen >= self.host_liveness_window]
+            for host_key in stale_hosts:
+                log.info('No datapoints from %s of %s for %ss, dropping its series',
+                         host_key[1], host_key[0], self.host_liveness_window)
+                for family_key, series in self.host_series.pop(host_key, {}).items():
+                    metric_plan = self.metrics_plan.get(family_key)
+                    if metric_plan is None:
                         continue
+                    for label_values in list(series):
+                        self.remove_series(metric_plan, label_values)
+                        expired += 1
+                del self.host_last_seen[host_key]
+                self.host_datapoints.pop(host_key, None)
+        return expired
+
+    def expire_stale_series(self, interval, stop_threads):
+        log.debug('Stale series sweeper thread starting..')
+
+        while not stop_threads.wait(interval):
+            self.expire_stale_series_once()
+            self.expire_stale_hosts_once()
+
+        log.debug('Stale series sweeper thread shutting down..')
+
+    def copy_family_series(self, metric_plan):
+        """Return a copy of the series stored for the given metric family,
+           to be called while holding the storage lock.
+        """
+        series = self.family_series(metric_plan)
+        if metric_plan.type in HISTOGRAM_TYPES:
+            return {labels: copy.copy(buckets) for labels, buckets in series.items()}
+        return series.copy() if series else {}
+
+    @staticmethod
+    def build_metric_family(metric_plan, series):
+        """Create the Prometheus metric family object for the given series
+           (as returned by copy_family_series).
+        """
+        metric_type = metric_plan.type
+
+        if metric_type == 'gauge' or metric_type == 'counter':
+            if metric_type == 'gauge':
+                metric_family_obj = GaugeMetricFamily
+            else:
+                metric_family_obj = CounterMetricFamily
+
+            prometheus_metric = metric_family_obj(
+                metric_plan.prometheus_metric_name,
+                metric_plan.description,
+                labels=metric_plan.prometheus_labels)
+            for label_value, value in series.items():
+                prometheus_metric.add_metric(label_value, value)
+
+        elif metric_type == 'histogram':
+            prometheus_metric = HistogramMetricFamily(
+                    metric_plan.prometheus_metric_name,
+                    metric_plan.description,
+                    labels=metric_plan.prometheus_labels)
+
+            for label_value, values in series.items():
+                buckets = [[bucket, values[position]]
+                           for position, (bucket, _) in enumerate(metric_plan.buckets)]
+                prometheus_metric.add_metric(label_value, buckets=buckets, sum_value=values[-1])
+
+        elif metric_type == 'exponential_histogram':
+            prometheus_metric = ExponentialHistogramMetricFamily(
+                    metric_plan.prometheus_metric_name,
+                    metric_plan.description,
+                    labels=metric_plan.prometheus_labels)
+
+            for label_value, histogram in series.items():
+                prometheus_metric.add_metric(label_value, histogram)
+
+        elif metric_type == 'summary':
+            prometheus_metric = SummaryMetricFamily(
+                    metric_plan.prometheus_metric_name,
+                    metric_plan.description,
+                    labels=metric_plan.prometheus_labels)
+
+            for label_value, summary in series.items():
+                labels = dict(zip(metric_plan.prometheus_labels, label_value))
+                for quantile, value in summary.quantile_values():
+                    quantile_labels = dict(labels, quantile=floatToGoString(quantile))
+                    prometheus_metric.add_sample(
+                        metric_plan.prometheus_metric_name, quantile_labels, value)
+                prometheus_metric.add_metric(label_value, summary.count, summary.sum)
+
+        else:
+            log.info('metric type not supported: {}'.format(metric_type))
+            return None
 
-                    prometheus_metric = HistogramMetricFamily(
-                            self.metrics_config[daemon][druid_metric_name]['prometheus_metric_name'],
-                            self.metrics_config[daemon][druid_metric_name]['description'],
-                            labels=map(
-                                lambda x: x.lower(),
-                                self.metrics_config[daemon][druid_metric_name]['labels']))
-
-                    label_values = list(self.histograms[druid_metric_name][daemon].keys())
-                    for label_value in label_values:
-                        value = self.histograms[druid_metric_name][daemon][label_value]
-                        buckets_without_sum = [
-                            [key, value] for key, value in value.items() if key != 'sum']
-                        prometheus_metric.add_metric(
-                            label_value, buckets=buckets_without_sum, sum_value=value['sum'])
+        return prometheus_metric
 
+    def refresh_families_cache(self):
+        """Rebuild the cached metric families modified since the last scrape
+           (honoring scrape_cache_max_staleness) and return the list of
+           cached families, in the order of the metrics config.
+        """
+        with self.families_cache_lock:
+            now = time.monotonic()
+            with self.storage_lock:
+                refresh = []
+                # The quantiles of the summaries change over time even
+                # without new datapoints, since old samples expire.
+                for family_key in self.dirty_families | self.summary_families:
+                    cached_family = self.families_cache.get(family_key)
+                    if (cached_family is None or
+                            now - cached_family.rendered_at >= self.scrape_cache_max_staleness):
+                        refresh.append(family_key)
+                self.dirty_families.difference_update(refresh)
+                series_copies = [
+                    (family_key, self.copy_family_series(self.metrics_plan[family_key]))
+                    for family_key in refresh]
+
+            for family_key, series in series_copies:
+                prometheus_metric = None
+                if series:
+                    prometheus_metric = self.build_metric_family(
+                        self.metrics_plan[family_key], series)
+                if prometheus_metric is None:
+                    self.families_cache.pop(family_key, None)
                 else:
-                    log.info('metric type not supported: {}'.format(metric_type))
-                    continue
+                    self.families_cache[family_key] = CachedMetricFamily(
+                        family_key, prometheus_metric, now)
+
+            cached_families = [
+                self.families_cache[family_key] for family_key in self.metrics_plan
+                if family_key in self.families_cache]
+
+        return cached_families
+
+    def exporter_stats(self):
+        """Return a copy of the exporter's bookkeeping values, used to
+           generate its own metrics.
+        """
+        with self.storage_lock:
+            stats = {
+                'datapoints_registered': self.datapoints_registered,
+                'series_dropped': dict(self.series_dropped),
+                'datapoints_ingested': dict(self.datapoints_ingested),
+                'host_datapoints': dict(self.host_datapoints),
+            }
+            # Exported as a Unix timestamp.
+            now, monotonic_now = time.time(), time.monotonic()
+            stats['host_last_seen'] = {
+                host_key: now - (monotonic_now - last_seen)
+                for host_key, last_seen in self.host_last_seen.items()}
+        with self.queue_not_full:
+            stats.update({
+                'queue_datapoints': self.queued_datapoints,
+                'queue_high_watermark': self.queue_high_watermark,
+                'payloads_rejected': self.payloads_rejected,
+                'datapoints_shed': dict(self.datapoints_shed),
+            })
+        with self.datapoints_queue.mutex:
+            oldest_batch = self.datapoints_queue.queue[0] if self.datapoints_queue.queue else None
+        if oldest_batch is not None and oldest_batch[0] is not None:
+            stats['queue_oldest_batch_age'] = time.monotonic() - oldest_batch[0]
+        with self.stats_lock:
+            stats['kafka_consumer_lag'] = dict(self.kafka_consumer_lag)
+            stats['datapoints_dropped'] = dict(self.datapoints_dropped)
+            stats['payloads_skipped'] = self.payloads_skipped
+            stats['stage_duration_buckets'] = {
+                (stage, index): count
+                for stage, histogram in self.stage_durations.items()
+                for index, count in enumerate(histogram.counts)}
+            stats['stage_duration_sum'] = {
+                stage: histogram.sum for stage, histogram in self.stage_durations.items()}
+        return stats
 
-                yield prometheus_metric
+    # Stats merged among shards keeping the maximum value instead of the sum.
+    max_merged_stats = ('queue_high_watermark', 'queue_oldest_batch_age', 'host_last_seen')
 
+    @staticmethod
+    def merge_exporter_stats(stats_list):
+        """Merge the exporter_stats() of multiple shards, summing the values
+           (except for the max_merged_stats ones).
+        """
+        merged = {}
+        for stats in stats_list:
+            for name, value in stats.items():
+                if isinstance(value, dict):
+                    merged_value = merged.setdefault(name, {})
+                    for key, key_value in value.items():
+                        if name in DruidCollector.max_merged_stats:
+                            merged_value[key] = max(merged_value.get(key, 0), key_value)
+                        else:
+                            merged_value[key] = merged_value.get(key, 0) + key_value
+                elif name in DruidCollector.max_merged_stats:
+                    merged[name] = max(merged.get(name, 0), value)
+                else:
+                    merged[name] = merged.get(name, 0) + value
+        return merged
+
+    @staticmethod
+    def collect_exporter_metrics(stats):
         registered = CounterMetricFamily('druid_exporter_datapoints_registered',
                                          'Number of datapoints successfully registered '
                                          'by the exporter.')
-        registered.add_metric([], self.datapoints_registered)
+        registered.add_metric([], stats.get('datapoints_registered', 0))
         yield registered
 
-    def register_datapoint(self, datapoint):
-        if (datapoint['feed'] != 'metrics'):
-            log.debug("The following feed does not contain a datapoint, "
-                      "dropping it: {}"
-                      .format(datapoint))
+        json_backend = GaugeMetricFamily('druid_exporter_json_backend',
+                                         'JSON library used to decode datapoints.',
+                                         labels=['backend'])
+        json_backend.add_metric([decoding.json_backend], 1)
+        yield json_backend
+
+        queue_datapoints = GaugeMetricFamily('druid_exporter_queue_datapoints',
+                                             'Number of datapoints waiting to be processed.')
+        queue_datapoints.add_metric([], stats.get('queue_datapoints', 0))
+        yield queue_datapoints
+
+        queue_high_watermark = GaugeMetricFamily(
+            'druid_exporter_queue_high_watermark_datapoints',
+            'Maximum number of datapoints waiting to be processed since the start.')
+        queue_high_watermark.add_metric([], stats.get('queue_high_watermark', 0))
+        yield queue_high_watermark
+
+        queue_age = GaugeMetricFamily('druid_exporter_queue_oldest_batch_age_seconds',
+                                      'Time spent in the queue by the oldest batch of '
+                                      'datapoints waiting to be processed.')
+        queue_age.add_metric([], stats.get('queue_oldest_batch_age', 0))
+        yield queue_age
+
+        if stats.get('stage_duration_sum'):
+            stage_duration = HistogramMetricFamily(
+                'druid_exporter_stage_duration_seconds',
+                'Time spent in each stage of the datapoints pipeline: reading and '
+                'decoding payloads (per payload), waiting in the queue and processing '
+                '(per batch), rendering the metrics (per scrape).',
+                labels=['stage'])
+            for stage, duration_sum in sorted(stats['stage_duration_sum'].items()):
+                stage_duration.add_metric(
+                    [stage],
+                    buckets=[
+                        [str(upper_bound), stats['stage_duration_buckets'].get((stage, index), 0)]
+                        for index, upper_bound in enumerate(DurationHistogram.buckets)],
+                    sum_value=duration_sum)
+            yield stage_duration
+
+        if stats.get('datapoints_ingested'):
+            ingested = CounterMetricFamily('druid_exporter_datapoints_ingested',
+                                           'Number of datapoints stored for each metric.',
+                                           labels=['daemon', 'metric'])
+            for (daemon, metric_name), value in stats['datapoints_ingested'].items():
+                ingested.add_metric([daemon, metric_name], value)
+            yield ingested
+
+        if stats.get('host_datapoints'):
+            host_datapoints = CounterMetricFamily(
+                'druid_exporter_host_datapoints',
+                'Number of datapoints processed for each Druid daemon and host '
+                'emitting them.',
+                labels=['daemon', 'host'])
+            for (daemon, host), value in sorted(stats['host_datapoints'].items()):
+                host_datapoints.add_metric([daemon, str(host)], value)
+            yield host_datapoints
+
+        if stats.get('host_last_seen'):
+            host_last_seen = GaugeMetricFamily(
+                'druid_exporter_host_last_seen_timestamp_seconds',
+                'Last time a datapoint was processed for each Druid daemon and host '
+                'emitting them.',
+                labels=['daemon', 'host'])
+            for (daemon, host), value in sorted(stats['host_last_seen'].items()):
+                host_last_seen.add_metric([daemon, str(host)], value)
+            yield host_last_seen
+
+        if stats.get('datapoints_dropped'):
+            dropped = CounterMetricFamily('druid_exporter_datapoints_dropped',
+                                          'Number of datapoints dropped before being '
+                                          'stored, by reason (for decode_error, the '
+                                          'number of payloads).',
+                                          labels=['reason'])
+            for reason, value in stats['datapoints_dropped'].items():
+                dropped.add_metric([reason], value)
+            yield dropped
+
+        if stats.get('payloads_skipped'):
+            skipped = CounterMetricFamily('druid_exporter_payloads_skipped',
+                                          'Number of payloads (or Kafka messages) dropped '
+                                          'without decoding them, since they hold only '
+                                          'unsupported datapoints.')
+            skipped.add_metric([], stats['payloads_skipped'])
+            yield skipped
+
+        if stats.get('kafka_consumer_lag'):
+            kafka_lag = GaugeMetricFamily('druid_exporter_kafka_consumer_lag',
+                                          'Number of messages of each Kafka partition '
+                                          'not consumed yet.',
+                                          labels=['topic', 'partition'])
+            for (topic, partition), value in sorted(stats['kafka_consumer_lag'].items()):
+                kafka_lag.add_metric([topic, str(partition)], value)
+            yield kafka_lag
+
+        if stats.get('payloads_rejected'):
+            rejected = CounterMetricFamily('druid_exporter_payloads_rejected',
+                                           'Number of payloads rejected because the '
+                                           'queue was full.')
+            rejected.add_metric([], stats['payloads_rejected'])
+            yield rejected
+
+        if stats.get('datapoints_shed'):
+            shed = CounterMetricFamily('druid_exporter_datapoints_shed',
+                                       'Number of datapoints dropped because the '
+                                       'queue was full.',
+                                       labels=['policy'])
+            for policy, value in stats['datapoints_shed'].items():
+                shed.add_metric([policy], value)
+            yield shed
+
+        series_dropped = stats.get('series_dropped')
+        if not series_dropped:
             return
+        dropped = CounterMetricFamily('druid_exporter_series_dropped',
+                                      'Number of datapoints dropped or folded into the '
+                                      'overflow series because of series budgets.',
+                                      labels=['daemon', 'metric'])
+        for (daemon, metric_name), value in series_dropped.items():
+            dropped.add_metric([daemon, metric_name], value)
+        yield dropped
+
+    @scrape_duration.time()
+    def collect(self):
+        for cached_family in self.refresh_families_cache():
+            yield cached_family.metric_family
 
+        for metric in self.collect_exporter_metrics(self.exporter_stats()):
+            yield metric
+
+    def render_families(self, use_protobuf=False, content_encoding=None):
+        """Return a list of (family_key, text) couples with the text
+           exposition of every Druid metric family with at least one series
+           (or its MetricFamily protobuf message, if use_protobuf is True).
+           If a content encoding is given, the expositions are compressed
+           (and the protobuf messages delimited).
+        """
+        start = time.monotonic()
+        if content_encoding is not None:
+            families = [(cached_family.family_key,
+                         cached_family.compressed(use_protobuf, content_encoding))
+                        for cached_family in self.refresh_families_cache()]
+        else:
+            families = [(cached_family.family_key,
+                         cached_family.protobuf() if use_protobuf else cached_family.text())
+                        for cached_family in self.refresh_families_cache()]
+        self.observe_stage('render', time.monotonic() - start)
+        return families
+
+    def generate_latest(self, use_protobuf=False, content_encoding=None):
+        """Return the Prometheus text exposition of the Druid metrics (or the
+           protobuf one, if use_protobuf is True), using the pre-rendered
+           families not modified since the last scrape. If a content encoding
+           is given, the exposition is compressed reusing the compressed
+           families not modified since the last scrape too.
+        """
+        with self.scrape_duration.time():
+            families = self.render_families(use_protobuf, content_encoding)
+            exporter_metrics = StaticRegistry(
+                self.collect_exporter_metrics(self.exporter_stats()))
+            if use_protobuf:
+                exporter_output = protobuf.generate_latest(exporter_metrics)
+            else:
+                exporter_output = generate_latest(exporter_metrics)
+            if content_encoding is not None:
+                output = [compressed for _, compressed in families]
+            elif use_protobuf:
+                output = [protobuf.delimited(message) for _, message in families]
+            else:
+                output = [text for _, text in families]
+            output.append(compression.compress(exporter_output, content_encoding))
+            return b''.join(output)
+
+    def get_metric_plan(self, datapoint):
+        """Return the MetricPlan related to the datapoint, or None if the
+           daemon/metric couple is not listed in the exporter's config file.
+        """
         daemon = DruidCollector.sanitize_field(str(datapoint['service']))
-        if (datapoint['feed'] != 'metrics' or
-                daemon not in self.supported_daemons or
-                datapoint['metric'] not in self.metrics_config[daemon].keys()):
-            log.debug("The following datapoint is not supported, either "
-                      "because the 'feed' field is not 'metrics' or "
-                      "the daemon name ({}) is not listed in the supported ones ({}) or "
-                      "the metric itself is not listed in the exporter's config file: {}"
-                      .format(daemon, self.supported_daemons, datapoint))
+        return self.metrics_plan.get((daemon, datapoint['metric']))
+
+    def decode_payload(self, payload, encoding='utf-8'):
+        """Decode a JSON payload (the body of a POST or a Kafka message)
+           carrying either a list of datapoints or a single one, and return
+           the list of its datapoints.
+        """
+        start = time.monotonic()
+        try:
+            datapoints = decoding.loads(payload, encoding)
+        except ValueError:
+            self.count_dropped('decode_error')
+            raise
+        self.observe_stage('decode', time.monotonic() - start)
+        log.debug('Processing datapoints: %s', datapoints)
+        if type(datapoints) == list:
+            return datapoints
+        return [datapoints]
+
+    def register_payload(self, payload, encoding='utf-8'):
+        """Decode a JSON payload and register its content, unless it holds
+           only unsupported datapoints.
+        """
+        if self.skip_unsupported_payload(payload, encoding):
+            return
+        self.register_datapoints(self.decode_payload(payload, encoding))
+
+    def register_stream(self, read, encoding='utf-8', length=None, batch_size=1000):
+        """Incrementally decode a JSON payload from the read(size) function
+           (for example the input of a big POST), filtering its datapoints
+           in batches of batch_size while reading. The batches are enqueued
+           (in order) only once the whole payload has been decoded: if it
+           turns out to be malformed (for example truncated, when the
+           connection of the emitter dropped) none of its datapoints is
+           registered and the decoding error is raised, so that the emitter
+           can send it again without counting them twice.
+           Payloads up to decoding.STREAM_DECODING_THRESHOLD are instead
+           decoded in one go, since it is a lot faster. When the length of
+           the payload isn't known (like for compressed ones), it is read up
+           to the threshold to find out. Payloads bigger than
+           max_payload_size raise decoding.PayloadTooLargeError, registering
+           none of their datapoints.
+        """
+        self.check_queue_capacity()
+        if length is not None and length > self.max_payload_size:
+            raise decoding.PayloadTooLargeError(
+                'The payload is bigger than {} bytes, rejecting it.'
+                .format(self.max_payload_size))
+        read = decoding.limited_reader(read, self.max_payload_size)
+        if length is None or length <= decoding.STREAM_DECODING_THRESHOLD:
+            start = time.monotonic()
+            payload = decoding.read_at_most(read, decoding.STREAM_DECODING_THRESHOLD)
+            self.observe_stage('read', time.monotonic() - start)
+            if len(payload) <= decoding.STREAM_DECODING_THRESHOLD:
+                self.register_payload(payload, encoding)
+                return
+            read = decoding.prefixed_reader(payload, read)
+
+        read_duration = [0.0]
+
+        def timed_read(size):
+            read_start = time.monotonic()
+            chunk = read(size)
+            read_duration[0] += time.monotonic() - read_start
+            return chunk
+
+        start = time.monotonic()
+        batches = []
+        batch = []
+        unsupported_feed = unknown_metric = 0
+        try:
+            for datapoint in decoding.DatapointsStreamDecoder(timed_read, encoding):
+                batch.append(datapoint)
+                if len(batch) >= batch_size:
+                    filtered_batch, batch_unsupported_feed, batch_unknown_metric = \
+                        self.filter_datapoints(batch)
+                    batches.append(filtered_batch)
+                    unsupported_feed += batch_unsupported_feed
+                    unknown_metric += batch_unknown_metric
+                    batch = []
+        except ValueError:
+            self.count_dropped('decode_error')
+            raise
+        if batch:
+            filtered_batch, batch_unsupported_feed, batch_unknown_metric = \
+                self.filter_datapoints(batch)
+            batches.append(filtered_batch)
+            unsupported_feed += batch_unsupported_feed
+            unknown_metric += batch_unknown_metric
+        for filtered_batch in batches:
+            self.enqueue_datapoints(filtered_batch)
+        self.count_filtered(unsupported_feed, unknown_metric)
+        # Reading and decoding are interleaved, the time spent decoding also
+        # includes the filtering of the datapoints.
+        self.observe_stage('read', read_duration[0])
+        self.observe_stage('decode', time.monotonic() - start - read_duration[0])
+
+    def register_datapoint(self, datapoint):
+        self.register_datapoints([datapoint])
+
+    def register_datapoints(self, datapoints):
+        """Filter a batch of datapoints (for example the body of a POST
+           or a Kafka message) and enqueue the supported ones as a single
+           item, to avoid paying the queue's locking overhead for every
+           datapoint.
+        """
+        batch, unsupported_feed, unknown_metric = self.filter_datapoints(datapoints)
+        self.count_filtered(unsupported_feed, unknown_metric)
+        self.enqueue_datapoints(batch)
+
+    def filter_datapoints(self, datapoints):
+        """Return the (metric_plan, datapoint) couples of the supported
+           datapoints of a batch, and the number of the ones dropped because
+           of their feed and of their metric (see count_filtered).
+        """
+        batch = []
+        unsupported_feed = 0
+        unknown_metric = 0
+        for datapoint in datapoints:
+            if (datapoint['feed'] != 'metrics'):
+                log.debug("The following feed does not contain a datapoint, "
+                          "dropping it: {}"
+                          .format(datapoint))
+                unsupported_feed += 1
+                continue
+
+            metric_plan = self.get_metric_plan(datapoint)
+            if metric_plan is None:
+                log.debug("The following datapoint is not supported, either "
+                          "because the daemon name is not listed in the supported "
+                          "ones ({}) or the metric itself is not listed in the "
+                          "exporter's config file: {}"
+                          .format(self.supported_daemons, datapoint))
+                unknown_metric += 1
+                continue
+
+            batch.append((metric_plan, datapoint))
+        return batch, unsupported_feed, unknown_metric
+
+    def count_filtered(self, unsupported_feed, unknown_metric):
+        """Count the datapoints dropped by filter_datapoints."""
+        if unsupported_feed or unknown_metric:
+            with self.stats_lock:
+                self.datapoints_dropped['unsupported_feed'] += unsupported_feed
+                self.datapoints_dropped['unknown_metric'] += unknown_metric
+
+    def enqueue_datapoints(self, batch):
+        """Enqueue a batch of (metric_plan, datapoint) couples returned by
+           filter_datapoints, or route it to the shards owning its series.
+        """
+        if not batch:
             return
+        if self.shard_router is None:
+            self.enqueue_batch(batch)
+        else:
+            self.shard_router.route(batch, self.enqueue_batch)
 
-        self.datapoints_queue.put((daemon, datapoint))
+    def register_routed_datapoints(self, routed_batch):
+        """Enqueue a batch of (family_key, datapoint) couples, already
+           filtered and forwarded by the shard router of another process.
+        """
+        metrics_plan = self.metrics_plan
+        batch = [(metrics_plan[family_key], datapoint)
+                 for family_key, datapoint in routed_batch if family_key in metrics_plan]
+        if len(batch) < len(routed_batch):
+            # The metrics were removed by a config reload in the meantime.
+            self.count_dropped('unknown_metric', len(routed_batch) - len(batch))
+        if batch:
+            self.enqueue_batch(batch)
+
+    def check_queue_capacity(self):
+        """With the 'reject' overflow policy, raise QueueFullError if the
+           queue is full. The check is done before accepting a payload, so
+           that a payload is either processed entirely or not at all (and
+           the emitter can safely send it again).
+        """
+        if self.queue_size is None or self.queue_overflow != 'reject':
+            return
+        with self.queue_not_full:
+            if self.queued_datapoints >= self.queue_size:
+                self.payloads_rejected += 1
+                raise QueueFullError(
+                    'The queue holds {} datapoints, rejecting the payload.'
+                    .format(self.queued_datapoints))
+
+    def wait_for_queue_capacity(self, stop_threads):
+        """Block until the queue is not full (used by the Kafka consumer)."""
+        if self.queue_size is None:
+            return
+        with self.queue_not_full:
+            while (self.queued_datapoints >= self.queue_size and
+                    not stop_threads.is_set()):
+                self.queue_not_full.wait(1)
+
+    def enqueue_batch(self, batch):
+        """Put a batch of (metric_plan, datapoint) couples in the queue,
+           applying the overflow policy if the queue is bounded.
+        """
+        with self.queue_not_full:
+            if self.queue_size is not None and self.queue_overflow == 'sample':
+                room = max(0, self.queue_size - self.queued_datapoints)
+                if len(batch) > room:
+                    sampled_batch = batch[::-(-len(batch) // room)] if room else []
+                    self.datapoints_shed['sample'] += len(batch) - len(sampled_batch)
+                    batch = sampled_batch
+                    if not batch:
+                        return
+
+            self.datapoints_queue.put((time.monotonic(), batch))
+            self.queued_datapoints += len(batch)
+
+            if self.queue_size is not None and self.queue_overflow == 'drop-oldest':
+                while self.queued_datapoints > self.queue_size:
+                    try:
+                        _, oldest_batch = self.datapoints_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.queued_datapoints -= len(oldest_batch)
+                    self.datapoints_shed['drop-oldest'] += len(oldest_batch)
+
+            self.queue_high_watermark = max(
+                self.queue_high_watermark, self.queued_datapoints)
+
+    def dequeue_batch(self):
+        enqueued_at, batch = self.datapoints_queue.get()
+        with self.queue_not_full:
+            self.queued_datapoints -= len(batch)
+            self.queue_not_full.notify_all()
+        if enqueued_at is not None:
+            self.observe_stage('queue_wait', time.monotonic() - enqueued_at)
+        return batch
+
+    def process_datapoints_batch(self, batch):
+        if not batch:
+            return
+        start = time.monotonic()
+        histograms_batch = []
+        hosts = defaultdict(int)
+        with self.storage_lock:
+            for metric_plan, datapoint in batch:
+                hosts[(metric_plan.daemon, datapoint.get('host'))] += 1
+                if metric_plan.retired:
+                    # The config was reloaded after the datapoint was queued.
+                    metric_plan = self.metrics_plan.get(metric_plan.key)
+                    if metric_plan is None:
+                        self.count_dropped('unknown_metric')
+                        continue
+                if metric_plan.type in HISTOGRAM_TYPES:
+                    histograms_batch.append((metric_plan, datapoint))
+                else:
+                    self.store_counter(datapoint, metric_plan)
+            self.store_histograms(histograms_batch)
+
+            for host_key, datapoints in hosts.items():
+                if host_key[1] is not None:
+                    self.host_last_seen[host_key] = start
+                    self.host_datapoints[host_key] += datapoints
+            self.datapoints_registered += len(batch)
+        self.observe_stage('process', time.monotonic() - start)
 
     def process_queued_datapoints(self, stop_threads):
         log.debug('Process datapoints thread starting..')
 
         while True and not stop_threads.isSet():
-            (daemon, datapoint) = self.datapoints_queue.get()
-            metric_name = str(datapoint['metric'])
-            if self.metrics_config[daemon][metric_name]['type'] == 'histogram':
-                self.store_histogram(datapoint)
-            else:
-                self.store_counter(datapoint)
-
-            self.datapoints_registered += 1
+            batch = self.dequeue_batch()
+            self.process_datapoints_batch(batch)
 
         log.debug('Process datapoints thread shutting down..')
 
+    def register_kafka_records(self, records):
+        """Decode the messages returned by a poll of the Kafka consumer,
+           {TopicPartition: [ConsumerRecord, ...]}, and register all their
+           datapoints as a single batch.
+        """
+        datapoints = []
+        for partition_records in records.values():
+            for record in partition_records:
+                if self.skip_unsupported_payload(record.value):
+                    continue
+                try:
+                    datapoints.extend(self.decode_payload(record.value))
+                except ValueError:
+                    log.exception("Failed to decode message from Kafka, skipping..")
+        self.register_datapoints(datapoints)
+
+    def update_kafka_consumer_lag(self, consumer, partitions):
+        """Update the lag of the partitions assigned to the consumer, and
+           return them. The lag of the partitions in the previously assigned
+           ones (but not anymore, after a rebalance) is removed.
+        """
+        assignment = consumer.assignment()
+        lags = {}
+        for partition in assignment:
+            try:
+                highwater = consumer.highwater(partition)
+                if highwater is None:
+                    # Nothing fetched yet, so the lag is not known.
+                    continue
+                lags[(partition.topic, partition.partition)] = max(
+                    0, highwater - consumer.position(partition))
+            except Exception:
+                # The partition might have been revoked in the meantime.
+                log.debug('Failed to get the lag of partition %s', partition)
+        with self.stats_lock:
+            for partition in partitions - assignment:
+                self.kafka_consumer_lag.pop((partition.topic, partition.partition), None)
+            self.kafka_consumer_lag.update(lags)
+        return assignment
+
     def pull_datapoints_from_kafka(self, kafka_config, stop_threads):
         log.debug('Kafka datapoints puller thread starting..')
 
@@ -297,21 +1627,17 @@ class DruidCollector(object):
             kafka_config['topic'],
             group_id=kafka_config['group_id'],
             bootstrap_servers=kafka_config['bootstrap_servers'])
+        max_poll_records = kafka_config.get('max_poll_records', 500)
+        partitions = set()
 
         while True and not stop_threads.isSet():
-            consumer.poll()
-            for message in consumer:
-                try:
-                    json_message = json.loads(message.value.decode())
-                    log.debug('Datapoint from kafka: %s', json_message)
-                    if type(json_message) == list:
-                        for datapoint in json_message:
-                            self.register_datapoint(datapoint)
-                    else:
-                        self.register_datapoint(json_message)
-                except json.JSONDecodeError:
-                    log.exception("Failed to decode message from Kafka, skipping..")
-                except Exception as e:
-                    log.exception("Generic exception while pulling datapoints from Kafka")
+            self.wait_for_queue_capacity(stop_threads)
+            try:
+                records = consumer.poll(timeout_ms=1000, max_records=max_poll_records)
+                self.register_kafka_records(records)
+                partitions = self.update_kafka_consumer_lag(consumer, partitions)
+            except Exception as e:
+                log.exception("Generic exception while pulling datapoints from Kafka")
 
+        consumer.close()
         log.debug('Kafka datapoints puller thread shutting down..')
@@ -0,0 +1,151 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content encodings of the HTTP bodies: decompression of the payloads
+   POSTed by the Druid emitters, and compression of the /metrics output.
+
+   Both gzip and zstd streams can be made of multiple independent members
+   (frames), decompressed as the concatenation of their contents, so every
+   metric family can be compressed once and its compressed form reused by
+   the following scrapes until the family changes.
+"""
+
+import zlib
+
+from druid_exporter import decoding
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+class DecompressionError(ValueError):
+    """Raised when a compressed payload is malformed."""
+
+
+class UnsupportedEncodingError(ValueError):
+    """Raised when the content encoding of a payload is not supported."""
+
+
+def supported_encodings():
+    """Return the content encodings supported, in order of preference."""
+    if zstandard is not None:
+        return ('zstd', 'gzip')
+    return ('gzip',)
+
+
+def negotiate_encoding(accept_encoding):
+    """Return the content encoding to use for a response given the
+       Accept-Encoding header of the request, or None for no compression.
+    """
+    accepted = {}
+    for coding in (accept_encoding or '').split(','):
+        name, _, parameters = coding.partition(';')
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            key, _, value = parameter.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in supported_encodings():
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data, content_encoding):
+    """Compress data as a single gzip member or zstd frame (data is returned
+       as it is if content_encoding is None).
+    """
+    if content_encoding is None:
+        return data
+    if content_encoding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if content_encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError('Unsupported content encoding {}'.format(content_encoding))
+
+
+class GzipReader(object):
+    """Incremental decompression of a gzip (or zlib) stream, possibly made
+       of multiple members. The output of every read is bounded by its
+       size, so a small malicious payload can't expand all at once.
+    """
+
+    def __init__(self, read):
+        self.read_compressed = read
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.input = b''
+
+    def read(self, size):
+        while True:
+            if not self.input:
+                self.input = self.read_compressed(decoding.CHUNK_SIZE)
+                if not self.input:
+                    if not self.decompressor.eof:
+                        raise DecompressionError('Truncated compressed payload')
+                    return b''
+            if self.decompressor.eof:
+                # Another member follows the previous one.
+                self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            chunk = self.decompressor.decompress(self.input, size)
+            self.input = self.decompressor.unconsumed_tail or self.decompressor.unused_data
+            if chunk:
+                return chunk
+
+
+class ReadFunctionFile(object):
+    """File-like wrapper of a read(size) function."""
+
+    def __init__(self, read):
+        self.read = read
+
+
+def decompressing_reader(read, content_encoding):
+    """Return a read(size) function returning the decompressed content of
+       the read(size) function, decompressing it incrementally, or read
+       itself if the content isn't encoded. Raise UnsupportedEncodingError if
+       the content encoding isn't supported, and DecompressionError while
+       reading if the content is malformed.
+    """
+    content_encoding = (content_encoding or 'identity').strip().lower()
+    if content_encoding == 'identity':
+        return read
+    if content_encoding in ('gzip', 'x-gzip', 'deflate'):
+        reader = GzipReader(read)
+        errors = (zlib.error,)
+    elif content_encoding == 'zstd' and zstandard is not None:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            ReadFunctionFile(read), read_size=decoding.CHUNK_SIZE, read_across_frames=True)
+        errors = (zstandard.ZstdError,)
+    else:
+        raise UnsupportedEncodingError(
+            'Unsupported content encoding {}'.format(content_encoding))
+
+    def decompressed_read(size):
+        try:
+            return reader.read(size)
+        except errors as e:
+            raise DecompressionError('Malformed compressed payload: {}'.format(e))
+    return decompressed_read
@@ -0,0 +1,306 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import codecs
+import importlib
+import json
+import logging
+import re
+
+
+log = logging.getLogger(__name__)
+
+
+# Size of the chunks read from the input stream.
+CHUNK_SIZE = 64 * 1024
+
+# Payloads up to this size are read entirely and decoded in one go (with
+# the active JSON backend), the bigger ones are decoded incrementally (with
+# the stdlib decoder) to avoid holding both the whole input and its decoded
+# datapoints in memory.
+STREAM_DECODING_THRESHOLD = 1024 * 1024
+
+# Default maximum size of a payload (after decompression). The datapoints
+# of a payload are registered only once it has been entirely decoded, so
+# they are held in memory until then (see DruidCollector.register_stream).
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+# A single datapoint bigger than this is considered malformed, to avoid
+# reading (and re-parsing) the whole input stream to find that out.
+MAX_DATAPOINT_SIZE = 1024 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Characters that could continue a JSON number (or literal) parsed at the
+# end of the buffer, for example "1." followed by "5" in the next chunk.
+VALUE_CONTINUATION = re.compile(r'[0-9a-zA-Z.+-]*\Z')
+
+
+# The value of the "feed" field of the datapoints (as opposed to alerts).
+FEED_METRICS = re.compile(rb'"feed"[ \t\n\r]*:[ \t\n\r]*"metrics"')
+
+# JSON libraries that can be used to decode payloads, in order of
+# preference. All of them accept bytes (UTF-8) and raise ValueError
+# subclasses on malformed input.
+JSON_BACKENDS = ('orjson', 'ujson', 'rapidjson', 'json')
+
+
+class PayloadTooLargeError(Exception):
+    """Raised when a payload is bigger than the maximum size allowed."""
+
+
+def get_json_backend(name='auto'):
+    """Return the (name, loads function) of the JSON backend requested,
+       or of the first available one if name is 'auto'.
+    """
+    if name == 'auto':
+        candidates = JSON_BACKENDS
+    elif name in JSON_BACKENDS:
+        candidates = (name,)
+    else:
+        raise RuntimeError('Unknown JSON backend {}, please use one of {}.'
+                           .format(name, JSON_BACKENDS))
+    for candidate in candidates:
+        try:
+            module = importlib.import_module(candidate)
+        except ImportError:
+            continue
+        return candidate, module.loads
+    raise RuntimeError('The JSON backend {} is not available, please install it.'
+                       .format(name))
+
+
+json_backend, json_loads = get_json_backend()
+
+
+def set_json_backend(name):
+    global json_backend, json_loads
+    json_backend, json_loads = get_json_backend(name)
+    log.info('Using the %s JSON backend', json_backend)
+
+
+def loads(payload, encoding='utf-8'):
+    """Decode a JSON payload (bytes) with the active JSON backend."""
+    if codecs.lookup(encoding).name != 'utf-8':
+        payload = payload.decode(encoding)
+    return json_loads(payload)
+
+
+def read_all(read):
+    """Read everything from the read(size) function."""
+    chunks = []
+    chunk = read(CHUNK_SIZE)
+    while chunk:
+        chunks.append(chunk)
+        chunk = read(CHUNK_SIZE)
+    return b''.join(chunks)
+
+
+def read_at_most(read, limit):
+    """Read from the read(size) function until the end of the input, or
+       until more than limit bytes are read (returning limit + 1 bytes).
+    """
+    chunks = []
+    size = 0
+    while size <= limit:
+        chunk = read(min(CHUNK_SIZE, limit + 1 - size))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return b''.join(chunks)
+
+
+def prefixed_reader(prefix, read):
+    """Return a read(size) function returning prefix, and then what the
+       read(size) function returns.
+    """
+    offset = [0]
+
+    def prefixed_read(size):
+        if offset[0] < len(prefix):
+            chunk = prefix[offset[0]:offset[0] + size]
+            offset[0] += len(chunk)
+            return chunk
+        return read(size)
+    return prefixed_read
+
+
+def bounded_reader(stream, length):
+    """Return a read(size) function that doesn't read more than length bytes
+       from the stream (like the CONTENT_LENGTH of a WSGI request).
+    """
+    remaining = [length]
+
+    def read(size):
+        size = min(size, remaining[0])
+        if size <= 0:
+            return b''
+        chunk = stream.read(size)
+        remaining[0] -= len(chunk)
+        return chunk
+    return read
+
+
+def limited_reader(read, limit):
+    """Return a read(size) function reading from the read(size) function,
+       that raises PayloadTooLargeError once more than limit bytes are read.
+    """
+    size = [0]
+
+    def limited_read(chunk_size):
+        chunk = read(chunk_size)
+        size[0] += len(chunk)
+        if size[0] > limit:
+            raise PayloadTooLargeError(
+                'The payload is bigger than {} bytes, rejecting it.'.format(limit))
+        return chunk
+    return limited_read
+
+
+class DatapointsStreamDecoder(object):
+    """Incrementally decode a JSON array of datapoints (or a single JSON
+       datapoint) read in chunks, yielding the datapoints as soon as they
+       are parsed. The memory used is bounded by the chunk size (and the
+       size of the datapoints) rather than by the size of the whole input.
+
+       The input is decoded with an incremental decoder chunk by chunk,
+       so a multi-byte character split between two chunks is handled
+       correctly, without a copy of the whole input as str.
+    """
+
+    def __init__(self, read, encoding='utf-8', chunk_size=CHUNK_SIZE):
+        self.read = read
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder(encoding)()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Append a new chunk to the buffer, discarding its consumed part.
+           Return False if the input stream was already exhausted.
+        """
+        if self.eof:
+            return False
+        chunk = self.read(self.chunk_size)
+        if chunk:
+            text = self.text_decoder.decode(chunk)
+        else:
+            self.eof = True
+            text = self.text_decoder.decode(b'', final=True)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip the whitespace and return the next character, or an empty
+           string at the end of the input.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value might be truncated at the end of the buffer.
+                if (len(self.buffer) - self.pos < MAX_DATAPOINT_SIZE and
+                        self.fill()):
+                    continue
+                raise
+            # A number (or a literal) ending with the buffer might continue
+            # in the next chunk.
+            if (not self.eof and VALUE_CONTINUATION.match(self.buffer, end) and
+                    self.fill()):
+                continue
+            self.pos = end
+            return value
+
+    def expect_end(self):
+        if self.peek() != '':
+            raise json.JSONDecodeError('Extra data', self.buffer, self.pos)
+
+    def __iter__(self):
+        char = self.peek()
+        if char != '[':
+            # A single datapoint, not wrapped in a list.
+            yield self.decode_value()
+            self.expect_end()
+            return
+
+        self.pos += 1
+        if self.peek() == ']':
+            self.pos += 1
+        else:
+            while True:
+                yield self.decode_value()
+                char = self.peek()
+                self.pos += 1
+                if char == ']':
+                    break
+                if char != ',':
+                    raise json.JSONDecodeError(
+                        'Expecting \',\' delimiter', self.buffer, self.pos - 1)
+        self.expect_end()
+
+
+class PayloadFilter(object):
+    """Find out from the raw bytes of a payload, without decoding it, if it
+       holds only datapoints that would be dropped anyway, because their
+       metric is not in the config (like the payloads of daemons emitting
+       only unsupported metrics, or most of the Kafka messages, every one
+       holding a single datapoint) or they are not metrics (alerts).
+
+       A single regex search looks for a "metric" field with the name of
+       one of the configured metrics, stopping at the first one found, so
+       the payloads holding supported datapoints are decoded as usual with
+       a small overhead. The check is conservative: a payload is dropped
+       only if no metric field holds a supported name, and none of them
+       holds escaped characters (that could hide one).
+    """
+
+    def __init__(self, metric_names):
+        names = b'|'.join(re.escape(name.encode('utf-8')) for name in sorted(metric_names))
+        self.supported_metric = re.compile(
+            rb'"metric"[ \t\n\r]*:[ \t\n\r]*"(?:(?:' + (names or rb'(?!)') +
+            rb')"|[^"\\]*\\)')
+
+    def dropped_datapoints(self, payload, encoding='utf-8'):
+        """Return None if the payload might hold datapoints of the configured
+           metrics (or if it's not possible to tell without decoding it),
+           otherwise the numbers of (unsupported_feed, unknown_metric)
+           datapoints it holds, all of them to be dropped.
+        """
+        if encoding != 'utf-8' and codecs.lookup(encoding).name != 'utf-8':
+            return None
+        # A truncated payload is decoded, to report the error.
+        if (payload[:64].lstrip()[:1] + payload[-64:].rstrip()[-1:]) not in (b'[]', b'{}'):
+            return None
+        if self.supported_metric.search(payload):
+            return None
+        datapoints = payload.count(b'"feed"')
+        if not datapoints:
+            return None
+        metrics_feed = payload.count(b'"feed":"metrics"')
+        if metrics_feed < datapoints:
+            metrics_feed = len(FEED_METRICS.findall(payload))
+        return datapoints - metrics_feed, metrics_feed
@@ -17,19 +17,23 @@
 import argparse
 import json
 import logging
+import os
+import signal
 import sys
+import threading
 
-from druid_exporter import collector
-from prometheus_client import generate_latest, make_wsgi_app, REGISTRY
-from gevent.pywsgi import WSGIServer
+from druid_exporter import aioserver, collector, sharding, snapshots
+from druid_exporter import compression, decoding, histograms, protobuf, relabel
+from druid_exporter.decoding import bounded_reader
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest, REGISTRY
 
 log = logging.getLogger(__name__)
 
 
 class DruidWSGIApp(object):
 
-    def __init__(self, post_uri, druid_collector, prometheus_app, encoding):
-        self.prometheus_app = prometheus_app
+    def __init__(self, post_uri, druid_collector, registry, encoding):
+        self.registry = registry
         self.druid_collector = druid_collector
         self.post_uri = post_uri
         self.encoding = encoding
@@ -37,27 +41,64 @@ class DruidWSGIApp(object):
     def __call__(self, environ, start_response):
         if (environ['REQUEST_METHOD'] == 'GET' and
                 environ['PATH_INFO'] == '/metrics'):
-            return self.prometheus_app(environ, start_response)
+            # The Druid metrics are rendered by the collector itself (that
+            # caches the text of the metric families not changed since the
+            # last scrape), the rest comes from the registry (process
+            # metrics, scrape duration, etc..).
+            # The protobuf format is used if the scraper supports it, since
+            # it is the only one carrying native histograms.
+            # The output is compressed if the scraper supports it, as a
+            # sequence of gzip members (or zstd frames) that lets the
+            # collector reuse the compressed families not changed.
+            content_encoding = compression.negotiate_encoding(
+                environ.get('HTTP_ACCEPT_ENCODING'))
+            use_protobuf = protobuf.accepts_protobuf(environ.get('HTTP_ACCEPT'))
+            if use_protobuf:
+                registry_output = protobuf.generate_latest(self.registry)
+                content_type = protobuf.CONTENT_TYPE
+            else:
+                registry_output = generate_latest(self.registry)
+                content_type = CONTENT_TYPE_LATEST
+            output = (self.druid_collector.generate_latest(use_protobuf, content_encoding) +
+                      compression.compress(registry_output, content_encoding))
+            headers = [('Content-Type', content_type), ('Vary', 'Accept-Encoding')]
+            if content_encoding is not None:
+                headers.append(('Content-Encoding', content_encoding))
+            start_response('200 OK', headers)
+            return [output]
         elif (environ['REQUEST_METHOD'] == 'POST' and
                 environ['PATH_INFO'] == self.post_uri and
                 environ['CONTENT_TYPE'] == 'application/json'):
             try:
-                request_body_size = int(environ.get('CONTENT_LENGTH', 0))
-                request_body = environ['wsgi.input'].read(request_body_size)
-                datapoints = json.loads(request_body.decode(self.encoding))
+                request_body_size = int(environ.get('CONTENT_LENGTH') or 0)
                 # The HTTP metrics emitter can batch datapoints and send them to
                 # a specific endpoint stated in the logs (this tool).
-                for datapoint in datapoints:
-                    log.debug("Processing datapoint: {}".format(datapoint))
-                    self.druid_collector.register_datapoint(datapoint)
+                # Batches can be several megabytes, so they are decoded
+                # incrementally while being read (and decompressed, if the
+                # emitter compressed them).
+                read = bounded_reader(environ['wsgi.input'], request_body_size)
+                content_encoding = environ.get('HTTP_CONTENT_ENCODING')
+                if content_encoding:
+                    read = compression.decompressing_reader(read, content_encoding)
+                    request_body_size = None
+                self.druid_collector.register_stream(read, self.encoding, request_body_size)
                 status = '200 OK'
+            except collector.QueueFullError as e:
+                log.warning('Rejecting POST data: {}'.format(e))
+                status = '503 Service Unavailable'
+            except decoding.PayloadTooLargeError as e:
+                log.warning('Rejecting POST data: {}'.format(e))
+                status = '413 Payload Too Large'
+            except compression.UnsupportedEncodingError as e:
+                log.warning('Rejecting POST data: {}'.format(e))
+                status = '415 Unsupported Media Type'
             except Exception as e:
                 log.exception('Error while processing the following POST data')
                 status = '400 Bad Request'
         else:
             status = '400 Bad Request'
         start_response(status, [])
-        return ''
+        return []
 
 
 def check_metrics_config_file_consistency(json_config):
@@ -69,7 +110,8 @@ def check_metrics_config_file_consistency(json_config):
     required_config_fields = [
         'prometheus_metric_name', 'labels', 'type', 'description'
     ]
-    allowed_metric_types = ['histogram', 'counter', 'gauge']
+    allowed_metric_types = ['histogram', 'exponential_histogram', 'summary', 'counter', 'gauge']
+    allowed_overflow_policies = ['drop', 'fold']
     for daemon in json_config.keys():
         if daemon not in druid_daemon_names:
             raise RuntimeError(
@@ -89,7 +131,94 @@ def check_metrics_config_file_consistency(json_config):
                     'Config error: metric {} for daemon {} has type {}, '
                     'that is not supported. Please use one of {}.'
                     .format(druid_metric_name, daemon,
-                            metric_metadata['type'], allowed_metric_type))
+                            metric_metadata['type'], allowed_metric_types))
+            if 'ttl' in metric_metadata and (
+                    type(metric_metadata['ttl']) not in (int, float) or
+                    metric_metadata['ttl'] <= 0):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has ttl {}, '
+                    'but it should be a positive number of seconds.'
+                    .format(druid_metric_name, daemon, metric_metadata['ttl']))
+            if 'max_series' in metric_metadata and (
+                    type(metric_metadata['max_series']) != int or
+                    metric_metadata['max_series'] <= 0):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has max_series {}, '
+                    'but it should be a positive integer.'
+                    .format(druid_metric_name, daemon, metric_metadata['max_series']))
+            if metric_metadata.get('overflow', 'drop') not in allowed_overflow_policies:
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has overflow {}, '
+                    'that is not supported. Please use one of {}.'
+                    .format(druid_metric_name, daemon,
+                            metric_metadata['overflow'], allowed_overflow_policies))
+            if 'schema' in metric_metadata and (
+                    type(metric_metadata['schema']) != int or
+                    not histograms.MIN_SCHEMA <= metric_metadata['schema'] <= histograms.MAX_SCHEMA):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has schema {}, '
+                    'but it should be an integer between {} and {}.'
+                    .format(druid_metric_name, daemon, metric_metadata['schema'],
+                            histograms.MIN_SCHEMA, histograms.MAX_SCHEMA))
+            if 'zero_threshold' in metric_metadata and (
+                    type(metric_metadata['zero_threshold']) not in (int, float) or
+                    metric_metadata['zero_threshold'] < 0):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has zero_threshold {}, '
+                    'but it should be a non negative number.'
+                    .format(druid_metric_name, daemon, metric_metadata['zero_threshold']))
+            if 'max_buckets' in metric_metadata and (
+                    type(metric_metadata['max_buckets']) != int or
+                    metric_metadata['max_buckets'] <= 0):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has max_buckets {}, '
+                    'but it should be a positive integer.'
+                    .format(druid_metric_name, daemon, metric_metadata['max_buckets']))
+            if 'quantiles' in metric_metadata and (
+                    type(metric_metadata['quantiles']) != list or
+                    not metric_metadata['quantiles'] or
+                    any(type(quantile) not in (int, float) or not 0 <= quantile <= 1
+                        for quantile in metric_metadata['quantiles'])):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has quantiles {}, '
+                    'but they should be a list of numbers between 0 and 1.'
+                    .format(druid_metric_name, daemon, metric_metadata['quantiles']))
+            if 'relative_accuracy' in metric_metadata and (
+                    type(metric_metadata['relative_accuracy']) not in (int, float) or
+                    not 0 < metric_metadata['relative_accuracy'] < 1):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has relative_accuracy {}, '
+                    'but it should be a number between 0 and 1 (excluded).'
+                    .format(druid_metric_name, daemon, metric_metadata['relative_accuracy']))
+            if 'max_age' in metric_metadata and (
+                    type(metric_metadata['max_age']) not in (int, float) or
+                    metric_metadata['max_age'] <= 0):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has max_age {}, '
+                    'but it should be a positive number of seconds.'
+                    .format(druid_metric_name, daemon, metric_metadata['max_age']))
+            if 'age_buckets' in metric_metadata and (
+                    type(metric_metadata['age_buckets']) != int or
+                    metric_metadata['age_buckets'] <= 0):
+                raise RuntimeError(
+                    'Config error: metric {} for daemon {} has age_buckets {}, '
+                    'but it should be a positive integer.'
+                    .format(druid_metric_name, daemon, metric_metadata['age_buckets']))
+            if 'relabel' in metric_metadata:
+                try:
+                    relabel.check_relabel_rules(
+                        metric_metadata['labels'], metric_metadata['relabel'])
+                except ValueError as e:
+                    raise RuntimeError(
+                        'Config error: metric {} for daemon {} has an invalid '
+                        'relabel config: {}.'.format(druid_metric_name, daemon, e))
+                if (relabel.merged_aggregation(metric_metadata) == 'sum' and
+                        'ttl' not in metric_metadata):
+                    raise RuntimeError(
+                        'Config error: metric {} for daemon {} sums the series merged '
+                        'by its labeldrop rules, but it has no ttl to expire their '
+                        'values. Please add it to the config, or use the "last" '
+                        'aggregation.'.format(druid_metric_name, daemon))
             if metric_metadata['type'] == 'histogram' and \
                     'buckets' not in metric_metadata.keys():
                 raise RuntimeError(
@@ -110,6 +239,45 @@ def parse_metrics_config_file(path):
         return parsed_json
 
 
+def reload_metrics_config_file(path, druid_collector):
+    """Parse and validate the metrics config file again, and replace the
+       config of the collector with it. If the new config is not valid the
+       collector keeps the current one. Return True if the config was reloaded.
+    """
+    log.info('Reloading metrics configuration from {}'.format(path))
+    try:
+        metrics_config = parse_metrics_config_file(path)
+        check_metrics_config_file_consistency(metrics_config)
+    except (OSError, RuntimeError) as e:
+        log.error('Not reloading the metrics config file {}: {}'.format(path, e))
+        return False
+    druid_collector.reload_metrics_config(metrics_config)
+    return True
+
+
+def config_file_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def watch_metrics_config_file(path, druid_collector, reload_requested, interval=None):
+    """Reload the metrics config file when reload_requested is set (on
+       SIGHUP), and every interval seconds (if given) when its modification
+       time changes.
+    """
+    log.debug('Metrics config watcher thread starting..')
+    last_mtime = config_file_mtime(path)
+    while True:
+        requested = reload_requested.wait(interval)
+        reload_requested.clear()
+        mtime = config_file_mtime(path)
+        if requested or mtime != last_mtime:
+            last_mtime = mtime
+            reload_metrics_config_file(path, druid_collector)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('config_file',
@@ -122,6 +290,64 @@ def main():
                         help='Enable debug logging')
     parser.add_argument('-e', '--encoding', default='utf-8',
                         help='Encoding of the Druid POST JSON data.')
+    parser.add_argument('-j', '--json-backend', default='auto',
+                        choices=('auto',) + decoding.JSON_BACKENDS,
+                        help='JSON library used to decode datapoints, by default the '
+                             'fastest one available (orjson, ujson, rapidjson, json).')
+    parser.add_argument('--scrape-cache-max-staleness', type=float, default=0,
+                        metavar='SECONDS',
+                        help='Re-render a metric modified since the last scrape at most '
+                             'once every SECONDS, serving the cached version in the '
+                             'meantime (default: 0, always up to date).')
+    parser.add_argument('--series-ttl', type=float, metavar='SECONDS',
+                        help='Stop exporting series not updated for more than SECONDS. '
+                             'It can be overridden by the "ttl" field of each metric in '
+                             'the config file (default: series never expire).')
+    parser.add_argument('--host-liveness-window', type=float, metavar='SECONDS',
+                        help='Drop all the series last updated by a Druid daemon (host) '
+                             'that didn\'t emit any datapoint for more than SECONDS, for '
+                             'example a coordinator or overlord that lost the leadership '
+                             '(default: series are never dropped).')
+    parser.add_argument('--max-series', type=int, metavar='N',
+                        help='Maximum number of series stored by the exporter, the '
+                             'datapoints that would create more are dropped or folded '
+                             'following the "overflow" field of their metric config '
+                             '(default: unlimited).')
+    parser.add_argument('-q', '--queue-size', type=int, metavar='N',
+                        help='Maximum number of datapoints waiting to be processed '
+                             '(default: unlimited).')
+    parser.add_argument('--queue-overflow', default='reject',
+                        choices=('reject', 'drop-oldest', 'sample'),
+                        help='What to do when the queue is full: reject the POSTs '
+                             '(with a 503, Druid will retry them), drop the oldest '
+                             'datapoints or keep only a sample of the new ones '
+                             '(default: reject).')
+    parser.add_argument('--max-payload-size', type=int, default=decoding.MAX_PAYLOAD_SIZE,
+                        metavar='BYTES',
+                        help='Maximum size of a POST body (once decompressed), the '
+                             'bigger ones are refused with a 413 (default: 16MiB).')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes decoding and storing datapoints, '
+                             'each one holding a shard of the series (default: 1).')
+    parser.add_argument('-s', '--server', default='gevent', choices=('gevent', 'asyncio'),
+                        help='HTTP server implementation: gevent\'s WSGIServer, or a '
+                             'server based on asyncio (not requiring gevent) supporting '
+                             'keep-alive connections and pipelining (default: gevent).')
+    parser.add_argument('--max-connections', type=int,
+                        default=aioserver.DEFAULT_MAX_CONNECTIONS, metavar='N',
+                        help='Maximum number of HTTP connections served at the same time '
+                             'by the asyncio server, the others are refused with a 503 '
+                             '(default: 1024).')
+    parser.add_argument('--config-reload-interval', type=float, metavar='SECONDS',
+                        help='Check every SECONDS if the config file was modified, and '
+                             'reload it if so. The config file is also reloaded on '
+                             'SIGHUP (default: reload only on SIGHUP).')
+    parser.add_argument('--snapshot-file', metavar='PATH',
+                        help='Save the series stored by the exporter to PATH periodically '
+                             '(and when terminated), and restore them at startup '
+                             '(default: the series are not persisted).')
+    parser.add_argument('--snapshot-interval', type=float, default=60, metavar='SECONDS',
+                        help='Save a snapshot of the series every SECONDS (default: 60).')
     kafka_parser = parser.add_argument_group('kafka',
                                              'Optional configuration for datapoints emitted '
                                              'to a topic via the Druid Kafka Emitter extension.')
@@ -131,6 +357,14 @@ def main():
                               help='Pull datapoints from a given list of Kafka brokers.')
     kafka_parser.add_argument('-g', '--kafka-consumer-group-id',
                               help='Pull datapoints from Kafka using this Consumer group id.')
+    kafka_parser.add_argument('--kafka-consumers', type=int, default=1,
+                              help='Number of consumer threads pulling datapoints (in every '
+                                   'worker process), to consume multiple partitions of the '
+                                   'topic in parallel (default: 1).')
+    kafka_parser.add_argument('--kafka-max-poll-records', type=int, default=500,
+                              help='Maximum number of messages returned by every poll of '
+                                   'a consumer, and registered as a single batch '
+                                   '(default: 500).')
 
     args = parser.parse_args()
 
@@ -154,12 +388,16 @@ def main():
             kafka_config['topic'] = args.kafka_topic
             kafka_config['bootstrap_servers'] = args.kafka_bootstrap_servers
             kafka_config['group_id'] = args.kafka_consumer_group_id
+            kafka_config['consumers'] = args.kafka_consumers
+            kafka_config['max_poll_records'] = args.kafka_max_poll_records
             log.info('Using Kafka config: {}'.format(kafka_config))
     else:
         kafka_config = None
 
     collect_metrics_from = []
 
+    decoding.set_json_backend(args.json_backend)
+
     address, port = args.listen.split(':', 1)
     log.info('Starting druid_exporter on %s:%s', address, port)
     log.info('Reading metrics configuration from {}'.format(args.config_file))
@@ -172,15 +410,79 @@ def main():
     log.info('Checking consistency of metrics config file..')
     check_metrics_config_file_consistency(metrics_config)
 
-    druid_collector = collector.DruidCollector(
-        metrics_config, kafka_config)
-    REGISTRY.register(druid_collector)
-    prometheus_app = make_wsgi_app()
+    if args.snapshot_file and args.workers > 1:
+        parser.error('--snapshot-file is not supported with multiple workers.')
+    if args.queue_size is not None and args.queue_overflow == 'reject' and args.workers > 1:
+        # The POSTs are answered before a worker finds out that its queue
+        # is full, so the payloads could only be dropped without a 503.
+        parser.error('--queue-overflow reject is not supported with multiple workers, '
+                     'please use drop-oldest or sample.')
+
+    collector_kwargs = {
+        'scrape_cache_max_staleness': args.scrape_cache_max_staleness,
+        'series_ttl': args.series_ttl,
+        'max_series': args.max_series,
+        'host_liveness_window': args.host_liveness_window,
+        'queue_size': args.queue_size,
+        'queue_overflow': args.queue_overflow,
+        'max_payload_size': args.max_payload_size,
+    }
+    if args.workers > 1:
+        log.info('Starting {} worker processes'.format(args.workers))
+        druid_collector = sharding.ShardedCollector(
+            metrics_config, args.workers, kafka_config, **collector_kwargs)
+    elif args.snapshot_file:
+        # The series are restored before serving and before starting the
+        # Kafka consumers, while the processing thread has no datapoints to
+        # store yet (restoring a metric family replaces its series).
+        druid_collector = collector.DruidCollector(metrics_config, **collector_kwargs)
+        if os.path.exists(args.snapshot_file):
+            try:
+                snapshots.load_snapshot(druid_collector, args.snapshot_file)
+            except (OSError, snapshots.SnapshotError) as e:
+                log.error('Failed to load the snapshot, starting from scratch: {}'.format(e))
+        if kafka_config:
+            druid_collector.start_kafka_consumers(kafka_config)
+
+        # The SIGTERM handler runs in the main thread, that serves HTTP and
+        # might be interrupted while holding the storage lock (during a
+        # scrape): the last snapshot is saved by the snapshot thread, that
+        # then terminates the process.
+        terminate_requested = threading.Event()
+
+        def save_snapshots_until_terminated():
+            snapshots.save_snapshots(druid_collector, args.snapshot_file,
+                                     args.snapshot_interval, terminate_requested)
+            druid_collector.stop_running_threads()
+            logging.shutdown()
+            os._exit(0)
+        threading.Thread(target=save_snapshots_until_terminated, daemon=True).start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: terminate_requested.set())
+    else:
+        druid_collector = collector.DruidCollector(
+            metrics_config, kafka_config, **collector_kwargs)
+
     druid_wsgi_app = DruidWSGIApp(args.uri, druid_collector,
-                                  prometheus_app, args.encoding)
+                                  REGISTRY, args.encoding)
+
+    # The metrics config file is reloaded by a dedicated thread, without
+    # pausing the ingestion of datapoints.
+    reload_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+    threading.Thread(
+        target=watch_metrics_config_file,
+        args=(args.config_file, druid_collector, reload_requested,
+              args.config_reload_interval),
+        daemon=True).start()
 
-    httpd = WSGIServer(listener=(address, int(port)), application=druid_wsgi_app, log=log)
-    httpd.serve_forever()
+    if args.server == 'asyncio':
+        httpd = aioserver.AsyncHTTPServer(druid_wsgi_app, max_connections=args.max_connections)
+        httpd.serve_forever(address, int(port))
+    else:
+        # Imported only when used, the asyncio server doesn't need gevent.
+        from gevent.pywsgi import WSGIServer
+        httpd = WSGIServer(listener=(address, int(port)), application=druid_wsgi_app, log=log)
+        httpd.serve_forever()
 
 
 if __name__ == "__main__":
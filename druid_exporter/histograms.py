@@ -0,0 +1,184 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import math
+
+from prometheus_client.core import HistogramMetricFamily
+from prometheus_client.utils import floatToGoString
+
+
+# Resolution limits of the Prometheus native histograms: the boundaries of
+# the buckets are powers of 2 ** (2 ** -schema).
+MIN_SCHEMA = -4
+MAX_SCHEMA = 8
+
+DEFAULT_SCHEMA = 3
+# Same default of the Prometheus client libraries (2 ** -128).
+DEFAULT_ZERO_THRESHOLD = 2.938735877055719e-39
+DEFAULT_MAX_BUCKETS = 160
+
+# For every positive schema, the boundaries of its buckets within [0.5, 1),
+# used to find the bucket of a value from the mantissa of its frexp().
+_MANTISSA_BOUNDS = {
+    schema: [2 ** (index / 2 ** schema - 1) for index in range(2 ** schema)]
+    for schema in range(1, MAX_SCHEMA + 1)}
+
+
+def bucket_index(value, schema):
+    """Return the index of the bucket of a (finite, positive) value, that is
+       the bucket with boundaries (base ** (index - 1), base ** index] where
+       base is 2 ** (2 ** -schema). Same algorithm of the Go client library,
+       to be exact for the powers of the base.
+    """
+    mantissa, exponent = math.frexp(value)
+    if schema > 0:
+        bounds = _MANTISSA_BOUNDS[schema]
+        return bisect.bisect_left(bounds, mantissa) + (exponent - 1) * len(bounds)
+    index = exponent
+    if mantissa == 0.5:
+        index -= 1
+    offset = (1 << -schema) - 1
+    return (index + offset) >> -schema
+
+
+def bucket_upper_bound(index, schema):
+    return 2.0 ** (index * 2.0 ** -schema)
+
+
+class ExponentialHistogram(object):
+    """Histogram with exponential buckets, like the Prometheus native
+       histograms: only the populated buckets are stored (as a dict of
+       bucket index -> count), and the resolution doesn't depend on a list
+       of buckets configured upfront.
+
+       When the populated buckets exceed max_buckets, the resolution is
+       halved (merging adjacent buckets) until they fit, down to MIN_SCHEMA.
+    """
+    __slots__ = ('schema', 'zero_threshold', 'max_buckets', 'zero_count',
+                 'positive', 'negative', 'count', 'sum')
+
+    def __init__(self, schema=DEFAULT_SCHEMA, zero_threshold=DEFAULT_ZERO_THRESHOLD,
+                 max_buckets=DEFAULT_MAX_BUCKETS):
+        self.schema = schema
+        self.zero_threshold = zero_threshold
+        self.max_buckets = max_buckets
+        self.zero_count = 0
+        self.positive = {}
+        self.negative = {}
+        self.count = 0
+        self.sum = 0.0
+
+    def copy(self):
+        histogram = ExponentialHistogram(self.schema, self.zero_threshold, self.max_buckets)
+        histogram.zero_count = self.zero_count
+        histogram.positive = dict(self.positive)
+        histogram.negative = dict(self.negative)
+        histogram.count = self.count
+        histogram.sum = self.sum
+        return histogram
+
+    __copy__ = copy
+
+    def observe(self, values):
+        """Add a list of samples to the histogram."""
+        schema = self.schema
+        for value in values:
+            if abs(value) <= self.zero_threshold:
+                self.zero_count += 1
+            elif not math.isinf(value) and value == value:
+                # NaN and infinite values are only counted (and summed).
+                buckets = self.positive if value > 0 else self.negative
+                index = bucket_index(abs(value), schema)
+                buckets[index] = buckets.get(index, 0) + 1
+        self.count += len(values)
+        self.sum += sum(values)
+
+        while (len(self.positive) + len(self.negative) > self.max_buckets and
+                self.schema > MIN_SCHEMA):
+            self.reduce_resolution()
+
+    def reduce_resolution(self):
+        """Halve the resolution, merging every couple of adjacent buckets."""
+        self.schema -= 1
+        for attribute in ('positive', 'negative'):
+            buckets = {}
+            for index, count in getattr(self, attribute).items():
+                # The bucket (base ** (index - 1), base ** index] is included
+                # in the bucket ceil(index / 2) of the new schema.
+                index = (index + 1) >> 1
+                buckets[index] = buckets.get(index, 0) + count
+            setattr(self, attribute, buckets)
+
+    def classic_buckets(self):
+        """Return the cumulative [upper_bound, count] buckets of the classic
+           histogram equivalent to this one, with only the populated ones.
+        """
+        buckets = []
+        count = 0
+        for index in sorted(self.negative, reverse=True):
+            count += self.negative[index]
+            buckets.append(
+                [floatToGoString(-bucket_upper_bound(index - 1, self.schema)), count])
+        if self.zero_count:
+            count += self.zero_count
+            buckets.append([floatToGoString(self.zero_threshold), count])
+        for index in sorted(self.positive):
+            count += self.positive[index]
+            buckets.append([floatToGoString(bucket_upper_bound(index, self.schema)), count])
+        buckets.append(['+Inf', self.count])
+        return buckets
+
+    @staticmethod
+    def spans_and_deltas(buckets):
+        """Encode the populated buckets as in the Prometheus native histograms:
+           [offset, length] spans of consecutive indexes, the offset of each
+           one being relative to the end of the previous one, and the count
+           of every bucket as the delta from the previous one.
+        """
+        spans = []
+        deltas = []
+        previous_index = None
+        previous_count = 0
+        for index in sorted(buckets):
+            if previous_index is None:
+                spans.append([index, 1])
+            elif index == previous_index + 1:
+                spans[-1][1] += 1
+            else:
+                spans.append([index - previous_index - 1, 1])
+            deltas.append(buckets[index] - previous_count)
+            previous_index = index
+            previous_count = buckets[index]
+        return spans, deltas
+
+
+class ExponentialHistogramMetricFamily(HistogramMetricFamily):
+    """HistogramMetricFamily of ExponentialHistogram series: the text
+       exposition uses their classic buckets, while the protobuf one
+       encodes them as native histograms (see the protobuf module).
+    """
+
+    def __init__(self, name, documentation, labels):
+        super(ExponentialHistogramMetricFamily, self).__init__(
+            name, documentation, labels=labels)
+        self.labelnames = tuple(labels)
+        # {((label_name, label_value), ...): ExponentialHistogram}
+        self.exponential_histograms = {}
+
+    def add_metric(self, labels, histogram):
+        super(ExponentialHistogramMetricFamily, self).add_metric(
+            labels, buckets=histogram.classic_buckets(), sum_value=histogram.sum)
+        self.exponential_histograms[tuple(sorted(zip(self.labelnames, labels)))] = histogram
@@ -0,0 +1,211 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Encoder of prometheus_client metric families in the Prometheus protobuf
+   exposition format (io.prometheus.client.MetricFamily messages, length
+   delimited), the only one able to carry native histograms.
+
+   The messages are small and fixed, so they are encoded by hand rather
+   than depending on the protobuf library. A useful property of the
+   protobuf encoding is that concatenating two messages is the same as
+   merging them (the repeated fields are appended), so the MetricFamily
+   messages rendered by different shards for the same family can be merged
+   without decoding them.
+"""
+
+import math
+import struct
+
+
+CONTENT_TYPE = ('application/vnd.google.protobuf; '
+                'proto=io.prometheus.client.MetricFamily; encoding=delimited')
+
+# Values of the MetricType enum.
+COUNTER = 0
+GAUGE = 1
+SUMMARY = 2
+UNTYPED = 3
+HISTOGRAM = 4
+GAUGE_HISTOGRAM = 5
+
+
+def accepts_protobuf(accept_header):
+    """Return True if the Accept header of a scrape request includes the
+       delimited protobuf format.
+    """
+    for media_range in (accept_header or '').split(','):
+        media_type, _, parameters = media_range.partition(';')
+        if media_type.strip() != 'application/vnd.google.protobuf':
+            continue
+        parameters = dict(
+            parameter.strip().partition('=')[::2] for parameter in parameters.split(';'))
+        if (parameters.get('proto') == 'io.prometheus.client.MetricFamily' and
+                parameters.get('encoding') == 'delimited'):
+            return True
+    return False
+
+
+def _varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def _uint(field, value):
+    return _varint(field << 3) + _varint(int(value))
+
+
+def _sint(field, value):
+    return _varint(field << 3) + _varint(_zigzag(int(value)))
+
+
+def _double(field, value):
+    return _varint(field << 3 | 1) + struct.pack('<d', value)
+
+
+def _bytes(field, data):
+    return _varint(field << 3 | 2) + _varint(len(data)) + data
+
+
+def _string(field, value):
+    return _bytes(field, value.encode('utf-8'))
+
+
+def _packed_sint(field, values):
+    return _bytes(field, b''.join(_varint(_zigzag(int(value))) for value in values))
+
+
+def delimited(message):
+    """Prefix a message with its length, as the exposition format requires."""
+    return _varint(len(message)) + message
+
+
+def _native_histogram(histogram):
+    """Encode an ExponentialHistogram as a native Histogram message."""
+    message = [
+        _uint(1, histogram.count),
+        _double(2, histogram.sum),
+        _sint(5, histogram.schema),
+        _double(6, histogram.zero_threshold),
+        _uint(7, histogram.zero_count),
+    ]
+    for spans_field, deltas_field, buckets in ((9, 10, histogram.negative),
+                                               (12, 13, histogram.positive)):
+        spans, deltas = histogram.spans_and_deltas(buckets)
+        for offset, length in spans:
+            message.append(_bytes(spans_field, _sint(1, offset) + _uint(2, length)))
+        if deltas:
+            message.append(_packed_sint(deltas_field, deltas))
+    if not (histogram.zero_threshold or histogram.zero_count or
+            histogram.positive or histogram.negative):
+        # An empty span marks the histogram as native.
+        message.append(_bytes(12, _sint(1, 0) + _uint(2, 0)))
+    return b''.join(message)
+
+
+def encode_metric_family(metric_family):
+    """Encode a prometheus_client metric family as a MetricFamily message
+       (not delimited), following the same naming conventions of the text
+       format. The series of an ExponentialHistogramMetricFamily are encoded
+       as native histograms (without their classic buckets).
+    """
+    name = metric_family.name
+    family_type = metric_family.type
+    if family_type == 'counter':
+        name += '_total'
+        proto_type = COUNTER
+    elif family_type == 'info':
+        name += '_info'
+        proto_type = GAUGE
+    elif family_type in ('gauge', 'stateset'):
+        proto_type = GAUGE
+    elif family_type == 'histogram':
+        proto_type = HISTOGRAM
+    elif family_type == 'gaugehistogram':
+        proto_type = GAUGE_HISTOGRAM
+    elif family_type == 'summary':
+        proto_type = SUMMARY
+    else:
+        proto_type = UNTYPED
+
+    # The samples of every series, grouped by their labels (without the
+    # 'le' and 'quantile' ones of histograms and summaries).
+    metrics = {}
+    for sample in metric_family.samples:
+        labels = tuple(sorted(
+            (label_name, label_value) for label_name, label_value in sample.labels.items()
+            if label_name not in ('le', 'quantile')))
+        metric = metrics.setdefault(
+            labels, {'value': None, 'count': 0, 'sum': 0.0, 'buckets': [], 'quantiles': []})
+        suffix = sample.name[len(metric_family.name):]
+        if suffix == '_created':
+            continue
+        elif suffix == '_bucket':
+            upper_bound = float(sample.labels['le'])
+            # The +Inf bucket is implied by the count.
+            if not math.isinf(upper_bound):
+                metric['buckets'].append((upper_bound, sample.value))
+        elif suffix in ('_count', '_gcount'):
+            metric['count'] = sample.value
+        elif suffix in ('_sum', '_gsum'):
+            metric['sum'] = sample.value
+        elif 'quantile' in sample.labels:
+            metric['quantiles'].append((float(sample.labels['quantile']), sample.value))
+        else:
+            metric['value'] = sample.value
+
+    exponential_histograms = getattr(metric_family, 'exponential_histograms', {})
+    family = [_string(1, name), _string(2, metric_family.documentation),
+              _uint(3, proto_type)]
+    for labels, metric in metrics.items():
+        message = [_bytes(1, _string(1, label_name) + _string(2, label_value))
+                   for label_name, label_value in labels]
+        if proto_type in (HISTOGRAM, GAUGE_HISTOGRAM):
+            if labels in exponential_histograms:
+                histogram = _native_histogram(exponential_histograms[labels])
+            else:
+                histogram = b''.join(
+                    [_uint(1, metric['count']), _double(2, metric['sum'])] +
+                    [_bytes(3, _uint(1, count) + _double(2, upper_bound))
+                     for upper_bound, count in metric['buckets']])
+            message.append(_bytes(7, histogram))
+        elif proto_type == SUMMARY:
+            message.append(_bytes(4, b''.join(
+                [_uint(1, metric['count']), _double(2, metric['sum'])] +
+                [_bytes(3, _double(1, quantile) + _double(2, value))
+                 for quantile, value in metric['quantiles']])))
+        else:
+            # The Gauge, Counter and Untyped messages have the same layout.
+            value_field = {COUNTER: 3, GAUGE: 2, UNTYPED: 5}[proto_type]
+            message.append(_bytes(value_field, _double(1, metric['value'] or 0.0)))
+        family.append(_bytes(4, b''.join(message)))
+    return b''.join(family)
+
+
+def generate_latest(registry):
+    """Return the delimited protobuf exposition of the metrics of a
+       registry, like prometheus_client's generate_latest for the text one.
+    """
+    output = []
+    for metric_family in registry.collect():
+        output.append(delimited(encode_metric_family(metric_family)))
+    return b''.join(output)
@@ -0,0 +1,217 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import math
+import time
+
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+# Like the Prometheus client libraries, the quantiles are computed over the
+# samples of the last DEFAULT_MAX_AGE seconds, in DEFAULT_AGE_BUCKETS steps.
+DEFAULT_MAX_AGE = 600
+DEFAULT_AGE_BUCKETS = 5
+
+# Values with a lower absolute value are counted as zeros.
+MIN_INDEXABLE_VALUE = 1e-300
+
+
+class DDSketch(object):
+    """Quantile sketch with a relative accuracy guarantee (DDSketch): every
+       sample is counted in the bin with logarithmic boundaries including it,
+       so that any quantile estimate is within relative_accuracy of the
+       actual value. The number of bins is bounded by max_bins: when it is
+       exceeded the bins of the lowest values are collapsed, so the
+       accuracy guarantee holds for the highest quantiles (the ones that
+       matter for latencies).
+    """
+    __slots__ = ('gamma', 'log_gamma', 'max_bins', 'positive', 'negative', 'zero_count',
+                 'count')
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def copy(self):
+        sketch = DDSketch.__new__(DDSketch)
+        sketch.gamma = self.gamma
+        sketch.log_gamma = self.log_gamma
+        sketch.max_bins = self.max_bins
+        sketch.positive = dict(self.positive)
+        sketch.negative = dict(self.negative)
+        sketch.zero_count = self.zero_count
+        sketch.count = self.count
+        return sketch
+
+    __copy__ = copy
+
+    def add(self, values):
+        log_gamma = self.log_gamma
+        for value in values:
+            if value > MIN_INDEXABLE_VALUE:
+                bins = self.positive
+            elif value < -MIN_INDEXABLE_VALUE:
+                bins = self.negative
+                value = -value
+            elif value == value:
+                self.zero_count += 1
+                self.count += 1
+                continue
+            else:
+                # NaN values can't be ranked.
+                continue
+            if math.isinf(value):
+                continue
+            index = math.ceil(math.log(value) / log_gamma)
+            bins[index] = bins.get(index, 0) + 1
+            self.count += 1
+
+        if len(self.positive) + len(self.negative) > self.max_bins:
+            self.collapse()
+
+    def collapse(self):
+        """Merge the bins of the lowest values until max_bins are left."""
+        excess = len(self.positive) + len(self.negative) - self.max_bins
+        if self.negative:
+            # The lowest values are the negative ones with the highest index.
+            excess = self.collapse_bins(self.negative, excess, reverse=True)
+        if excess > 0:
+            self.collapse_bins(self.positive, excess, reverse=False)
+
+    @staticmethod
+    def collapse_bins(bins, excess, reverse):
+        """Fold the first excess + 1 bins of the given order into the last
+           one of them, returning the number of bins still to remove.
+        """
+        indexes = sorted(bins, reverse=reverse)
+        removed = min(excess, len(indexes) - 1)
+        if removed <= 0:
+            return excess
+        target = indexes[removed]
+        for index in indexes[:removed]:
+            bins[target] += bins.pop(index)
+        return excess - removed
+
+    def merge(self, sketch):
+        for bins, other_bins in ((self.positive, sketch.positive),
+                                 (self.negative, sketch.negative)):
+            for index, count in other_bins.items():
+                bins[index] = bins.get(index, 0) + count
+        self.zero_count += sketch.zero_count
+        self.count += sketch.count
+        if len(self.positive) + len(self.negative) > self.max_bins:
+            self.collapse()
+
+    def bin_value(self, index):
+        """Value representative of a bin, with the lowest relative error
+           for every value of the bin (gamma ** (index - 1), gamma ** index].
+        """
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, quantile):
+        if not self.count:
+            return float('nan')
+        rank = quantile * (self.count - 1)
+        count = 0
+        for index in sorted(self.negative, reverse=True):
+            count += self.negative[index]
+            if count > rank:
+                return -self.bin_value(index)
+        count += self.zero_count
+        if count > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            count += self.positive[index]
+            if count > rank:
+                return self.bin_value(index)
+        return float('nan')
+
+
+class QuantileSummary(object):
+    """Series of a summary metric: the total count and sum of the samples,
+       and the quantiles of the samples of the last max_age seconds.
+
+       The window is split in age_buckets sketches, every one collecting the
+       samples of max_age / age_buckets seconds: the oldest one is dropped
+       when a new one is started, and the quantiles are estimated merging
+       all of them. So the memory used is fixed (age_buckets sketches of up
+       to max_bins bins) and old samples stop affecting the quantiles.
+    """
+    __slots__ = ('quantiles', 'relative_accuracy', 'max_bins', 'rotation_interval',
+                 'sketches', 'rotated_at', 'count', 'sum')
+
+    def __init__(self, quantiles=DEFAULT_QUANTILES,
+                 relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS,
+                 max_age=DEFAULT_MAX_AGE, age_buckets=DEFAULT_AGE_BUCKETS, now=None):
+        self.quantiles = quantiles
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.rotation_interval = max_age / age_buckets
+        self.sketches = collections.deque(
+            [DDSketch(relative_accuracy, max_bins) for _ in range(age_buckets)],
+            maxlen=age_buckets)
+        self.rotated_at = time.monotonic() if now is None else now
+        self.count = 0
+        self.sum = 0.0
+
+    def copy(self):
+        summary = QuantileSummary.__new__(QuantileSummary)
+        summary.quantiles = self.quantiles
+        summary.relative_accuracy = self.relative_accuracy
+        summary.max_bins = self.max_bins
+        summary.rotation_interval = self.rotation_interval
+        summary.sketches = collections.deque(
+            [sketch.copy() for sketch in self.sketches], maxlen=self.sketches.maxlen)
+        summary.rotated_at = self.rotated_at
+        summary.count = self.count
+        summary.sum = self.sum
+        return summary
+
+    __copy__ = copy
+
+    def rotate(self, now):
+        """Start a new sketch (dropping the oldest one) for every rotation
+           interval elapsed since the last rotation.
+        """
+        rotations = int((now - self.rotated_at) / self.rotation_interval)
+        if rotations <= 0:
+            return
+        for _ in range(min(rotations, self.sketches.maxlen)):
+            self.sketches.appendleft(DDSketch(self.relative_accuracy, self.max_bins))
+        self.rotated_at += rotations * self.rotation_interval
+
+    def observe(self, values, now=None):
+        """Add a list of samples to the summary."""
+        self.rotate(time.monotonic() if now is None else now)
+        self.sketches[0].add(values)
+        self.count += len(values)
+        self.sum += sum(values)
+
+    def quantile_values(self, now=None):
+        """Return the list of (quantile, value) of the samples in the window,
+           NaN if there are none.
+        """
+        self.rotate(time.monotonic() if now is None else now)
+        merged = DDSketch(self.relative_accuracy, self.max_bins)
+        for sketch in self.sketches:
+            merged.merge(sketch)
+        return [(quantile, merged.quantile(quantile)) for quantile in self.quantiles]
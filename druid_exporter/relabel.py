@@ -0,0 +1,230 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ingest-time relabeling of the datapoints of a metric, configured by the
+   optional "relabel" list of its config, for example:
+
+   "relabel": [
+       {"label": "taskId", "action": "replace",
+        "regex": "index_([a-z]+)_.*", "replacement": "\\1"},
+       {"label": "dataSource", "action": "keep",
+        "values": ["wikidata", "webrequest"], "replacement": "other"},
+       {"label": "host", "action": "labeldrop"}
+   ]
+
+   The rules are applied in order to the value of their label:
+   * replace: if the value matches the (fully anchored) regex, it is
+     replaced by the expansion of replacement (default "\\1").
+   * keep: the values not in the list are replaced by replacement, or
+     the datapoint is dropped if it has none (an allow list).
+   * drop: the values in the list are replaced by replacement, or the
+     datapoint is dropped if it has none (a deny list).
+   * labeldrop: the label is not exported, so the series differing only
+     by its value are merged: the samples of histograms (and summaries)
+     are aggregated, while the values of counters and gauges are summed
+     (the default "aggregation" of counters) or the last one wins ("last",
+     the default of gauges). Summing requires the metric to have a ttl:
+     the values of the merged datapoints not updated for longer than it
+     are removed from the sum, like the series of finished tasks.
+   The values of the labels of a relabeled metric are converted to strings
+   joining the lists with commas (Druid emits some dimensions, like taskId,
+   as lists of a single value). The transforms of every label are memoized
+   by a bounded LRU cache, since the same values are seen over and over.
+"""
+
+import functools
+import re
+import sys
+
+
+ACTIONS = ('replace', 'keep', 'drop', 'labeldrop')
+AGGREGATIONS = ('sum', 'last')
+
+# Maximum number of values memoized for every relabeled label.
+CACHE_SIZE = 4096
+
+# Group references in the replacement of a replace rule.
+GROUP_REFERENCE = re.compile(r'\\(?:(\d+)|g<([^>]*)>)')
+
+
+def normalize_value(value):
+    """Return the string value of a label as found in a datapoint, joining
+       the values of the lists with commas.
+    """
+    if type(value) is str:
+        return value
+    if type(value) is list:
+        if len(value) == 1 and type(value[0]) is str:
+            return value[0]
+        return ','.join([str(item) for item in value])
+    return str(value)
+
+
+def check_relabel_rules(labels, rules):
+    """Raise ValueError if the relabel rules of a metric with the given
+       labels are not valid.
+    """
+    if type(rules) != list:
+        raise ValueError('relabel should be a list of rules')
+    aggregations = set()
+    for rule in rules:
+        if type(rule) != dict:
+            raise ValueError('relabel rule {} should be an object'.format(rule))
+        if rule.get('label') not in labels:
+            raise ValueError('relabel rule {} should have a "label" among the labels {}'
+                             .format(rule, labels))
+        action = rule.get('action', 'replace')
+        if action not in ACTIONS:
+            raise ValueError('relabel rule {} has action {}, that is not supported. '
+                             'Please use one of {}'.format(rule, action, ACTIONS))
+        replacement = rule.get('replacement')
+        if replacement is not None and type(replacement) != str:
+            raise ValueError('relabel rule {} should have a string replacement'.format(rule))
+        if action == 'replace':
+            try:
+                regex = re.compile(rule.get('regex'))
+            except (TypeError, re.error) as e:
+                raise ValueError('relabel rule {} has an invalid regex: {}'.format(rule, e))
+            for number, name in GROUP_REFERENCE.findall(replacement or '\\1'):
+                if (int(number) > regex.groups) if number else (name not in regex.groupindex):
+                    raise ValueError('relabel rule {} references a group not in its regex'
+                                     .format(rule))
+        elif action in ('keep', 'drop'):
+            values = rule.get('values')
+            if type(values) != list or any(type(value) != str for value in values):
+                raise ValueError('relabel rule {} should have a list of string values'
+                                 .format(rule))
+        elif 'aggregation' in rule:
+            if rule['aggregation'] not in AGGREGATIONS:
+                raise ValueError('relabel rule {} has aggregation {}, that is not supported. '
+                                 'Please use one of {}'
+                                 .format(rule, rule['aggregation'], AGGREGATIONS))
+            aggregations.add(rule['aggregation'])
+    if len(aggregations) > 1:
+        raise ValueError('the labeldrop rules should all have the same aggregation')
+
+
+def merged_aggregation(metric_config):
+    """Return how the values of the counter or gauge series merged by the
+       labeldrop rules of a (valid) metric config are aggregated: 'sum' or
+       'last'. Return None if the metric doesn't merge such series.
+    """
+    if metric_config['type'] not in ('counter', 'gauge'):
+        return None
+    aggregation = None
+    for rule in metric_config.get('relabel') or []:
+        if rule.get('action', 'replace') == 'labeldrop':
+            aggregation = rule.get('aggregation', aggregation)
+            if aggregation is None:
+                aggregation = 'sum' if metric_config['type'] == 'counter' else 'last'
+    return aggregation
+
+
+def replace_value(regex, replacement, value):
+    match = regex.fullmatch(value)
+    if match is None:
+        return value
+    return match.expand(replacement)
+
+
+def keep_value(values, replacement, value):
+    if value in values:
+        return value
+    return replacement
+
+
+def drop_value(values, replacement, value):
+    if value in values:
+        return replacement
+    return value
+
+
+def rule_transform(rule):
+    """Return the function applying a (replace, keep or drop) rule to a label
+       value, returning None if the datapoint has to be dropped.
+    """
+    action = rule.get('action', 'replace')
+    if action == 'replace':
+        return functools.partial(replace_value, re.compile(rule['regex']),
+                                 rule.get('replacement', '\\1'))
+    if action == 'keep':
+        return functools.partial(keep_value, frozenset(rule['values']), rule.get('replacement'))
+    return functools.partial(drop_value, frozenset(rule['values']), rule.get('replacement'))
+
+
+def memoized_transform(transforms, cache_size):
+    """Return the function applying a chain of transforms to a label value,
+       memoized by a bounded LRU cache. Its results are interned, since they
+       end up in the label values of the series.
+    """
+    @functools.lru_cache(maxsize=cache_size)
+    def transform(value):
+        for value_transform in transforms:
+            value = value_transform(value)
+            if value is None:
+                return None
+        return sys.intern(value)
+    return transform
+
+
+class Relabeler(object):
+    """Compiled relabel rules of a metric. labels are the ones exported (the
+       configured ones without the dropped labels), in the same order.
+    """
+    __slots__ = ('labels', 'dropped_labels', 'transforms')
+
+    def __init__(self, labels, rules, cache_size=CACHE_SIZE):
+        check_relabel_rules(labels, rules)
+        label_transforms = {label: [] for label in labels}
+        dropped = set()
+        for rule in rules:
+            if rule.get('action', 'replace') == 'labeldrop':
+                dropped.add(rule['label'])
+            else:
+                label_transforms[rule['label']].append(rule_transform(rule))
+        self.labels = tuple(label for label in labels if label not in dropped)
+        self.dropped_labels = tuple(label for label in labels if label in dropped)
+        # (label, transform) couples, the transform is None for the labels
+        # without rules.
+        self.transforms = tuple(
+            (label, memoized_transform(tuple(label_transforms[label]), cache_size)
+             if label_transforms[label] else None)
+            for label in self.labels)
+
+    def label_values(self, datapoint):
+        """Return the tuple of the (relabeled) values of the exported labels
+           of a datapoint, or None if it has to be dropped, raising KeyError
+           if one of the labels (including the dropped ones) is missing.
+        """
+        for label in self.dropped_labels:
+            if label not in datapoint:
+                raise KeyError(label)
+        label_values = []
+        for label, transform in self.transforms:
+            value = datapoint[label]
+            if type(value) is not str:
+                value = normalize_value(value)
+            if transform is not None:
+                value = transform(value)
+                if value is None:
+                    return None
+            label_values.append(value)
+        return tuple(label_values)
+
+    def dropped_label_values(self, datapoint):
+        """Return the tuple of the values of the dropped labels of a
+           datapoint, identifying it among the ones merged into a series.
+        """
+        return tuple([normalize_value(datapoint[label]) for label in self.dropped_labels])
@@ -0,0 +1,114 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import sys
+
+from collections.abc import Mapping
+
+
+def intern_label_values(raw_label_values):
+    """Return the label values of a series as a tuple of strings, interned
+       so that the values repeated by many series (like the dataSource or
+       tier names) are stored only once.
+    """
+    return tuple([sys.intern(str(value)) for value in raw_label_values])
+
+
+class SeriesIndex(Mapping):
+    """Values of the series of a (counter or gauge) metric family, stored in
+       a contiguous array and indexed by a stable integer series ID.
+
+       ids maps the label values of every series to its ID, that is its
+       position in labels and values. The IDs of the removed series are
+       reused by the new ones, so the arrays don't grow with the churn of
+       the series. It behaves like a read-only {label_values: value} dict.
+    """
+    __slots__ = ('ids', 'labels', 'values', 'free_ids')
+
+    def __init__(self):
+        self.ids = {}
+        # Label values of every series ID (None for the free ones).
+        self.labels = []
+        self.values = array.array('d')
+        self.free_ids = []
+
+    def lookup(self, raw_label_values):
+        """Return the ID of a series given its label values as found in a
+           datapoint (not necessarily strings), or None if it doesn't exist.
+        """
+        try:
+            series_id = self.ids.get(raw_label_values)
+        except TypeError:
+            # Unhashable values, like lists.
+            series_id = None
+        if series_id is None:
+            series_id = self.ids.get(intern_label_values(raw_label_values))
+        return series_id
+
+    def add(self, label_values, value=0.0):
+        """Create a new series, returning its ID."""
+        if self.free_ids:
+            series_id = self.free_ids.pop()
+            self.labels[series_id] = label_values
+            self.values[series_id] = value
+        else:
+            series_id = len(self.labels)
+            self.labels.append(label_values)
+            self.values.append(value)
+        self.ids[label_values] = series_id
+        return series_id
+
+    def pop(self, label_values, default=None):
+        """Remove a series, returning its value (or default if missing)."""
+        series_id = self.ids.pop(label_values, None)
+        if series_id is None:
+            return default
+        self.labels[series_id] = None
+        self.free_ids.append(series_id)
+        return self.values[series_id]
+
+    def copy(self):
+        series_index = SeriesIndex()
+        series_index.ids = dict(self.ids)
+        series_index.labels = list(self.labels)
+        series_index.values = self.values[:]
+        series_index.free_ids = list(self.free_ids)
+        return series_index
+
+    __copy__ = copy
+
+    def items(self):
+        """Iterate over the (label_values, value) couples of the series,
+           in order of ID.
+        """
+        for label_values, value in zip(self.labels, self.values):
+            if label_values is not None:
+                yield label_values, value
+
+    def __getitem__(self, label_values):
+        return self.values[self.ids[label_values]]
+
+    def __contains__(self, label_values):
+        return label_values in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return 'SeriesIndex({!r})'.format(dict(self.items()))
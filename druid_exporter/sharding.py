@@ -0,0 +1,258 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+from druid_exporter import compression, protobuf
+from druid_exporter.collector import (DruidCollector, QueueFullError, StaticRegistry,
+                                      compile_metrics_config)
+from druid_exporter.decoding import MAX_PAYLOAD_SIZE, PayloadTooLargeError
+from druid_exporter.decoding import limited_reader, read_all
+from prometheus_client import generate_latest
+
+
+log = logging.getLogger(__name__)
+
+
+class ShardRouter(object):
+    """Decide which shard (worker process) owns a datapoint, and forward it
+       there. A series is always stored by the same shard, so gauges keep
+       their last value semantic and the shards never export the same series.
+    """
+
+    def __init__(self, index, inboxes):
+        self.index = index
+        self.inboxes = inboxes
+
+    def shard_of(self, metric_plan, datapoint):
+        # The series of metrics with a max_series budget are all kept in
+        # the same shard, to enforce the budget (and to have only one
+        # overflow series).
+        if metric_plan.max_series is not None:
+            return hash(metric_plan.key) % len(self.inboxes)
+        try:
+            label_values = metric_plan.label_values(datapoint)
+        except KeyError:
+            # The datapoint will be dropped by the store functions anyway.
+            return self.index
+        return hash((metric_plan.key, label_values)) % len(self.inboxes)
+
+    def route(self, batch, enqueue_batch):
+        """Split a batch of (metric_plan, datapoint) couples among the
+           shards, enqueuing locally (via enqueue_batch) the part owned by
+           this shard.
+        """
+        shard_batches = [[] for _ in self.inboxes]
+        for metric_plan, datapoint in batch:
+            shard_batches[self.shard_of(metric_plan, datapoint)].append(
+                (metric_plan, datapoint))
+
+        for index, shard_batch in enumerate(shard_batches):
+            if not shard_batch:
+                continue
+            if index == self.index:
+                enqueue_batch(shard_batch)
+            else:
+                self.inboxes[index].put(
+                    ('datapoints',
+                     [(metric_plan.key, datapoint) for metric_plan, datapoint in shard_batch]))
+
+
+def serve_shard_scrapes(index, druid_collector, control, replies):
+    """Reply to the scrape requests of the main process, in a dedicated
+       thread so that scrapes don't wait for the datapoints in the inbox.
+    """
+    while True:
+        scrape_request = control.get()
+        if scrape_request is None:
+            return
+        scrape_id, use_protobuf = scrape_request
+        try:
+            replies.put((scrape_id, index, druid_collector.render_families(use_protobuf),
+                         druid_collector.exporter_stats()))
+        except Exception:
+            log.exception('Shard %d failed to render its metrics', index)
+
+
+def run_shard(index, inboxes, controls, replies, metrics_config, kafka_config,
+              collector_kwargs):
+    """Main function of a worker process, holding a shard of the series."""
+    druid_collector = DruidCollector(
+        metrics_config, kafka_config,
+        shard_router=ShardRouter(index, inboxes), **collector_kwargs)
+    threading.Thread(
+        target=serve_shard_scrapes,
+        args=(index, druid_collector, controls[index], replies),
+        daemon=True).start()
+
+    log.debug('Shard %d starting..', index)
+    inbox = inboxes[index]
+    while True:
+        message = inbox.get()
+        if message[0] == 'payload':
+            try:
+                # The HTTP response has already been sent, so with the
+                # 'reject' overflow policy the payload can only be dropped.
+                druid_collector.check_queue_capacity()
+                druid_collector.register_payload(message[1], message[2])
+            except QueueFullError:
+                log.error('Shard %d queue is full, dropping a payload', index)
+            except Exception:
+                log.exception('Shard %d failed to process a payload, dropping it', index)
+        elif message[0] == 'datapoints':
+            druid_collector.register_routed_datapoints(message[1])
+        elif message[0] == 'reload':
+            druid_collector.reload_metrics_config(message[1])
+        elif message[0] == 'stop':
+            break
+
+    druid_collector.stop_running_threads()
+    log.debug('Shard %d shutting down..', index)
+
+
+class ShardedCollector(object):
+    """Drop-in replacement of DruidCollector for the exporter's WSGI app,
+       spreading the decoding and processing of the datapoints over multiple
+       worker processes (to use more than one CPU core).
+
+       The payloads received via HTTP are handed over, still encoded, to the
+       workers in a round robin fashion. Every worker decodes them and
+       forwards each datapoint to the worker owning its series (see
+       ShardRouter). If Kafka is configured, every worker runs a consumer
+       of the same consumer group, so the topic's partitions are split
+       among them. At scrape time the metrics rendered by every shard are
+       merged in a single exposition.
+    """
+
+    def __init__(self, metrics_config, workers, kafka_config=None,
+                 scrape_timeout=10, **collector_kwargs):
+        self.metrics_plan = compile_metrics_config(metrics_config)
+        self.scrape_timeout = scrape_timeout
+        self.max_payload_size = collector_kwargs.get('max_payload_size', MAX_PAYLOAD_SIZE)
+
+        # The global series budget is split among the shards.
+        if collector_kwargs.get('max_series'):
+            collector_kwargs['max_series'] = -(-collector_kwargs['max_series'] // workers)
+
+        # The workers are forked, so they share the same hash seed and the
+        # ShardRouter of every process agrees on the owner of each series.
+        context = multiprocessing.get_context('fork')
+        self.inboxes = [context.Queue() for _ in range(workers)]
+        self.controls = [context.Queue() for _ in range(workers)]
+        self.replies = context.Queue()
+        self.processes = []
+        for index in range(workers):
+            process = context.Process(
+                target=run_shard,
+                args=(index, self.inboxes, self.controls, self.replies,
+                      metrics_config, kafka_config, collector_kwargs),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        self.next_inbox = itertools.cycle(self.inboxes)
+        self.scrape_lock = threading.Lock()
+        self.scrape_id = 0
+
+    def stop_running_threads(self):
+        for inbox, control in zip(self.inboxes, self.controls):
+            inbox.put(('stop',))
+            control.put(None)
+
+    def reload_metrics_config(self, metrics_config):
+        """Replace the metrics config of all the shards at runtime (see
+           DruidCollector.reload_metrics_config). Every shard reloads it after
+           processing the payloads already in its inbox.
+        """
+        self.metrics_plan = compile_metrics_config(metrics_config, previous_plan=self.metrics_plan)
+        for inbox in self.inboxes:
+            inbox.put(('reload', metrics_config))
+
+    def register_payload(self, payload, encoding='utf-8'):
+        next(self.next_inbox).put(('payload', payload, encoding))
+
+    def register_stream(self, read, encoding='utf-8', length=None):
+        # The payload is decoded by the workers, so it needs to be read
+        # entirely to be handed over to one of them.
+        if length is not None and length > self.max_payload_size:
+            raise PayloadTooLargeError(
+                'The payload is bigger than {} bytes, rejecting it.'
+                .format(self.max_payload_size))
+        self.register_payload(
+            read_all(limited_reader(read, self.max_payload_size)), encoding)
+
+    def scrape_shards(self, use_protobuf=False):
+        """Ask every shard to render its metrics (in the text or protobuf
+           format), and return their replies as (index, families, stats) tuples.
+        """
+        self.scrape_id += 1
+        for control in self.controls:
+            control.put((self.scrape_id, use_protobuf))
+
+        shard_replies = []
+        deadline = time.monotonic() + self.scrape_timeout
+        while len(shard_replies) < len(self.controls):
+            try:
+                scrape_id, index, families, stats = self.replies.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                log.error('Only %d shards out of %d replied to the scrape request, '
+                          'returning partial results.',
+                          len(shard_replies), len(self.controls))
+                break
+            # Late replies to a previous (timed out) scrape are discarded.
+            if scrape_id == self.scrape_id:
+                shard_replies.append((index, families, stats))
+        return shard_replies
+
+    def generate_latest(self, use_protobuf=False, content_encoding=None):
+        """Return the Prometheus text exposition of the Druid metrics of all
+           the shards (or the protobuf one, if use_protobuf is True),
+           compressed with the content encoding if given. Every
+           shard renders disjoint series, so the text families are merged
+           keeping the HELP/TYPE header of the first one and concatenating
+           all the samples, while the protobuf messages of the same family
+           are simply concatenated (that merges them).
+        """
+        with DruidCollector.scrape_duration.time(), self.scrape_lock:
+            shard_replies = self.scrape_shards(use_protobuf)
+
+        families = {}
+        for _, shard_families, _ in shard_replies:
+            for family_key, rendered_family in shard_families:
+                if use_protobuf:
+                    families.setdefault(family_key, []).append(rendered_family)
+                    continue
+                help_line, type_line, samples = rendered_family.split(b'\n', 2)
+                if family_key not in families:
+                    families[family_key] = [help_line, b'\n', type_line, b'\n']
+                families[family_key].append(samples)
+
+        output = [b''.join(families[family_key])
+                  for family_key in self.metrics_plan if family_key in families]
+        stats = DruidCollector.merge_exporter_stats(
+            [shard_stats for _, _, shard_stats in shard_replies])
+        exporter_metrics = StaticRegistry(DruidCollector.collect_exporter_metrics(stats))
+        if use_protobuf:
+            output = [protobuf.delimited(message) for message in output]
+            output.append(protobuf.generate_latest(exporter_metrics))
+        else:
+            output.append(generate_latest(exporter_metrics))
+        return compression.compress(b''.join(output), content_encoding)
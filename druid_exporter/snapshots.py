@@ -0,0 +1,246 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Snapshots of the series stored by a DruidCollector, saved periodically
+   to a file and loaded at startup, so that a restart of the exporter
+   doesn't reset the histograms and blank the gauges until Druid emits them
+   again.
+
+   A snapshot file starts with a fixed header (magic bytes and format
+   version) followed by a pickle of the series of every metric family:
+   * counters and gauges as the list of their label values and an array of
+     their values.
+   * classic histograms as the list of their label values and a single
+     array with the values of all the series, one after the other.
+   * exponential histograms and summaries as {label_values: object}.
+   The label values shared by many series are pickled only once, since they
+   are interned. The series of a family are restored only if the config of
+   its metric still stores them in the same way (see
+   collector.STORAGE_FIELDS).
+"""
+
+import array
+import logging
+import os
+import pickle
+import struct
+import time
+
+from collections import OrderedDict
+from druid_exporter.collector import HISTOGRAM_TYPES, STORAGE_FIELDS
+from druid_exporter.series import SeriesIndex, intern_label_values
+
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'DRUIDSNP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('>8sH')
+
+
+class SnapshotError(ValueError):
+    """Raised when a snapshot file can't be loaded."""
+
+
+def storage_config(metric_plan):
+    return {field: metric_plan.config.get(field) for field in STORAGE_FIELDS}
+
+
+def monotonic_offset():
+    """Return the difference between the monotonic clock and the wall clock,
+       to translate the monotonic times of a snapshot to the ones of the
+       process loading it.
+    """
+    return time.monotonic() - time.time()
+
+
+def family_state(druid_collector, metric_plan):
+    """Return the snapshot of the series of a metric family, or None if it
+       has none. The storage lock is held only for the time needed to copy
+       them.
+    """
+    with druid_collector.storage_lock:
+        series = druid_collector.copy_family_series(metric_plan)
+        if not series:
+            return None
+        last_update = druid_collector.series_last_update.get(metric_plan.key)
+        if last_update is not None:
+            last_update = list(last_update.items())
+        owners = druid_collector.series_hosts.get(metric_plan.key)
+        if owners:
+            owners = dict(owners)
+
+    series_count = len(series)
+    if metric_plan.type == 'histogram':
+        values = array.array('d')
+        for series_values in series.values():
+            values.extend(series_values)
+        series = (list(series.keys()), values)
+    elif metric_plan.type not in HISTOGRAM_TYPES:
+        series = tuple(zip(*series.items()))
+        series = (list(series[0]), array.array('d', series[1]))
+    return {
+        'key': metric_plan.key,
+        'storage': storage_config(metric_plan),
+        'series': series,
+        'last_update': last_update,
+        'owners': owners,
+        'series_count': series_count,
+    }
+
+
+def save_snapshot(druid_collector, path):
+    """Write a snapshot of the series of the collector to path, atomically
+       (the previous snapshot is replaced only when the new one is complete).
+       Return the number of series saved.
+    """
+    start = time.monotonic()
+    families = []
+    for metric_plan in list(druid_collector.metrics_plan.values()):
+        state = family_state(druid_collector, metric_plan)
+        if state is not None:
+            families.append(state)
+    with druid_collector.storage_lock:
+        host_last_seen = dict(druid_collector.host_last_seen)
+    snapshot = {
+        'saved_at': time.time(),
+        'monotonic_offset': monotonic_offset(),
+        'families': families,
+        'host_last_seen': host_last_seen,
+    }
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+        pickle.dump(snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+
+    series_count = sum(family['series_count'] for family in families)
+    druid_collector.observe_stage('snapshot', time.monotonic() - start)
+    log.debug('Saved a snapshot of %d series to %s', series_count, path)
+    return series_count
+
+
+def read_snapshot(path):
+    """Return the content of a snapshot file, raising SnapshotError if it's
+       not valid.
+    """
+    with open(path, 'rb') as snapshot_file:
+        header = snapshot_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise SnapshotError('Truncated snapshot file {}'.format(path))
+        magic, version = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise SnapshotError('{} is not a snapshot file'.format(path))
+        if version != FORMAT_VERSION:
+            raise SnapshotError('Unsupported version {} of snapshot file {}'
+                                .format(version, path))
+        try:
+            return pickle.load(snapshot_file)
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+            raise SnapshotError('Malformed snapshot file {}: {}'.format(path, e))
+
+
+def restore_family(druid_collector, metric_plan, family, shift):
+    """Replace the series of a metric family with the ones of its snapshot,
+       to be called while holding the storage lock. The monotonic times of the
+       snapshot are shifted to the clock of this process.
+    """
+    druid_collector.remove_family(metric_plan)
+    if metric_plan.type == 'histogram':
+        label_values_list, values = family['series']
+        size = len(metric_plan.buckets) + 1
+        series = {label_values: values[index * size:(index + 1) * size]
+                  for index, label_values in enumerate(label_values_list)}
+        druid_collector.histograms.setdefault(
+            metric_plan.metric_name, {})[metric_plan.daemon] = series
+    elif metric_plan.type in HISTOGRAM_TYPES:
+        series = family['series']
+        if metric_plan.type == 'summary':
+            for summary in series.values():
+                summary.rotated_at += shift
+        druid_collector.histograms.setdefault(
+            metric_plan.metric_name, {})[metric_plan.daemon] = series
+    else:
+        series = SeriesIndex()
+        for label_values, value in zip(*family['series']):
+            series.add(intern_label_values(label_values), value)
+        druid_collector.counters[metric_plan.metric_name][metric_plan.daemon] = series
+    druid_collector.series_count += len(series)
+
+    if metric_plan.ttl:
+        now = time.monotonic()
+        if family['last_update'] is None:
+            # The metric had no TTL, start counting it now.
+            last_update = [(label_values, now) for label_values in series]
+        else:
+            last_update = [(label_values, min(now, updated_at + shift))
+                           for label_values, updated_at in family['last_update']
+                           if label_values in series]
+        druid_collector.series_last_update[metric_plan.key] = OrderedDict(last_update)
+
+    if druid_collector.host_liveness_window and family['owners']:
+        for label_values, host_key in family['owners'].items():
+            if label_values in series:
+                druid_collector.series_hosts[metric_plan.key][label_values] = host_key
+                druid_collector.host_series[host_key][metric_plan.key].add(label_values)
+    druid_collector.dirty_families.add(metric_plan.key)
+
+
+def load_snapshot(druid_collector, path):
+    """Restore the series saved in a snapshot file into the collector
+       (before it starts ingesting datapoints), skipping the metric families
+       no longer in the config or stored differently. Return the number of
+       series restored, raising SnapshotError if the file is not valid.
+    """
+    start = time.monotonic()
+    snapshot = read_snapshot(path)
+    shift = monotonic_offset() - snapshot['monotonic_offset']
+    restored = skipped = 0
+    with druid_collector.storage_lock:
+        for family in snapshot['families']:
+            metric_plan = druid_collector.metrics_plan.get(family['key'])
+            if metric_plan is None or storage_config(metric_plan) != family['storage']:
+                skipped += 1
+                continue
+            restore_family(druid_collector, metric_plan, family, shift)
+            restored += len(druid_collector.family_series(metric_plan))
+        if druid_collector.host_liveness_window:
+            for host_key, last_seen in snapshot['host_last_seen'].items():
+                druid_collector.host_last_seen.setdefault(host_key, last_seen + shift)
+    log.info('Restored %d series from the snapshot %s (saved %.0f seconds ago) in %.2f '
+             'seconds, skipping %d metrics whose config changed', restored, path,
+             time.time() - snapshot['saved_at'], time.monotonic() - start, skipped)
+    return restored
+
+
+def save_snapshots(druid_collector, path, interval, stop):
+    """Save a snapshot of the collector every interval seconds, and a last
+       one when stop is set.
+    """
+    log.debug('Snapshot writer thread starting..')
+
+    while True:
+        stopping = stop.wait(interval)
+        try:
+            save_snapshot(druid_collector, path)
+        except Exception:
+            log.exception('Failed to save a snapshot to %s', path)
+        if stopping:
+            break
+
+    log.debug('Snapshot writer thread shutting down..')
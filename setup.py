@@ -13,7 +13,10 @@ setup(name='druid_exporter',
           'gevent',
       ],
       extras_require = {
-          'kafka': ['kafka-python']
+          'kafka': ['kafka-python'],
+          'fast-json': ['orjson'],
+          'numpy': ['numpy'],
+          'zstd': ['zstandard'],
       },
       entry_points={
           'console_scripts': [
@@ -0,0 +1,130 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import time
+import unittest
+
+from druid_exporter.aioserver import AsyncHTTPServer
+from druid_exporter.collector import DruidCollector
+from druid_exporter.exporter import DruidWSGIApp
+from prometheus_client import CollectorRegistry
+from test_exporter import METRICS_CONFIG
+
+
+class TestAsyncHTTPServer(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = DruidCollector(METRICS_CONFIG)
+        self.server = AsyncHTTPServer(
+            DruidWSGIApp('/', self.collector, CollectorRegistry(), 'utf-8'),
+            max_connections=2)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        server = asyncio.run_coroutine_threadsafe(
+            self.server.start('127.0.0.1', 0), self.loop).result()
+        self.port = server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        async def stop_server():
+            self.server.server.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(stop_server(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.collector.stop_running_threads()
+
+    def datapoints_body(self, *values):
+        return json.dumps([
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+             'metric': 'query/time', 'value': value}
+            for value in values]).encode()
+
+    def read_responses(self, sock, count):
+        """Read count responses (without body) from a socket."""
+        data = b''
+        while data.count(b'\r\n\r\n') < count:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return [response for response in data.split(b'\r\n\r\n') if response]
+
+    def test_keep_alive(self):
+        """Multiple requests should be served by the same connection."""
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        for value in (5, 50):
+            connection.request('POST', '/', self.datapoints_body(value),
+                               {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.read(), b'')
+            self.assertEqual(response.getheader('Connection'), 'keep-alive')
+        time.sleep(0.1)
+
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'druid_broker_query_time_ms_sum{datasource="test"} 55.0',
+                      response.read())
+        connection.close()
+        self.assertEqual(self.collector.datapoints_registered, 2)
+
+    def test_pipelining(self):
+        """Pipelined requests should all be answered, in order."""
+        body = self.datapoints_body(5)
+        post = (b'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        chunked = (b'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                   b'Transfer-Encoding: chunked\r\n\r\n' +
+                   '{:x}'.format(len(body)).encode() + b'\r\n' + body + b'\r\n0\r\n\r\n')
+        invalid = b'POST /other HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall(post + chunked + invalid)
+            responses = self.read_responses(sock, 3)
+            self.assertEqual(sock.recv(1), b'')
+        self.assertEqual([response.split(b'\r\n')[0] for response in responses],
+                         [b'HTTP/1.1 200 OK', b'HTTP/1.1 200 OK',
+                          b'HTTP/1.1 400 Bad Request'])
+        self.assertIn(b'Connection: close', responses[2])
+        time.sleep(0.1)
+        self.assertEqual(self.collector.datapoints_registered, 2)
+
+    def test_malformed_request(self):
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall(b'GARBAGE\r\n\r\n')
+            responses = self.read_responses(sock, 1)
+        self.assertTrue(responses[0].startswith(b'HTTP/1.1 400 Bad Request'))
+
+    def test_max_connections(self):
+        """Connections beyond the limit should be refused with a 503."""
+        connections = [socket.create_connection(('127.0.0.1', self.port), timeout=5)
+                       for _ in range(2)]
+        time.sleep(0.1)
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            responses = self.read_responses(sock, 1)
+        self.assertTrue(responses[0].startswith(b'HTTP/1.1 503 Service Unavailable'))
+        for connection in connections:
+            connection.close()
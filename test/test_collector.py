@@ -13,12 +13,119 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
+import io
+import json
 import time
 import unittest
 
-from collections import defaultdict
-from druid_exporter.collector import DruidCollector
+from collections import defaultdict, namedtuple
+from druid_exporter import decoding
+from druid_exporter.collector import (DruidCollector, QueueFullError, bin_histogram_samples,
+                                      compile_metrics_config)
 from druid_exporter.exporter import check_metrics_config_file_consistency, parse_metrics_config_file
+from unittest import mock
+
+
+# One datapoint for each metric configured in TestDruidCollector.setUp
+DATAPOINTS = [
+    {"feed": "metrics",
+     "timestamp": "2017-11-14T16:25:01.395Z",
+     "service": "druid/broker",
+     "host": "druid1001.eqiad.wmnet:8082",
+     "metric": "query/time",
+     "value": 10,
+     "context": "{\"queryId\":\"b09649a1-a440-463f-8b7e-6b476cc22d45\",\"timeout\":40000}",
+     "dataSource": "NavigationTiming",
+     "duration": "PT94670899200S", "hasFilters": "false",
+     "id": "b09649a1-a440-463f-8b7e-6b476cc22d45",
+     "interval": ["0000-01-01T00:00:00.000Z/3000-01-01T00:00:00.000Z"],
+     "remoteAddress": "10.64.53.26", "success": "true",
+     "type": "timeBoundary", "version": "0.9.2"},
+
+    {"feed": "metrics",
+     "timestamp": "2017-11-14T16:25:01.395Z",
+     "service": "druid/historical",
+     "host": "druid1001.eqiad.wmnet:8082",
+     "metric": "query/time",
+     "value": 1,
+     "context": "{\"queryId\":\"b09649a1-a440-463f-8b7e-6b476cc22d45\",\"timeout\":40000}",
+     "dataSource": "NavigationTiming",
+     "duration": "PT94670899200S", "hasFilters": "false",
+     "id": "b09649a1-a440-463f-8b7e-6b476cc22d45",
+     "interval": ["0000-01-01T00:00:00.000Z/3000-01-01T00:00:00.000Z"],
+     "remoteAddress": "10.64.53.26", "success": "true",
+     "type": "timeBoundary", "version": "0.9.2"},
+
+    {"feed": "metrics", "timestamp": "2017-11-14T13:11:55.581Z",
+     "service": "druid/broker", "host": "druid1001.eqiad.wmnet:8083",
+     "metric": "query/bytes", "value": 1015,
+     "context": "{\"bySegment\":true,\"finalize\":false,\"populateCache\":false,\
+                  \"priority\": 0,\"queryId\":\"d96c4b73-8e9b-4a43-821d-f194b4e134d7\",\
+                  \"timeout\":40000}",
+     "dataSource": "webrequest", "duration": "PT3600S",
+     "hasFilters": "false", "id": "d96c4b73-8e9b-4a43-821d-f194b4e134d7",
+     "interval": ["2017-11-14T11:00:00.000Z/2017-11-14T12:00:00.000Z"],
+     "remoteAddress": "10.64.5.101", "type": "segmentMetadata",
+     "version": "0.9.2"},
+
+    {"feed": "metrics", "timestamp": "2017-11-14T13:11:55.581Z",
+     "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
+     "metric": "query/bytes", "value": 1015,
+     "context": "{\"bySegment\":true,\"finalize\":false,\"populateCache\":false,\
+                 \"priority\": 0,\"queryId\":\"d96c4b73-8e9b-4a43-821d-f194b4e134d7\"\
+                 ,\"timeout\":40000}",
+     "dataSource": "webrequest", "duration": "PT3600S", "hasFilters": "false",
+     "id": "d96c4b73-8e9b-4a43-821d-f194b4e134d7",
+     "interval": ["2017-11-14T11:00:00.000Z/2017-11-14T12:00:00.000Z"],
+     "remoteAddress": "10.64.5.101", "type": "segmentMetadata",
+     "version": "0.9.2"},
+
+    {"feed": "metrics", "timestamp": "2017-11-14T16:25:39.217Z",
+     "service": "druid/broker", "host": "druid1001.eqiad.wmnet:8082",
+     "metric": "query/cache/total/numEntries", "value": 5350},
+
+    {"feed": "metrics", "timestamp": "2017-11-14T16:25:39.217Z",
+     "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8082",
+     "metric": "query/cache/total/numEntries", "value": 5351},
+
+    {"feed": "metrics", "timestamp": "2017-11-14T13:08:20.820Z",
+     "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
+     "metric": "query/cache/total/evictions", "dataSource": "test", "value": 0},
+
+    {"feed": "metrics", "timestamp": "2017-11-14T13:07:20.823Z",
+     "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
+     "metric": "segment/count", "value": 41, "dataSource": "netflow",
+     "priority": "0", "tier": "_default_tier"},
+
+    {"feed": "metrics", "timestamp": "2017-11-14T12:14:53.697Z",
+     "service": "druid/coordinator", "host": "druid1001.eqiad.wmnet: 8081",
+     "metric": "segment/count", "value": 56, "dataSource": "netflow"},
+
+    {"feed": "metrics", "timestamp": "2017-12-07T09:55:04.937Z",
+     "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
+     "metric": "segment/used", "value": 3252671142,
+     "dataSource": "banner_activity_minutely",
+     "priority": "0", "tier": "_default_tier"},
+
+    {"feed": "metrics", "timestamp": "2017-11-14T16:15:15.577Z",
+     "service": "druid/coordinator",
+     "host": "druid1001.eqiad.wmnet:8081", "metric": "segment/assigned/count",
+     "value": 0.0, "tier": "_default_tier"},
+
+    {"feed": "metrics",
+     "timestamp": "2017-11-14T16:19:46.564Z",
+     "service": "druid/coordinator", "host": "druid1001.eqiad.wmnet:8081",
+     "metric": "segment/overShadowed/count", "value": 0.0},
+
+    {"feed": "metrics",
+     "timestamp": "2017-11-14T16:27:48.310Z",
+     "service": "druid/coordinator",
+     "host": "druid1001.eqiad.wmnet:8081",
+     "metric": "segment/underReplicated/count", "value": 0,
+     "dataSource": "unique_devices_per_project_family_monthly",
+     "tier": "_default_tier"}
+]
 
 
 class TestDruidCollector(unittest.TestCase):
@@ -129,6 +236,26 @@ class TestDruidCollector(unittest.TestCase):
                      'metric': 'query/time', 'value': 42}
         self.register_datapoint(datapoint)
 
+    def make_collector(self, metrics_config=None, **kwargs):
+        """Create an additional collector, stopped at the end of the test."""
+        if metrics_config is None:
+            metrics_config = self.collector.metrics_config
+        collector = DruidCollector(metrics_config, **kwargs)
+
+        def stop_collector():
+            collector.stop_running_threads()
+        self.addCleanup(stop_collector)
+        return collector
+
+    def make_stopped_collector(self, **kwargs):
+        """Create an additional collector whose processing thread is stopped,
+           so that the datapoints registered stay in the queue.
+        """
+        collector = self.make_collector(**kwargs)
+        collector.stop_running_threads()
+        time.sleep(0.1)
+        return collector
+
     def register_datapoint(self, datapoint):
         """Wrapper around the real register_datapoint to insert a little delay.
         """
@@ -209,6 +336,92 @@ class TestDruidCollector(unittest.TestCase):
         }
         with self.assertRaises(RuntimeError):
             check_metrics_config_file_consistency(wrong_config)
+        wrong_config = {
+            'broker': {
+                "segment/count": {
+                    "prometheus_metric_name": "druid_coordinator_segment_count",
+                    "type": "gauge",
+                    "labels": ["dataSource"],
+                    "description": "Segments count.",
+                    "ttl": "1h"
+                }
+            }
+        }
+        with self.assertRaises(RuntimeError):
+            check_metrics_config_file_consistency(wrong_config)
+        wrong_config = {
+            'broker': {
+                "segment/count": {
+                    "prometheus_metric_name": "druid_coordinator_segment_count",
+                    "type": "gauge",
+                    "labels": ["dataSource"],
+                    "description": "Segments count.",
+                    "max_series": 10,
+                    "overflow": "sample"
+                }
+            }
+        }
+        with self.assertRaises(RuntimeError):
+            check_metrics_config_file_consistency(wrong_config)
+        wrong_config = {
+            'broker': {
+                "query/time": {
+                    "prometheus_metric_name": "druid_broker_query_time_ms",
+                    "type": "exponential_histogram",
+                    "labels": ["dataSource"],
+                    "description": "Milliseconds taken to complete a query.",
+                    "schema": 9
+                }
+            }
+        }
+        with self.assertRaises(RuntimeError):
+            check_metrics_config_file_consistency(wrong_config)
+        wrong_config = {
+            'broker': {
+                "query/node/ttfb": {
+                    "prometheus_metric_name": "druid_broker_query_node_ttfb_ms",
+                    "type": "summary",
+                    "labels": ["dataSource"],
+                    "description": "Time to first byte.",
+                    "quantiles": [0.5, 99]
+                }
+            }
+        }
+        with self.assertRaises(RuntimeError):
+            check_metrics_config_file_consistency(wrong_config)
+
+    def test_compile_metrics_config(self):
+        """Check that the metrics config is flattened into per (daemon, metric)
+           plans with pre-parsed histogram buckets.
+        """
+        metrics_plan = compile_metrics_config(self.collector.metrics_config)
+        self.assertEqual(len(metrics_plan), 13)
+        plan = metrics_plan[('broker', 'query/time')]
+        self.assertEqual(plan.type, 'histogram')
+        self.assertEqual(plan.labels, ('dataSource',))
+        self.assertEqual(plan.prometheus_labels, ('datasource',))
+        self.assertEqual(plan.buckets[0], ('10', 10.0))
+        self.assertEqual(plan.buckets[-1], ('inf', float('inf')))
+        self.assertNotIn('sum', [bucket for bucket, _ in plan.buckets])
+        plan = metrics_plan[('historical', 'segment/used')]
+        self.assertEqual(plan.buckets, ())
+        self.assertEqual(plan.label_values({'tier': 't', 'dataSource': 42}), ('t', '42'))
+        with self.assertRaises(KeyError):
+            plan.label_values({'tier': 't'})
+
+    @staticmethod
+    def histogram_dicts(collector):
+        """Return the histograms of a collector with the values of every
+           series as a {bucket: count, ..., 'sum': sum} dictionary.
+        """
+        return {
+            metric: {
+                daemon: {
+                    label_values: collector.metrics_plan[(daemon, metric)]
+                    .histogram_values_dict(values)
+                    for label_values, values in series.items()}
+                for daemon, series in daemons.items()}
+            for metric, daemons in collector.histograms.items()}
 
     def test_store_histogram(self):
         """Check that multiple datapoints modify the self.histograms data-structure
@@ -224,7 +437,7 @@ class TestDruidCollector(unittest.TestCase):
                         '10': 0, '100': 1, '500': 1, '1000': 1, '2000': 1, '3000': 1,
                         '5000': 1, '7000': 1, '10000': 1, 'inf': 1, 'sum': 42.0}}}}
         expected_result = defaultdict(lambda: {}, expected_struct)
-        self.assertEqual(self.collector.histograms, expected_result)
+        self.assertEqual(self.histogram_dicts(self.collector), expected_result)
 
         datapoint = {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
                      'metric': 'query/time', 'value': 5}
@@ -234,7 +447,7 @@ class TestDruidCollector(unittest.TestCase):
                 expected_struct['query/time']['historical'][('test',)][bucket] += 1
             else:
                 expected_struct['query/time']['historical'][('test',)][bucket] += 5
-        self.assertEqual(self.collector.histograms, expected_result)
+        self.assertEqual(self.histogram_dicts(self.collector), expected_result)
 
         datapoint = {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test2',
                      'metric': 'query/time', 'value': 5}
@@ -242,7 +455,7 @@ class TestDruidCollector(unittest.TestCase):
         expected_result['query/time']['historical'][('test2',)] = {
             '10': 1, '100': 1, '500': 1, '1000': 1, '2000': 1, '3000': 1, '5000': 1, '7000': 1,
             '10000': 1, 'inf': 1, 'sum': 5.0}
-        self.assertEqual(self.collector.histograms, expected_result)
+        self.assertEqual(self.histogram_dicts(self.collector), expected_result)
 
         datapoint = {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
                      'metric': 'query/time', 'value': 42}
@@ -250,7 +463,7 @@ class TestDruidCollector(unittest.TestCase):
         expected_result['query/time']['broker'] = {
                 ('test',): {'10': 0, '100': 1, '500': 1, '1000': 1, '2000': 1, '3000': 1,
                             '5000': 1, '7000': 1, '10000': 1, 'inf': 1, 'sum': 42.0}}
-        self.assertEqual(self.collector.histograms, expected_result)
+        self.assertEqual(self.histogram_dicts(self.collector), expected_result)
 
         datapoint = {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
                      'metric': 'query/time', 'value': 600}
@@ -260,7 +473,7 @@ class TestDruidCollector(unittest.TestCase):
                 expected_struct['query/time']['broker'][('test',)][bucket] += 600
             elif 600 <= float(bucket):
                 expected_struct['query/time']['broker'][('test',)][bucket] += 1
-        self.assertEqual(self.collector.histograms, expected_result)
+        self.assertEqual(self.histogram_dicts(self.collector), expected_result)
 
         datapoint = {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test2',
                      'metric': 'query/time', 'value': 5}
@@ -268,7 +481,7 @@ class TestDruidCollector(unittest.TestCase):
         expected_result['query/time']['broker'][('test2',)] = {
             '10': 1, '100': 1, '500': 1, '1000': 1, '2000': 1, '3000': 1, '5000': 1, '7000': 1,
             '10000': 1, 'inf': 1, 'sum': 5.0}
-        self.assertEqual(self.collector.histograms, expected_result)
+        self.assertEqual(self.histogram_dicts(self.collector), expected_result)
 
     def test_store_counter(self):
         """Check that multiple datapoints modify the self.counters data-structure
@@ -312,6 +525,15 @@ class TestDruidCollector(unittest.TestCase):
         expected_result['segment/used']['historical'][('_default_tier', 'test')] = 11.0
         self.assertEqual(self.collector.counters, expected_result)
 
+        # Label values that are not strings end up in the same series.
+        datapoint = {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 42,
+                     'metric': 'query/cache/total/evictions', 'value': 1}
+        self.register_datapoint(datapoint)
+        datapoint = dict(datapoint, dataSource='42', value=2)
+        self.register_datapoint(datapoint)
+        expected_result['query/cache/total/evictions']['historical'][('42',)] = 2.0
+        self.assertEqual(self.collector.counters, expected_result)
+
     def test_store_datapoint_not_supported_in_config(self):
         """Check if a datapoint not supported by the config is correctly handled.
         """
@@ -343,104 +565,7 @@ class TestDruidCollector(unittest.TestCase):
         """Add one datapoint for each metric and make sure that they render correctly
            when running collect()
         """
-        datapoints = [
-            {"feed": "metrics",
-             "timestamp": "2017-11-14T16:25:01.395Z",
-             "service": "druid/broker",
-             "host": "druid1001.eqiad.wmnet:8082",
-             "metric": "query/time",
-             "value": 10,
-             "context": "{\"queryId\":\"b09649a1-a440-463f-8b7e-6b476cc22d45\",\"timeout\":40000}",
-             "dataSource": "NavigationTiming",
-             "duration": "PT94670899200S", "hasFilters": "false",
-             "id": "b09649a1-a440-463f-8b7e-6b476cc22d45",
-             "interval": ["0000-01-01T00:00:00.000Z/3000-01-01T00:00:00.000Z"],
-             "remoteAddress": "10.64.53.26", "success": "true",
-             "type": "timeBoundary", "version": "0.9.2"},
-
-            {"feed": "metrics",
-             "timestamp": "2017-11-14T16:25:01.395Z",
-             "service": "druid/historical",
-             "host": "druid1001.eqiad.wmnet:8082",
-             "metric": "query/time",
-             "value": 1,
-             "context": "{\"queryId\":\"b09649a1-a440-463f-8b7e-6b476cc22d45\",\"timeout\":40000}",
-             "dataSource": "NavigationTiming",
-             "duration": "PT94670899200S", "hasFilters": "false",
-             "id": "b09649a1-a440-463f-8b7e-6b476cc22d45",
-             "interval": ["0000-01-01T00:00:00.000Z/3000-01-01T00:00:00.000Z"],
-             "remoteAddress": "10.64.53.26", "success": "true",
-             "type": "timeBoundary", "version": "0.9.2"},
-
-            {"feed": "metrics", "timestamp": "2017-11-14T13:11:55.581Z",
-             "service": "druid/broker", "host": "druid1001.eqiad.wmnet:8083",
-             "metric": "query/bytes", "value": 1015,
-             "context": "{\"bySegment\":true,\"finalize\":false,\"populateCache\":false,\
-                          \"priority\": 0,\"queryId\":\"d96c4b73-8e9b-4a43-821d-f194b4e134d7\",\
-                          \"timeout\":40000}",
-             "dataSource": "webrequest", "duration": "PT3600S",
-             "hasFilters": "false", "id": "d96c4b73-8e9b-4a43-821d-f194b4e134d7",
-             "interval": ["2017-11-14T11:00:00.000Z/2017-11-14T12:00:00.000Z"],
-             "remoteAddress": "10.64.5.101", "type": "segmentMetadata",
-             "version": "0.9.2"},
-
-            {"feed": "metrics", "timestamp": "2017-11-14T13:11:55.581Z",
-             "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
-             "metric": "query/bytes", "value": 1015,
-             "context": "{\"bySegment\":true,\"finalize\":false,\"populateCache\":false,\
-                         \"priority\": 0,\"queryId\":\"d96c4b73-8e9b-4a43-821d-f194b4e134d7\"\
-                         ,\"timeout\":40000}",
-             "dataSource": "webrequest", "duration": "PT3600S", "hasFilters": "false",
-             "id": "d96c4b73-8e9b-4a43-821d-f194b4e134d7",
-             "interval": ["2017-11-14T11:00:00.000Z/2017-11-14T12:00:00.000Z"],
-             "remoteAddress": "10.64.5.101", "type": "segmentMetadata",
-             "version": "0.9.2"},
-
-            {"feed": "metrics", "timestamp": "2017-11-14T16:25:39.217Z",
-             "service": "druid/broker", "host": "druid1001.eqiad.wmnet:8082",
-             "metric": "query/cache/total/numEntries", "value": 5350},
-
-            {"feed": "metrics", "timestamp": "2017-11-14T16:25:39.217Z",
-             "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8082",
-             "metric": "query/cache/total/numEntries", "value": 5351},
-
-            {"feed": "metrics", "timestamp": "2017-11-14T13:08:20.820Z",
-             "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
-             "metric": "query/cache/total/evictions", "dataSource": "test", "value": 0},
-
-            {"feed": "metrics", "timestamp": "2017-11-14T13:07:20.823Z",
-             "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
-             "metric": "segment/count", "value": 41, "dataSource": "netflow",
-             "priority": "0", "tier": "_default_tier"},
-
-            {"feed": "metrics", "timestamp": "2017-11-14T12:14:53.697Z",
-             "service": "druid/coordinator", "host": "druid1001.eqiad.wmnet: 8081",
-             "metric": "segment/count", "value": 56, "dataSource": "netflow"},
-
-            {"feed": "metrics", "timestamp": "2017-12-07T09:55:04.937Z",
-             "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
-             "metric": "segment/used", "value": 3252671142,
-             "dataSource": "banner_activity_minutely",
-             "priority": "0", "tier": "_default_tier"},
-
-            {"feed": "metrics", "timestamp": "2017-11-14T16:15:15.577Z",
-             "service": "druid/coordinator",
-             "host": "druid1001.eqiad.wmnet:8081", "metric": "segment/assigned/count",
-             "value": 0.0, "tier": "_default_tier"},
-
-            {"feed": "metrics",
-             "timestamp": "2017-11-14T16:19:46.564Z",
-             "service": "druid/coordinator", "host": "druid1001.eqiad.wmnet:8081",
-             "metric": "segment/overShadowed/count", "value": 0.0},
-
-            {"feed": "metrics",
-             "timestamp": "2017-11-14T16:27:48.310Z",
-             "service": "druid/coordinator",
-             "host": "druid1001.eqiad.wmnet:8081",
-             "metric": "segment/underReplicated/count", "value": 0,
-             "dataSource": "unique_devices_per_project_family_monthly",
-             "tier": "_default_tier"}
-        ]
+        datapoints = DATAPOINTS
 
         # The following datapoint registration batch should not generate
         # any exception (breaking the test).
@@ -463,8 +588,11 @@ class TestDruidCollector(unittest.TestCase):
 
         # Number of metrics pushed using register_datapoint plus the ones
         # generated by the exporter for bookeeping,
-        # like druid_exporter_datapoints_registered_total
-        expected_druid_metrics_len = len(datapoints) + 1
+        # like druid_exporter_datapoints_registered_total,
+        # druid_exporter_json_backend, the queue gauges, the pipeline stages
+        # durations, the datapoints ingested for each metric and the
+        # liveness of the emitting hosts.
+        expected_druid_metrics_len = len(datapoints) + 9
         self.assertEqual(collected_metrics, expected_druid_metrics_len)
 
         for datapoint in datapoints:
@@ -543,3 +671,710 @@ class TestDruidCollector(unittest.TestCase):
             self.register_datapoint(datapoint)
 
         self.assertEqual(self.collector.datapoints_registered, 3)
+
+    def test_register_unsupported_payload(self):
+        """A payload holding only unsupported datapoints should be dropped
+           without decoding it, and its datapoints accounted.
+        """
+        datapoints = [
+            {"feed": "metrics", "service": "druid/broker", "host": "druid1001.eqiad.wmnet:8082",
+             "metric": "jvm/gc/count", "value": 1},
+            {"feed": "alerts", "service": "druid/broker", "severity": "alert",
+             "description": "Something happened"},
+        ]
+        with mock.patch('druid_exporter.decoding.loads') as loads:
+            self.collector.register_payload(json.dumps(datapoints).encode())
+        loads.assert_not_called()
+        self.assertEqual(self.collector.datapoints_dropped['unknown_metric'], 1)
+        self.assertEqual(self.collector.datapoints_dropped['unsupported_feed'], 1)
+        self.assertIn('druid_exporter_payloads_skipped_total 1.0',
+                      self.collector.generate_latest().decode())
+
+        # A single supported datapoint makes the whole payload decoded.
+        self.collector.register_payload(json.dumps(datapoints + [DATAPOINTS[0]]).encode())
+        time.sleep(0.1)
+        self.assertEqual(self.collector.datapoints_registered, 1)
+        self.assertEqual(self.collector.datapoints_dropped['unknown_metric'], 2)
+        self.assertEqual(self.collector.payloads_skipped, 1)
+
+    def test_register_datapoints_batch(self):
+        """A batch of datapoints should be filtered and enqueued as one item."""
+        datapoints = [
+            {"feed": "metrics", "service": "druid/broker",
+             "metric": "query/cache/total/numEntries", "value": 1},
+            {"feed": "alerts", "service": "druid/broker",
+             "severity": "component-failure", "description": "test"},
+            {"feed": "metrics", "service": "druid/broker",
+             "metric": "segment/scan/pending", "value": 0},
+            {"feed": "metrics", "service": "druid/historical", "dataSource": "test",
+             "metric": "query/time", "value": 42},
+        ]
+        # Stop the processing thread to be able to inspect the queue.
+        self.collector.stop_running_threads()
+        time.sleep(0.1)
+
+        self.collector.register_datapoints(datapoints)
+        self.assertEqual(self.collector.datapoints_queue.qsize(), 1)
+        batch = self.collector.dequeue_batch()
+        self.assertEqual([datapoint for _, datapoint in batch],
+                         [datapoints[0], datapoints[3]])
+
+        self.collector.process_datapoints_batch(batch)
+        self.assertEqual(self.collector.datapoints_registered, 2)
+        self.assertEqual(self.collector.counters['query/cache/total/numEntries'],
+                         {'broker': {(): 1.0}})
+        stats = self.collector.exporter_stats()
+        self.assertEqual(stats['datapoints_dropped'],
+                         {'unsupported_feed': 1, 'unknown_metric': 1})
+        self.assertEqual(stats['datapoints_ingested'],
+                         {('broker', 'query/cache/total/numEntries'): 1,
+                          ('historical', 'query/time'): 1})
+
+    def test_exposition_cache(self):
+        """Only the metric families modified since the last scrape should be
+           rendered again.
+        """
+        self.register_datapoint(
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'query/time', 'value': 42})
+        self.register_datapoint(
+            {'feed': 'metrics', 'service': 'druid/broker',
+             'metric': 'query/cache/total/numEntries', 'value': 5})
+        output = self.collector.generate_latest().decode()
+        self.assertIn('druid_historical_query_time_ms_sum{datasource="test"} 42.0', output)
+        self.assertIn('druid_broker_query_cache_numentries_count 5.0', output)
+        self.assertIn('druid_exporter_datapoints_registered_total 2.0', output)
+        histogram_family = self.collector.families_cache[('historical', 'query/time')]
+        gauge_family = self.collector.families_cache[('broker', 'query/cache/total/numEntries')]
+
+        self.register_datapoint(
+            {'feed': 'metrics', 'service': 'druid/broker',
+             'metric': 'query/cache/total/numEntries', 'value': 6})
+        output = self.collector.generate_latest().decode()
+        self.assertIn('druid_broker_query_cache_numentries_count 6.0', output)
+        self.assertIs(self.collector.families_cache[('historical', 'query/time')],
+                      histogram_family)
+        self.assertIsNot(
+            self.collector.families_cache[('broker', 'query/cache/total/numEntries')],
+            gauge_family)
+
+        # With a max staleness, modified families are served from the cache
+        # until it expires.
+        self.collector.scrape_cache_max_staleness = 3600
+        self.register_datapoint(
+            {'feed': 'metrics', 'service': 'druid/broker',
+             'metric': 'query/cache/total/numEntries', 'value': 7})
+        output = self.collector.generate_latest().decode()
+        self.assertIn('druid_broker_query_cache_numentries_count 6.0', output)
+        self.collector.scrape_cache_max_staleness = 0
+        output = self.collector.generate_latest().decode()
+        self.assertIn('druid_broker_query_cache_numentries_count 7.0', output)
+
+    def test_expire_stale_series(self):
+        """Series not updated for longer than their TTL should be dropped."""
+        metrics_config = copy.deepcopy(self.collector.metrics_config)
+        metrics_config['historical']['segment/used']['ttl'] = 10
+        collector = self.make_collector(metrics_config, series_ttl=60)
+        self.assertEqual(collector.metrics_plan[('historical', 'segment/used')].ttl, 10)
+        self.assertEqual(collector.metrics_plan[('historical', 'query/time')].ttl, 60)
+
+        collector.register_datapoints([
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'segment/used', 'tier': '_default_tier', 'value': 42},
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'query/time', 'value': 42},
+        ])
+        time.sleep(0.1)
+        self.assertIn('druid_historical_segment_used',
+                      collector.generate_latest().decode())
+
+        now = time.monotonic()
+        self.assertEqual(collector.expire_stale_series_once(now), 0)
+        self.assertEqual(collector.expire_stale_series_once(now + 30), 1)
+        self.assertEqual(collector.counters['segment/used'], {'historical': {}})
+        self.assertEqual(len(collector.histograms['query/time']['historical']), 1)
+        output = collector.generate_latest().decode()
+        self.assertNotIn('druid_historical_segment_used', output)
+        self.assertIn('druid_historical_query_time_ms', output)
+
+        self.assertEqual(collector.expire_stale_series_once(now + 61), 1)
+        self.assertNotIn('druid_historical_query_time_ms',
+                         collector.generate_latest().decode())
+
+    def test_series_budgets(self):
+        """Datapoints creating series beyond the configured budgets should be
+           dropped or folded into the overflow series, and accounted.
+        """
+        metrics_config = copy.deepcopy(self.collector.metrics_config)
+        metrics_config['historical']['query/time']['max_series'] = 1
+        metrics_config['historical']['query/time']['overflow'] = 'fold'
+        metrics_config['historical']['query/cache/total/evictions']['max_series'] = 1
+        collector = self.make_collector(metrics_config, max_series=3)
+
+        collector.register_datapoints([
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': datasource,
+             'metric': metric, 'value': 10}
+            for datasource in ('test1', 'test2', 'test3')
+            for metric in ('query/time', 'query/cache/total/evictions')])
+        time.sleep(0.1)
+
+        self.assertEqual(collector.counters['query/cache/total/evictions'],
+                         {'historical': {('test1',): 10.0}})
+        series = self.histogram_dicts(collector)['query/time']['historical']
+        self.assertEqual(list(series.keys()), [('test1',), ('__overflow__',)])
+        self.assertEqual(series[('__overflow__',)]['sum'], 20.0)
+        self.assertEqual(series[('__overflow__',)]['inf'], 2)
+        self.assertEqual(collector.series_count, 3)
+
+        # The global budget is exhausted, so new series of other metrics
+        # are dropped too.
+        collector.register_datapoint(
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'segment/used', 'tier': '_default_tier', 'value': 42})
+        time.sleep(0.1)
+        self.assertEqual(collector.counters['segment/used'], {'historical': {}})
+
+        output = collector.generate_latest().decode()
+        self.assertIn('druid_exporter_series_dropped_total{daemon="historical",'
+                      'metric="query/time"} 2.0', output)
+        self.assertIn('druid_exporter_series_dropped_total{daemon="historical",'
+                      'metric="query/cache/total/evictions"} 2.0', output)
+        self.assertIn('druid_exporter_series_dropped_total{daemon="historical",'
+                      'metric="segment/used"} 1.0', output)
+
+    def test_reload_metrics_config(self):
+        """Reloading the config should keep the series of the metrics not
+           changed (or changed without affecting their storage), and drop the
+           other ones.
+        """
+        collector = self.make_collector(copy.deepcopy(self.collector.metrics_config))
+        collector.register_datapoints(copy.deepcopy(DATAPOINTS))
+        time.sleep(0.1)
+        collector.generate_latest()
+        series_count = collector.series_count
+        old_plan = collector.metrics_plan
+
+        metrics_config = copy.deepcopy(collector.metrics_config)
+        historical = metrics_config['historical']
+        historical['query/time']['buckets'] = ['10', '100', 'inf', 'sum']
+        historical['segment/used']['description'] = 'Bytes used by the segments.'
+        historical['segment/used']['ttl'] = 10
+        del historical['segment/count']
+        historical['segment/max'] = {
+            'prometheus_metric_name': 'druid_historical_segment_max',
+            'type': 'gauge', 'labels': [], 'description': 'Maximum bytes.'}
+        check_metrics_config_file_consistency(metrics_config)
+        collector.reload_metrics_config(metrics_config)
+
+        plan = collector.metrics_plan
+        self.assertIs(plan[('broker', 'query/time')], old_plan[('broker', 'query/time')])
+        self.assertFalse(old_plan[('broker', 'query/time')].retired)
+        for family_key in (('historical', 'query/time'), ('historical', 'segment/used'),
+                           ('historical', 'segment/count')):
+            self.assertTrue(old_plan[family_key].retired)
+        self.assertNotIn(('historical', 'segment/count'), plan)
+
+        self.assertNotIn('historical', collector.histograms['query/time'])
+        self.assertEqual(len(collector.histograms['query/time']['broker']), 1)
+        self.assertEqual(list(collector.counters['segment/count']), ['coordinator'])
+        self.assertEqual(len(collector.counters['segment/used']['historical']), 1)
+        self.assertEqual(len(collector.series_last_update[('historical', 'segment/used')]), 1)
+        self.assertEqual(collector.series_count, series_count - 2)
+        self.assertIsNotNone(collector.sweeper_thread)
+
+        output = collector.generate_latest().decode()
+        self.assertIn('druid_broker_query_time_ms_bucket', output)
+        self.assertNotIn('druid_historical_query_time_ms_bucket', output)
+        self.assertNotIn('druid_historical_segment_count', output)
+        self.assertIn('# HELP druid_historical_segment_used Bytes used by the segments.', output)
+
+        collector.register_datapoints([
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'query/time', 'value': 42},
+            {'feed': 'metrics', 'service': 'druid/historical',
+             'metric': 'segment/max', 'value': 100}])
+        time.sleep(0.1)
+        self.assertEqual(
+            self.histogram_dicts(collector)['query/time']['historical'][('test',)],
+            {'10': 0, '100': 1, 'inf': 1, 'sum': 42.0})
+        self.assertIn('druid_historical_segment_max 100.0', collector.generate_latest().decode())
+
+    def test_reload_metrics_config_queued_datapoints(self):
+        """The datapoints queued before a reload should be stored following
+           the new config, or dropped if their metric was removed.
+        """
+        collector = self.make_stopped_collector()
+        collector.register_datapoints([
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'query/time', 'value': 42},
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'segment/count', 'tier': '_default_tier', 'value': 1}])
+        metrics_config = copy.deepcopy(collector.metrics_config)
+        metrics_config['historical']['query/time']['type'] = 'summary'
+        del metrics_config['historical']['query/time']['buckets']
+        del metrics_config['historical']['segment/count']
+        collector.reload_metrics_config(metrics_config)
+
+        collector.process_datapoints_batch(collector.dequeue_batch())
+        summary = collector.histograms['query/time']['historical'][('test',)]
+        self.assertEqual((summary.count, summary.sum), (1, 42.0))
+        self.assertNotIn('segment/count', collector.counters)
+        self.assertEqual(collector.datapoints_dropped['unknown_metric'], 1)
+
+    def test_host_liveness(self):
+        """The series last updated by a host not emitting for longer than the
+           liveness window should be dropped, and the hosts accounted.
+        """
+        collector = self.make_collector(host_liveness_window=60)
+        self.assertIsNotNone(collector.sweeper_thread)
+        datapoint = {'feed': 'metrics', 'service': 'druid/coordinator',
+                     'metric': 'segment/count', 'value': 10}
+        collector.register_datapoints([
+            dict(datapoint, host='coordinator1:8081', dataSource='test1'),
+            dict(datapoint, host='coordinator1:8081', dataSource='test2'),
+            dict(datapoint, host='coordinator1:8081', metric='segment/assigned/count',
+                 tier='_default_tier'),
+            {'feed': 'metrics', 'service': 'druid/broker', 'host': 'broker1:8082',
+             'metric': 'query/time', 'dataSource': 'test1', 'value': 42},
+        ])
+        time.sleep(0.1)
+        # The new leader takes over one of the series.
+        collector.register_datapoint(dict(datapoint, host='coordinator2:8081',
+                                          dataSource='test2'))
+        time.sleep(0.1)
+
+        output = collector.generate_latest().decode()
+        self.assertIn('druid_exporter_host_datapoints_total{daemon="coordinator",'
+                      'host="coordinator1:8081"} 3.0', output)
+        self.assertIn('druid_exporter_host_last_seen_timestamp_seconds{daemon="broker",'
+                      'host="broker1:8082"}', output)
+
+        now = time.monotonic()
+        self.assertEqual(collector.expire_stale_hosts_once(now), 0)
+        collector.host_last_seen[('coordinator', 'coordinator2:8081')] = now + 60
+        collector.host_last_seen[('broker', 'broker1:8082')] = now + 60
+        self.assertEqual(collector.expire_stale_hosts_once(now + 61), 2)
+        self.assertEqual(dict(collector.counters['segment/count']['coordinator']),
+                         {('test2',): 10.0})
+        self.assertEqual(len(collector.counters['segment/assigned/count']['coordinator']), 0)
+        self.assertEqual(len(collector.histograms['query/time']['broker']), 1)
+        self.assertEqual(collector.series_count, 2)
+        output = collector.generate_latest().decode()
+        self.assertNotIn('host="coordinator1:8081"', output)
+        self.assertNotIn('druid_coordinator_segment_assigned_count', output)
+
+    def test_queue_overflow_policies(self):
+        """A bounded queue should apply the configured overflow policy."""
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+             'metric': 'query/time', 'value': value}
+            for value in range(10)]
+
+        collector = self.make_stopped_collector(queue_size=15, queue_overflow='reject')
+        collector.register_stream(io.BytesIO(json.dumps(datapoints).encode()).read)
+        collector.register_stream(io.BytesIO(json.dumps(datapoints).encode()).read)
+        with self.assertRaises(QueueFullError):
+            collector.register_stream(io.BytesIO(json.dumps(datapoints).encode()).read)
+        stats = collector.exporter_stats()
+        self.assertEqual(stats['queue_datapoints'], 20)
+        self.assertEqual(stats['payloads_rejected'], 1)
+        collector.process_datapoints_batch(collector.dequeue_batch())
+        self.assertEqual(collector.exporter_stats()['queue_datapoints'], 10)
+        collector.register_datapoints(datapoints)
+        self.assertEqual(collector.exporter_stats()['queue_high_watermark'], 20)
+
+        collector = self.make_stopped_collector(queue_size=15, queue_overflow='drop-oldest')
+        collector.register_datapoints(datapoints[:5])
+        collector.register_datapoints(datapoints[5:])
+        collector.register_datapoints(datapoints)
+        stats = collector.exporter_stats()
+        self.assertEqual(stats['queue_datapoints'], 15)
+        self.assertEqual(stats['datapoints_shed'], {'drop-oldest': 5})
+        self.assertEqual([datapoint['value'] for _, datapoint in collector.dequeue_batch()],
+                         list(range(5, 10)))
+
+        collector = self.make_stopped_collector(queue_size=15, queue_overflow='sample')
+        collector.register_datapoints(datapoints)
+        collector.register_datapoints(datapoints)
+        collector.register_datapoints(datapoints)
+        stats = collector.exporter_stats()
+        self.assertEqual(stats['queue_datapoints'], 15)
+        self.assertEqual(stats['datapoints_shed'], {'sample': 15})
+        collector.dequeue_batch()
+        self.assertEqual([datapoint['value'] for _, datapoint in collector.dequeue_batch()],
+                         [0, 2, 4, 6, 8])
+
+        output = collector.generate_latest().decode()
+        self.assertIn('druid_exporter_queue_datapoints 0.0', output)
+        self.assertIn('druid_exporter_queue_high_watermark_datapoints 15.0', output)
+        self.assertIn('druid_exporter_datapoints_shed_total{policy="sample"} 15.0', output)
+
+    def test_register_truncated_stream(self):
+        """A truncated payload (for example a POST whose connection dropped)
+           should not register any of its datapoints, so that it can be sent
+           again by the emitter without counting them twice.
+        """
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+             'metric': 'query/time', 'value': value}
+            for value in range(3000)]
+        datapoints.append({'feed': 'alerts', 'service': 'druid/broker'})
+        payload = json.dumps(datapoints).encode()
+        collector = self.make_stopped_collector()
+        with mock.patch('druid_exporter.decoding.STREAM_DECODING_THRESHOLD', 1024):
+            with self.assertRaises(ValueError):
+                collector.register_stream(io.BytesIO(payload[:len(payload) // 2]).read,
+                                          length=len(payload))
+            stats = collector.exporter_stats()
+            self.assertEqual(stats['queue_datapoints'], 0)
+            self.assertEqual(stats['datapoints_dropped'], {'decode_error': 1})
+
+            collector.register_stream(io.BytesIO(payload).read, length=len(payload))
+        while collector.exporter_stats()['queue_datapoints']:
+            collector.process_datapoints_batch(collector.dequeue_batch())
+        stats = collector.exporter_stats()
+        self.assertEqual(stats['datapoints_registered'], 3000)
+        self.assertEqual(stats['datapoints_dropped']['decode_error'], 1)
+        self.assertEqual(stats['datapoints_dropped']['unsupported_feed'], 1)
+        output = collector.generate_latest().decode()
+        self.assertIn('druid_broker_query_time_ms_count{datasource="test"} 3000.0', output)
+
+    def test_register_stream_order(self):
+        """The batches of a streamed payload should be enqueued in order, so
+           that the last value of a gauge wins.
+        """
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'segment/count', 'tier': '_default_tier', 'value': value}
+            for value in range(2500)]
+        payload = json.dumps(datapoints).encode()
+        collector = self.make_stopped_collector()
+        with mock.patch('druid_exporter.decoding.STREAM_DECODING_THRESHOLD', 1024):
+            collector.register_stream(io.BytesIO(payload).read, length=len(payload))
+        while collector.exporter_stats()['queue_datapoints']:
+            collector.process_datapoints_batch(collector.dequeue_batch())
+        self.assertIn('druid_historical_segment_count{datasource="test",tier="_default_tier"} '
+                      '2499.0', collector.generate_latest().decode())
+
+    def test_register_stream_too_large(self):
+        """The payloads bigger than max_payload_size should be refused, without
+           registering any of their datapoints.
+        """
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+             'metric': 'query/time', 'value': value}
+            for value in range(3000)]
+        payload = json.dumps(datapoints).encode()
+        collector = self.make_stopped_collector(max_payload_size=len(payload) - 1)
+        with mock.patch('druid_exporter.decoding.STREAM_DECODING_THRESHOLD', 1024):
+            for length in (len(payload), None):
+                with self.assertRaises(decoding.PayloadTooLargeError):
+                    collector.register_stream(io.BytesIO(payload).read, length=length)
+        stats = collector.exporter_stats()
+        self.assertEqual(stats['queue_datapoints'], 0)
+        self.assertNotIn('decode_error', stats['datapoints_dropped'])
+
+    def test_exporter_self_metrics(self):
+        """The exporter should report the time spent in each stage of the
+           pipeline and the datapoints dropped by reason.
+        """
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'query/time', 'value': 42},
+            # Missing label "tier"
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'metric': 'segment/used', 'value': 42},
+        ]
+        self.collector.register_stream(io.BytesIO(json.dumps(datapoints).encode()).read)
+        with self.assertRaises(ValueError):
+            self.collector.register_payload(b'[{"feed": ')
+        time.sleep(0.1)
+
+        self.collector.generate_latest()
+        output = self.collector.generate_latest().decode()
+        for stage in ('read', 'decode', 'queue_wait', 'process', 'render'):
+            self.assertIn('druid_exporter_stage_duration_seconds_count{{stage="{}"}}'
+                          .format(stage), output)
+        self.assertIn('druid_exporter_datapoints_ingested_total{daemon="historical",'
+                      'metric="query/time"} 1.0', output)
+        self.assertIn('druid_exporter_datapoints_dropped_total{reason="missing_label"} 1.0',
+                      output)
+        self.assertIn('druid_exporter_datapoints_dropped_total{reason="decode_error"} 1.0',
+                      output)
+        self.assertIn('druid_exporter_queue_oldest_batch_age_seconds 0.0', output)
+
+    def test_kafka_records_batch(self):
+        """The messages of a Kafka poll should be registered as a single
+           batch, and the lag of the assigned partitions reported.
+        """
+        TopicPartition = namedtuple('TopicPartition', ['topic', 'partition'])
+        ConsumerRecord = namedtuple('ConsumerRecord', ['offset', 'value'])
+
+        class FakeConsumer(object):
+            def __init__(self, highwaters, positions):
+                self.highwaters = highwaters
+                self.positions = positions
+
+            def assignment(self):
+                return set(self.highwaters)
+
+            def highwater(self, partition):
+                return self.highwaters[partition]
+
+            def position(self, partition):
+                return self.positions[partition]
+
+        partitions = [TopicPartition('druid', index) for index in range(3)]
+        records = {
+            partitions[0]: [ConsumerRecord(0, json.dumps(DATAPOINTS[0]).encode()),
+                            ConsumerRecord(1, b'{"feed": ')],
+            partitions[1]: [ConsumerRecord(0, json.dumps(DATAPOINTS[1:3]).encode())],
+        }
+        self.collector.stop_running_threads()
+        time.sleep(0.1)
+
+        self.collector.register_kafka_records(records)
+        self.assertEqual(self.collector.datapoints_queue.qsize(), 1)
+        batch = self.collector.dequeue_batch()
+        self.assertEqual([datapoint for _, datapoint in batch], DATAPOINTS[:3])
+        self.assertEqual(self.collector.exporter_stats()['datapoints_dropped'],
+                         {'decode_error': 1})
+
+        consumer = FakeConsumer({partitions[0]: 10, partitions[1]: 5, partitions[2]: None},
+                                {partitions[0]: 2, partitions[1]: 5})
+        assignment = self.collector.update_kafka_consumer_lag(consumer, set())
+        self.assertEqual(self.collector.exporter_stats()['kafka_consumer_lag'],
+                         {('druid', 0): 8, ('druid', 1): 0})
+        output = self.collector.generate_latest().decode()
+        self.assertIn('druid_exporter_kafka_consumer_lag{partition="0",topic="druid"} 8.0',
+                      output)
+
+        # After a rebalance, the lag of the revoked partitions is removed.
+        consumer = FakeConsumer({partitions[1]: 7}, {partitions[1]: 6})
+        self.collector.update_kafka_consumer_lag(consumer, assignment)
+        self.assertEqual(self.collector.exporter_stats()['kafka_consumer_lag'],
+                         {('druid', 1): 1})
+
+    def test_store_histograms_batch(self):
+        """Grouping the samples of a batch by series should give the same
+           histograms as storing the datapoints one at a time.
+        """
+        values = [0, 5, 10, 10.5, 99, 100, 101, 4999, 7000, 12000, float('nan')] * 10
+        batch = []
+        for index, value in enumerate(values):
+            batch.append({'feed': 'metrics', 'service': 'druid/broker',
+                          'dataSource': 'test{}'.format(index % 3),
+                          'metric': ('query/time', 'query/bytes')[index % 2],
+                          'value': value})
+        # Missing label "dataSource"
+        batch.append({'feed': 'metrics', 'service': 'druid/broker',
+                      'metric': 'query/time', 'value': 1})
+
+        batch_collector = self.make_stopped_collector()
+        batch_collector.process_datapoints_batch(
+            [(batch_collector.get_metric_plan(datapoint), datapoint) for datapoint in batch])
+        single_collector = self.make_stopped_collector()
+        for datapoint in batch:
+            single_collector.store_histogram(datapoint)
+
+        # NaN != NaN, so the sums are compared separately.
+        batch_histograms, single_histograms = {}, {}
+        for collector, copy_to in ((batch_collector, batch_histograms),
+                                   (single_collector, single_histograms)):
+            for metric_name, daemons in self.histogram_dicts(collector).items():
+                for label_values, buckets in daemons['broker'].items():
+                    buckets['sum'] = str(buckets['sum'])
+                    copy_to[(metric_name, label_values)] = buckets
+        self.assertEqual(batch_histograms, single_histograms)
+        self.assertEqual(len(batch_histograms), 6)
+        self.assertEqual(batch_collector.exporter_stats()['datapoints_ingested'],
+                         single_collector.exporter_stats()['datapoints_ingested'])
+        self.assertEqual(batch_collector.exporter_stats()['datapoints_dropped'],
+                         {'missing_label': 1})
+
+    def test_bin_histogram_samples(self):
+        """Both the bisect and the NumPy binning should count, for every bucket,
+           the samples lower or equal to its upper bound.
+        """
+        bucket_bounds = (10.0, 100.0, 1000.0, float('inf'))
+        values = [-1, 10, 10.1, 100, 999, 1000, 1e9, float('inf'), float('nan')] * 10
+        expected = [sum(1 for value in values if value <= upper_bound)
+                    for upper_bound in bucket_bounds]
+        self.assertEqual(bin_histogram_samples(bucket_bounds, values), expected)
+        with mock.patch('druid_exporter.collector.numpy', None):
+            self.assertEqual(bin_histogram_samples(bucket_bounds, values), expected)
+        self.assertEqual(bin_histogram_samples(bucket_bounds, values[:1]), [1, 1, 1, 1])
+
+    def test_store_exponential_histogram(self):
+        """Exponential histograms should keep only the populated buckets, and
+           be exported with classic buckets in the text format.
+        """
+        metrics_config = {
+            'broker': {
+                "query/time": {
+                    "prometheus_metric_name": "druid_broker_query_time_ms",
+                    "type": "exponential_histogram",
+                    "schema": 0,
+                    "labels": ["dataSource"],
+                    "description": "Milliseconds taken to complete a query."
+                },
+            },
+        }
+        check_metrics_config_file_consistency(metrics_config)
+        collector = self.make_stopped_collector(metrics_config=metrics_config)
+        batch = [{'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+                  'metric': 'query/time', 'value': value} for value in (3, 4, 1000)]
+        collector.process_datapoints_batch(
+            [(collector.get_metric_plan(datapoint), datapoint) for datapoint in batch])
+        collector.store_histogram(batch[0])
+
+        histogram = collector.histograms['query/time']['broker'][('test',)]
+        self.assertEqual(histogram.positive, {2: 3, 10: 1})
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 1010)
+        self.assertEqual(collector.exporter_stats()['datapoints_ingested'],
+                         {('broker', 'query/time'): 4})
+
+        output = collector.generate_latest().decode()
+        self.assertIn('druid_broker_query_time_ms_bucket{datasource="test",le="4.0"} 3.0',
+                      output)
+        self.assertIn('druid_broker_query_time_ms_bucket{datasource="test",le="1024.0"} 4.0',
+                      output)
+        self.assertIn('druid_broker_query_time_ms_count{datasource="test"} 4.0', output)
+
+    def test_store_summary(self):
+        """Summaries should export the configured quantiles of their series,
+           refreshed at every scrape.
+        """
+        metrics_config = {
+            'broker': {
+                "query/node/ttfb": {
+                    "prometheus_metric_name": "druid_broker_query_node_ttfb_ms",
+                    "type": "summary",
+                    "quantiles": [0.5, 0.99],
+                    "max_age": 60,
+                    "labels": ["dataSource"],
+                    "description": "Time to first byte."
+                },
+            },
+        }
+        check_metrics_config_file_consistency(metrics_config)
+        collector = self.make_stopped_collector(metrics_config=metrics_config)
+        batch = [{'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+                  'metric': 'query/node/ttfb', 'value': value} for value in range(1, 101)]
+        collector.process_datapoints_batch(
+            [(collector.get_metric_plan(datapoint), datapoint) for datapoint in batch])
+
+        families = {family.name: family for family in collector.collect()}
+        samples = {(sample.name, sample.labels.get('quantile')): sample.value
+                   for sample in families['druid_broker_query_node_ttfb_ms'].samples}
+        self.assertAlmostEqual(samples[('druid_broker_query_node_ttfb_ms', '0.5')], 50, delta=1)
+        self.assertAlmostEqual(samples[('druid_broker_query_node_ttfb_ms', '0.99')], 99, delta=1)
+        self.assertEqual(samples[('druid_broker_query_node_ttfb_ms_count', None)], 100)
+        self.assertEqual(samples[('druid_broker_query_node_ttfb_ms_sum', None)], 5050)
+
+        # The quantiles are recomputed even if no datapoint was received.
+        summary = collector.histograms['query/node/ttfb']['broker'][('test',)]
+        summary.rotated_at -= 120
+        output = collector.generate_latest().decode()
+        self.assertIn('druid_broker_query_node_ttfb_ms{datasource="test",quantile="0.5"} NaN',
+                      output)
+        self.assertIn('druid_broker_query_node_ttfb_ms_count{datasource="test"} 100.0', output)
+
+    def test_relabel(self):
+        """The relabel rules should rewrite the label values of the datapoints,
+           drop the ones not allowed and merge the series differing only by a
+           dropped label, summing gauges (expiring the values merged with the
+           TTL) and aggregating histograms.
+        """
+        metrics_config = {
+            'peon': {
+                "ingest/events/processed": {
+                    "prometheus_metric_name": "druid_realtime_ingest_events_processed_count",
+                    "type": "gauge",
+                    "labels": ["dataSource", "taskId"],
+                    "relabel": [
+                        {"label": "dataSource", "action": "drop", "values": ["test"]},
+                        {"label": "taskId", "action": "labeldrop", "aggregation": "sum"}
+                    ],
+                    "description": "Number of events successfully processed per emission period.",
+                    "ttl": 600
+                },
+                "ingest/events/thrownAway": {
+                    "prometheus_metric_name": "druid_realtime_ingest_events_thrownaway_count",
+                    "type": "gauge",
+                    "labels": ["dataSource", "taskId"],
+                    "relabel": [
+                        {"label": "taskId", "action": "labeldrop"}
+                    ],
+                    "description": "Number of events rejected because they are outside the windowPeriod."
+                },
+                "ingest/persists/time": {
+                    "prometheus_metric_name": "druid_realtime_ingest_persists_time_ms",
+                    "type": "histogram",
+                    "buckets": ["10", "100", "inf", "sum"],
+                    "labels": ["taskId"],
+                    "relabel": [
+                        {"label": "taskId", "action": "replace",
+                         "regex": "index_([a-z]+)_.*", "replacement": "\\1"}
+                    ],
+                    "description": "Milliseconds spent doing intermediate persist."
+                },
+            },
+        }
+        check_metrics_config_file_consistency(metrics_config)
+        # Summing the merged series requires a TTL to expire their values.
+        wrong_config = copy.deepcopy(metrics_config)
+        del wrong_config['peon']['ingest/events/processed']['ttl']
+        with self.assertRaises(RuntimeError):
+            check_metrics_config_file_consistency(wrong_config)
+        collector = self.make_stopped_collector(metrics_config=metrics_config)
+
+        def datapoint(metric, value, data_source, task_id):
+            return {'feed': 'metrics', 'service': 'druid/peon', 'host': 'druid1001:8200',
+                    'metric': metric, 'value': value, 'dataSource': data_source,
+                    'taskId': [task_id]}
+
+        batch = [
+            datapoint('ingest/events/processed', 10, 'wikidata', 'index_kafka_wikidata_1'),
+            datapoint('ingest/events/processed', 20, 'wikidata', 'index_kafka_wikidata_2'),
+            datapoint('ingest/events/processed', 15, 'wikidata', 'index_kafka_wikidata_1'),
+            datapoint('ingest/events/processed', 99, 'test', 'index_kafka_test_1'),
+            datapoint('ingest/persists/time', 5, 'wikidata', 'index_kafka_wikidata_1'),
+            datapoint('ingest/persists/time', 50, 'wikidata', 'index_kafka_wikidata_2'),
+            datapoint('ingest/persists/time', 500, 'test', 'index_hadoop_test_1'),
+            datapoint('ingest/events/thrownAway', 3, 'wikidata', 'index_kafka_wikidata_1'),
+            datapoint('ingest/events/thrownAway', 4, 'wikidata', 'index_kafka_wikidata_2'),
+            {'feed': 'metrics', 'service': 'druid/peon', 'metric': 'ingest/events/processed',
+             'value': 1, 'dataSource': 'wikidata'},
+        ]
+        collector.process_datapoints_batch(
+            [(collector.get_metric_plan(datapoint), datapoint) for datapoint in batch])
+
+        self.assertEqual(dict(collector.counters['ingest/events/processed']['peon']),
+                         {('wikidata',): 35.0})
+        # Gauges keep the last value of the merged series by default.
+        self.assertEqual(dict(collector.counters['ingest/events/thrownAway']['peon']),
+                         {('wikidata',): 4.0})
+        self.assertEqual(collector.series_count, 4)
+        self.assertEqual(collector.exporter_stats()['datapoints_dropped'],
+                         {'relabel': 1, 'missing_label': 1})
+        output = collector.generate_latest().decode()
+        self.assertIn('druid_realtime_ingest_events_processed_count{datasource="wikidata"} 35.0',
+                      output)
+        self.assertIn('druid_realtime_ingest_persists_time_ms_count{taskid="kafka"} 2.0', output)
+        self.assertIn('druid_realtime_ingest_persists_time_ms_sum{taskid="hadoop"} 500.0',
+                      output)
+
+        # The value of the task that stopped emitting is removed from the sum.
+        plan = collector.get_metric_plan(batch[0])
+        merged_values = collector.merged_series[plan.key][('wikidata',)][1]
+        merged_values[('index_kafka_wikidata_1',)] = (15.0, time.monotonic() - 700)
+        merged_values.move_to_end(('index_kafka_wikidata_1',), last=False)
+        self.assertEqual(collector.expire_stale_series_once(), 0)
+        self.assertEqual(dict(collector.counters['ingest/events/processed']['peon']),
+                         {('wikidata',): 20.0})
+        self.assertEqual(list(merged_values), [('index_kafka_wikidata_2',)])
+
+        collector.remove_series(plan, ('wikidata',))
+        self.assertEqual(collector.merged_series[plan.key], {})
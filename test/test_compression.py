@@ -0,0 +1,81 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import io
+import unittest
+import zlib
+
+from druid_exporter import compression
+from druid_exporter.compression import (DecompressionError, UnsupportedEncodingError,
+                                        compress, decompressing_reader, negotiate_encoding)
+from unittest import mock
+
+
+def read_everything(read, size=4096):
+    chunks = []
+    chunk = read(size)
+    while chunk:
+        assert len(chunk) <= size
+        chunks.append(chunk)
+        chunk = read(size)
+    return b''.join(chunks)
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_negotiate_encoding(self):
+        with mock.patch('druid_exporter.compression.zstandard', None):
+            self.assertEqual(negotiate_encoding('gzip'), 'gzip')
+            self.assertEqual(negotiate_encoding('zstd'), None)
+            self.assertEqual(negotiate_encoding('*'), 'gzip')
+        self.assertEqual(negotiate_encoding(None), None)
+        self.assertEqual(negotiate_encoding('identity'), None)
+        self.assertEqual(negotiate_encoding('gzip;q=0, deflate'), None)
+        self.assertEqual(negotiate_encoding('deflate, GZIP;q=0.5'), 'gzip')
+
+    def test_gzip_members(self):
+        """Concatenated gzip members should be decompressed as one stream,
+           and every read bounded by its size.
+        """
+        data = b'x' * 100000
+        compressed = compress(data, 'gzip') + compress(b'tail', 'gzip')
+        self.assertEqual(gzip.decompress(compressed), data + b'tail')
+        read = decompressing_reader(io.BytesIO(compressed).read, 'gzip')
+        self.assertEqual(read_everything(read), data + b'tail')
+
+        read = decompressing_reader(io.BytesIO(zlib.compress(data)).read, 'deflate')
+        self.assertEqual(read_everything(read), data)
+        read = decompressing_reader(io.BytesIO(data).read, 'identity')
+        self.assertEqual(read_everything(read), data)
+
+    def test_malformed_payloads(self):
+        compressed = compress(b'[{"feed": "metrics"}]', 'gzip')
+        for payload in (compressed[:10], b'not gzip at all'):
+            read = decompressing_reader(io.BytesIO(payload).read, 'gzip')
+            with self.assertRaises(DecompressionError):
+                read_everything(read)
+        with self.assertRaises(UnsupportedEncodingError):
+            decompressing_reader(io.BytesIO(compressed).read, 'br')
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def test_zstd_frames(self):
+        data = b'y' * 100000
+        compressed = compress(data, 'zstd') + compress(b'tail', 'zstd')
+        read = decompressing_reader(io.BytesIO(compressed).read, 'zstd')
+        self.assertEqual(read_everything(read), data + b'tail')
+        read = decompressing_reader(io.BytesIO(b'not zstd at all').read, 'zstd')
+        with self.assertRaises(DecompressionError):
+            read_everything(read)
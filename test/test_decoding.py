@@ -0,0 +1,157 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+import io
+import json
+import unittest
+
+from druid_exporter import decoding
+from druid_exporter.decoding import bounded_reader, DatapointsStreamDecoder, PayloadFilter
+from test_collector import DATAPOINTS as COLLECTOR_DATAPOINTS
+
+
+DATAPOINTS = [
+    {"feed": "metrics", "service": "druid/broker", "host": "druid1001.eqiad.wmnet:8082",
+     "metric": "query/time", "value": 10, "dataSource": "NavigationTiming",
+     "interval": ["0000-01-01T00:00:00.000Z/3000-01-01T00:00:00.000Z"]},
+    {"feed": "metrics", "service": "druid/historical", "host": "druid1001.eqiad.wmnet:8083",
+     "metric": "segment/count", "value": 41.5, "dataSource": "ünïcödé_€",
+     "tier": "_default_tier"},
+    {"feed": "alerts", "service": "druid/coordinator", "severity": "component-failure",
+     "description": "Something \"bad\" happened, [really]", "data": {}},
+]
+
+
+class TestDatapointsStreamDecoder(unittest.TestCase):
+
+    def decode(self, payload, chunk_size=7, encoding='utf-8'):
+        decoder = DatapointsStreamDecoder(
+            io.BytesIO(payload).read, encoding, chunk_size=chunk_size)
+        return list(decoder)
+
+    def test_decode_array(self):
+        """The decoded datapoints should not depend on the chunk size."""
+        for payload in (json.dumps(DATAPOINTS).encode(),
+                        json.dumps(DATAPOINTS, indent=4, ensure_ascii=False).encode()):
+            for chunk_size in (1, 2, 7, 64, 65536):
+                self.assertEqual(self.decode(payload, chunk_size), DATAPOINTS)
+
+    def test_decode_other_encoding(self):
+        payload = json.dumps(DATAPOINTS, ensure_ascii=False).encode('utf-16')
+        self.assertEqual(self.decode(payload, encoding='utf-16'), DATAPOINTS)
+
+    def test_decode_single_datapoint(self):
+        payload = json.dumps(DATAPOINTS[0]).encode()
+        self.assertEqual(self.decode(payload), [DATAPOINTS[0]])
+
+    def test_decode_empty_array(self):
+        self.assertEqual(self.decode(b' [ ] \n'), [])
+
+    def test_decode_numbers_split_between_chunks(self):
+        self.assertEqual(self.decode(b'[12345678, 1.5e10]', chunk_size=3), [12345678, 1.5e10])
+
+    def test_decode_malformed(self):
+        for payload in (b'', b'[', b'[{"feed": "metrics"', b'[{}, {}', b'[{} {}]',
+                        b'[{}], {}', b'{"feed": }'):
+            with self.assertRaises(ValueError):
+                self.decode(payload)
+
+    def test_malformed_payload_yields_previous_datapoints(self):
+        decoder = iter(DatapointsStreamDecoder(io.BytesIO(b'[{"a": 1}, {"b": ]').read))
+        self.assertEqual(next(decoder), {'a': 1})
+        with self.assertRaises(ValueError):
+            next(decoder)
+
+    def test_bounded_reader(self):
+        read = bounded_reader(io.BytesIO(b'[{}]trailing data'), 4)
+        self.assertEqual(read(3), b'[{}')
+        self.assertEqual(read(3), b']')
+        self.assertEqual(read(3), b'')
+
+
+class TestPayloadFilter(unittest.TestCase):
+
+    def test_dropped_datapoints(self):
+        payload_filter = PayloadFilter(['query/time', 'segment/count'])
+        unsupported = [dict(DATAPOINTS[0], metric='jvm/gc/count'), DATAPOINTS[2]]
+        self.assertEqual(payload_filter.dropped_datapoints(json.dumps(unsupported).encode()),
+                         (1, 1))
+        self.assertEqual(
+            payload_filter.dropped_datapoints(json.dumps(unsupported, indent=2).encode()),
+            (1, 1))
+        self.assertEqual(payload_filter.dropped_datapoints(
+            json.dumps(unsupported[0], separators=(',', ':')).encode()), (0, 1))
+
+        for payload in (
+                json.dumps(DATAPOINTS, ensure_ascii=False).encode(),
+                json.dumps(unsupported + [DATAPOINTS[0]]).encode(),
+                # The escaped name of a supported metric.
+                json.dumps(unsupported).replace('jvm/gc/count', 'query\\/time').encode(),
+                # Truncated or empty payloads, left to the decoder.
+                json.dumps(unsupported).encode()[:-1], b'[]', b''):
+            self.assertIsNone(payload_filter.dropped_datapoints(payload), payload)
+        self.assertIsNone(payload_filter.dropped_datapoints(
+            json.dumps(unsupported).encode('utf-16'), 'utf-16'))
+
+
+class TestJSONBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.available_backends = []
+        for backend in decoding.JSON_BACKENDS:
+            try:
+                importlib.import_module(backend)
+            except ImportError:
+                continue
+            self.available_backends.append(backend)
+        self.default_backend = decoding.json_backend
+
+    def tearDown(self):
+        decoding.set_json_backend(self.default_backend)
+
+    def test_auto_backend(self):
+        self.assertEqual(decoding.get_json_backend()[0], self.available_backends[0])
+        with self.assertRaises(RuntimeError):
+            decoding.get_json_backend('simplejson')
+
+    def test_backends_parity(self):
+        """Every available backend should decode the test fixtures exactly
+           like the stdlib json module (and the stream decoder).
+        """
+        payloads = [
+            (json.dumps(COLLECTOR_DATAPOINTS).encode(), 'utf-8'),
+            (json.dumps(COLLECTOR_DATAPOINTS, indent=2).encode(), 'utf-8'),
+            (json.dumps(DATAPOINTS, ensure_ascii=False).encode(), 'utf-8'),
+            (json.dumps(DATAPOINTS, ensure_ascii=False).encode('latin-1', 'replace'),
+             'latin-1'),
+            (json.dumps(DATAPOINTS[0]).encode(), 'utf-8'),
+        ]
+        for backend in self.available_backends:
+            decoding.set_json_backend(backend)
+            for payload, encoding in payloads:
+                expected = json.loads(payload.decode(encoding))
+                self.assertEqual(decoding.loads(payload, encoding), expected,
+                                 'backend {}'.format(backend))
+                self.assertEqual(
+                    list(DatapointsStreamDecoder(io.BytesIO(payload).read, encoding)),
+                    expected if isinstance(expected, list) else [expected])
+
+    def test_backends_malformed_payload(self):
+        for backend in self.available_backends:
+            decoding.set_json_backend(backend)
+            for payload in (b'', b'[{"feed": "metrics"', b'[{}, {}'):
+                with self.assertRaises(ValueError, msg='backend {}'.format(backend)):
+                    decoding.loads(payload)
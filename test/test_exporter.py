@@ -0,0 +1,187 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from druid_exporter import compression, protobuf
+from druid_exporter.collector import DruidCollector
+from druid_exporter.exporter import DruidWSGIApp, reload_metrics_config_file
+from prometheus_client import CollectorRegistry
+from test_protobuf import decode_delimited
+
+
+METRICS_CONFIG = {
+    'broker': {
+        "query/time": {
+            "prometheus_metric_name": "druid_broker_query_time_ms",
+            "type": "histogram",
+            "buckets": ["10", "100", "1000", "inf", "sum"],
+            "labels": ["dataSource"],
+            "description": "Milliseconds taken to complete a query."
+        },
+    },
+}
+
+
+class TestDruidWSGIApp(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = DruidCollector(METRICS_CONFIG)
+        self.app = DruidWSGIApp('/', self.collector, CollectorRegistry(), 'utf-8')
+
+    def tearDown(self):
+        self.collector.stop_running_threads()
+
+    def request(self, method, path, body=b'', content_type='application/json', accept=None,
+                headers=None):
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_TYPE': content_type,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        }
+        if accept is not None:
+            environ['HTTP_ACCEPT'] = accept
+        for name, value in (headers or {}).items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        response['body'] = b''.join(self.app(environ, start_response))
+        return response
+
+    def test_post_datapoints(self):
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+             'metric': 'query/time', 'value': value}
+            for value in (5, 50, 500)]
+        response = self.request('POST', '/', json.dumps(datapoints).encode())
+        self.assertEqual(response['status'], '200 OK')
+        time.sleep(0.1)
+        self.assertEqual(self.collector.datapoints_registered, 3)
+
+        response = self.request('GET', '/metrics')
+        self.assertEqual(response['status'], '200 OK')
+        self.assertIn(b'druid_broker_query_time_ms_sum{datasource="test"} 555.0',
+                      response['body'])
+
+    def test_get_metrics_protobuf(self):
+        """Scrapers supporting the protobuf format should get it."""
+        self.collector.register_datapoint(
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+             'metric': 'query/time', 'value': 5})
+        time.sleep(0.1)
+        response = self.request(
+            'GET', '/metrics',
+            accept='application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;'
+                   'encoding=delimited;q=0.8,text/plain;version=0.0.4;q=0.6')
+        self.assertEqual(response['status'], '200 OK')
+        self.assertEqual(response['headers']['Content-Type'], protobuf.CONTENT_TYPE)
+        families = decode_delimited(response['body'])
+        self.assertEqual(families['druid_broker_query_time_ms'][0], protobuf.HISTOGRAM)
+        self.assertIn('druid_exporter_datapoints_registered_total', families)
+
+    def test_post_compressed_datapoints(self):
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+             'metric': 'query/time', 'value': value}
+            for value in (5, 50, 500)]
+        body = gzip.compress(json.dumps(datapoints).encode())
+        response = self.request('POST', '/', body, headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response['status'], '200 OK')
+        response = self.request('POST', '/', body[:20], headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response['status'], '400 Bad Request')
+        response = self.request('POST', '/', body, headers={'Content-Encoding': 'br'})
+        self.assertEqual(response['status'], '415 Unsupported Media Type')
+        time.sleep(0.1)
+        self.assertEqual(self.collector.datapoints_registered, 3)
+
+    def test_get_metrics_compressed(self):
+        """The output should be compressed if the scraper supports it,
+           reusing the compressed families not modified.
+        """
+        self.collector.register_datapoint(
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+             'metric': 'query/time', 'value': 5})
+        time.sleep(0.1)
+        response = self.request('GET', '/metrics', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response['status'], '200 OK')
+        self.assertEqual(response['headers']['Content-Encoding'], 'gzip')
+        output = gzip.decompress(response['body'])
+        self.assertIn(b'druid_broker_query_time_ms_sum{datasource="test"} 5.0', output)
+        self.assertIn(b'druid_exporter_datapoints_registered_total', output)
+
+        family = compression.compress(
+            self.collector.families_cache[('broker', 'query/time')].text(), 'gzip')
+        response = self.request('GET', '/metrics', headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(response['body'].startswith(family))
+        self.assertNotIn('Content-Encoding', self.request('GET', '/metrics')['headers'])
+
+    def test_post_malformed_datapoints(self):
+        response = self.request('POST', '/', b'[{"feed": "metrics", ')
+        self.assertEqual(response['status'], '400 Bad Request')
+
+    def test_post_datapoints_queue_full(self):
+        """A full queue should make the exporter reply with a 503, so that
+           the emitter retries later.
+        """
+        collector = DruidCollector(METRICS_CONFIG, queue_size=1)
+        collector.stop_running_threads()
+        time.sleep(0.1)
+        self.app.druid_collector = collector
+        datapoints = [{'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test',
+                       'metric': 'query/time', 'value': 5}]
+        response = self.request('POST', '/', json.dumps(datapoints).encode())
+        self.assertEqual(response['status'], '200 OK')
+        response = self.request('POST', '/', json.dumps(datapoints).encode())
+        self.assertEqual(response['status'], '503 Service Unavailable')
+
+    def test_unsupported_requests(self):
+        self.assertEqual(self.request('POST', '/', b'[]', 'text/plain')['status'],
+                         '400 Bad Request')
+        self.assertEqual(self.request('POST', '/other', b'[]')['status'],
+                         '400 Bad Request')
+        self.assertEqual(self.request('GET', '/')['status'], '400 Bad Request')
+
+    def test_reload_metrics_config_file(self):
+        """An invalid config file should be ignored, keeping the current config."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'config.json')
+            self.assertFalse(reload_metrics_config_file(path, self.collector))
+
+            with open(path, 'w') as config_file:
+                config_file.write('{"broker": ')
+            self.assertFalse(reload_metrics_config_file(path, self.collector))
+            metrics_config = json.loads(json.dumps(METRICS_CONFIG))
+            del metrics_config['broker']['query/time']['buckets']
+            with open(path, 'w') as config_file:
+                json.dump(metrics_config, config_file)
+            self.assertFalse(reload_metrics_config_file(path, self.collector))
+            self.assertIs(self.collector.metrics_config, METRICS_CONFIG)
+
+            metrics_config['broker']['query/time']['buckets'] = ['10', 'inf', 'sum']
+            with open(path, 'w') as config_file:
+                json.dump(metrics_config, config_file)
+            self.assertTrue(reload_metrics_config_file(path, self.collector))
+            self.assertEqual(self.collector.metrics_config, metrics_config)
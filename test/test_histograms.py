@@ -0,0 +1,86 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import unittest
+
+from druid_exporter.histograms import (ExponentialHistogram, ExponentialHistogramMetricFamily,
+                                       bucket_index, bucket_upper_bound)
+
+
+class TestExponentialHistogram(unittest.TestCase):
+
+    def test_bucket_index(self):
+        """Every value should fall in the bucket (base ** (i - 1), base ** i],
+           the powers of the base being the upper bound of their bucket.
+        """
+        for schema in (-4, -1, 0, 1, 3, 8):
+            for value in (1e-30, 0.001, 0.5, 1, 1.0001, 2, 3, 1000, 123456.789, 1e30):
+                index = bucket_index(value, schema)
+                self.assertLess(bucket_upper_bound(index - 1, schema), value)
+                self.assertLessEqual(value, bucket_upper_bound(index, schema) * (1 + 1e-12))
+            for index in range(-20, 20):
+                self.assertEqual(bucket_index(bucket_upper_bound(index, schema), schema),
+                                 index)
+
+    def test_observe(self):
+        histogram = ExponentialHistogram(schema=0, zero_threshold=0.5)
+        histogram.observe([0, 0.25, -0.5, 1, 1.5, 2, 3, -3, float('nan'), float('inf')])
+        self.assertEqual(histogram.zero_count, 3)
+        self.assertEqual(histogram.positive, {0: 1, 1: 2, 2: 1})
+        self.assertEqual(histogram.negative, {2: 1})
+        self.assertEqual(histogram.count, 10)
+        self.assertTrue(math.isnan(histogram.sum))
+        # Only the populated buckets are reported.
+        self.assertEqual(histogram.classic_buckets(),
+                         [['-2.0', 1], ['0.5', 4], ['1.0', 5], ['2.0', 7], ['4.0', 8],
+                          ['+Inf', 10]])
+
+    def test_reduce_resolution(self):
+        """Halving the resolution should give the same buckets as observing
+           the values with the lower resolution in the first place.
+        """
+        values = [1.5 ** exponent for exponent in range(-40, 40)]
+        values += [-value for value in values[::3]]
+        histogram = ExponentialHistogram(schema=3, max_buckets=20)
+        histogram.observe(values)
+        self.assertLessEqual(len(histogram.positive) + len(histogram.negative), 20)
+        self.assertLess(histogram.schema, 3)
+
+        expected = ExponentialHistogram(schema=histogram.schema, max_buckets=1000)
+        expected.observe(values)
+        self.assertEqual(histogram.positive, expected.positive)
+        self.assertEqual(histogram.negative, expected.negative)
+        self.assertEqual(histogram.count, len(values))
+
+    def test_spans_and_deltas(self):
+        spans, deltas = ExponentialHistogram.spans_and_deltas(
+            {-2: 3, -1: 1, 0: 4, 5: 4, 6: 1, 9: 2})
+        self.assertEqual(spans, [[-2, 3], [4, 2], [2, 1]])
+        self.assertEqual(deltas, [3, -2, 3, 0, -3, 1])
+        self.assertEqual(ExponentialHistogram.spans_and_deltas({}), ([], []))
+
+    def test_metric_family(self):
+        histogram = ExponentialHistogram()
+        histogram.observe([1, 2, 4])
+        family = ExponentialHistogramMetricFamily('test', 'Test.', labels=['a', 'b'])
+        family.add_metric(['1', '2'], histogram)
+        self.assertEqual(family.exponential_histograms,
+                         {(('a', '1'), ('b', '2')): histogram})
+        samples = {(sample.name, sample.labels.get('le')): sample.value
+                   for sample in family.samples}
+        self.assertEqual(samples[('test_bucket', '2.0')], 2)
+        self.assertEqual(samples[('test_count', None)], 3)
+        self.assertEqual(samples[('test_sum', None)], 7)
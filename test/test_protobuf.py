@@ -0,0 +1,285 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import unittest
+
+from druid_exporter import protobuf
+from druid_exporter.collector import StaticRegistry
+from druid_exporter.histograms import ExponentialHistogram, ExponentialHistogramMetricFamily
+from prometheus_client.core import (CounterMetricFamily, GaugeMetricFamily,
+                                    HistogramMetricFamily, SummaryMetricFamily)
+
+try:
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+except ImportError:
+    message_factory = None
+
+
+# The messages of the io.prometheus.client schema (prometheus/client_model
+# metrics.proto) with their (name, number, type, repeated) fields, to check
+# the exposition with a real protobuf decoder. The timestamps and exemplars
+# are left out, since they are never encoded.
+UPSTREAM_SCHEMA = {
+    'LabelPair': [('name', 1, 'string', False), ('value', 2, 'string', False)],
+    'Gauge': [('value', 1, 'double', False)],
+    'Counter': [('value', 1, 'double', False)],
+    'Quantile': [('quantile', 1, 'double', False), ('value', 2, 'double', False)],
+    'Summary': [('sample_count', 1, 'uint64', False), ('sample_sum', 2, 'double', False),
+                ('quantile', 3, 'Quantile', True)],
+    'Untyped': [('value', 1, 'double', False)],
+    'Histogram': [
+        ('sample_count', 1, 'uint64', False), ('sample_count_float', 4, 'double', False),
+        ('sample_sum', 2, 'double', False), ('bucket', 3, 'Bucket', True),
+        ('schema', 5, 'sint32', False), ('zero_threshold', 6, 'double', False),
+        ('zero_count', 7, 'uint64', False), ('zero_count_float', 8, 'double', False),
+        ('negative_span', 9, 'BucketSpan', True), ('negative_delta', 10, 'sint64', True),
+        ('negative_count', 11, 'double', True), ('positive_span', 12, 'BucketSpan', True),
+        ('positive_delta', 13, 'sint64', True), ('positive_count', 14, 'double', True)],
+    'Bucket': [('cumulative_count', 1, 'uint64', False),
+               ('cumulative_count_float', 4, 'double', False),
+               ('upper_bound', 2, 'double', False)],
+    'BucketSpan': [('offset', 1, 'sint32', False), ('length', 2, 'uint32', False)],
+    'Metric': [('label', 1, 'LabelPair', True), ('gauge', 2, 'Gauge', False),
+               ('counter', 3, 'Counter', False), ('summary', 4, 'Summary', False),
+               ('untyped', 5, 'Untyped', False), ('histogram', 7, 'Histogram', False),
+               ('timestamp_ms', 6, 'int64', False)],
+    'MetricFamily': [('name', 1, 'string', False), ('help', 2, 'string', False),
+                     ('type', 3, 'uint32', False), ('metric', 4, 'Metric', True),
+                     ('unit', 5, 'string', False)],
+}
+
+
+def upstream_metric_family_class():
+    """Return the class of the MetricFamily message of UPSTREAM_SCHEMA
+       (proto2, like the upstream file).
+    """
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name='metrics.proto', package='io.prometheus.client', syntax='proto2')
+    field_proto = descriptor_pb2.FieldDescriptorProto
+    for message_name, fields in UPSTREAM_SCHEMA.items():
+        message_proto = file_proto.message_type.add(name=message_name)
+        for field_name, number, field_type, repeated in fields:
+            field = message_proto.field.add(
+                name=field_name, number=number,
+                label=field_proto.LABEL_REPEATED if repeated else field_proto.LABEL_OPTIONAL)
+            if field_type in UPSTREAM_SCHEMA:
+                field.type = field_proto.TYPE_MESSAGE
+                field.type_name = '.io.prometheus.client.' + field_type
+            else:
+                field.type = getattr(field_proto, 'TYPE_' + field_type.upper())
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    return message_factory.GetMessageClass(
+        pool.FindMessageTypeByName('io.prometheus.client.MetricFamily'))
+
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def decode_message(data):
+    """Decode a protobuf message into {field_number: [raw values]}, where the
+       raw values are ints (varint), floats (64 bit) or bytes (length delimited).
+    """
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value = struct.unpack('<d', data[pos:pos + 8])[0]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError('Unexpected wire type {}'.format(wire_type))
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def decode_packed_sint(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(unzigzag(value))
+    return values
+
+
+def decode_delimited(data):
+    """Decode a delimited protobuf exposition into a dictionary of
+       {family_name: (type, [metric fields])}.
+    """
+    families = {}
+    pos = 0
+    while pos < len(data):
+        length, pos = read_varint(data, pos)
+        family = decode_message(data[pos:pos + length])
+        pos += length
+        families[family[1][0].decode()] = (
+            family[3][0], [decode_message(metric) for metric in family.get(4, [])])
+    return families
+
+
+def metric_labels(metric):
+    labels = [decode_message(label) for label in metric.get(1, [])]
+    return {label[1][0].decode(): label[2][0].decode() for label in labels}
+
+
+class TestProtobuf(unittest.TestCase):
+
+    def test_accepts_protobuf(self):
+        self.assertTrue(protobuf.accepts_protobuf(
+            'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;'
+            'encoding=delimited;q=0.8,application/openmetrics-text;version=1.0.0;q=0.7,'
+            'text/plain;version=0.0.4;q=0.6,*/*;q=0.5'))
+        self.assertFalse(protobuf.accepts_protobuf(
+            'application/openmetrics-text;version=1.0.0,text/plain;version=0.0.4'))
+        self.assertFalse(protobuf.accepts_protobuf(
+            'application/vnd.google.protobuf;proto=io.prometheus.client.MetricFamily;'
+            'encoding=text'))
+        self.assertFalse(protobuf.accepts_protobuf(None))
+
+    def test_generate_latest(self):
+        counter = CounterMetricFamily('test_counter', 'Counter.', labels=['a'])
+        counter.add_metric(['x'], 3)
+        gauge = GaugeMetricFamily('test_gauge', 'Gauge.')
+        gauge.add_metric([], -1.5)
+        histogram = HistogramMetricFamily('test_histogram', 'Histogram.', labels=['a'])
+        histogram.add_metric(['y'], buckets=[('1', 2), ('10', 3), ('+Inf', 4)], sum_value=20)
+        summary = SummaryMetricFamily('test_summary', 'Summary.', count_value=5, sum_value=2.5)
+        families = decode_delimited(protobuf.generate_latest(
+            StaticRegistry([counter, gauge, histogram, summary])))
+
+        self.assertEqual(sorted(families), ['test_counter_total', 'test_gauge',
+                                            'test_histogram', 'test_summary'])
+        metric_type, metrics = families['test_counter_total']
+        self.assertEqual(metric_type, protobuf.COUNTER)
+        self.assertEqual(metric_labels(metrics[0]), {'a': 'x'})
+        self.assertEqual(decode_message(metrics[0][3][0]), {1: [3.0]})
+
+        metric_type, metrics = families['test_gauge']
+        self.assertEqual(metric_type, protobuf.GAUGE)
+        self.assertEqual(decode_message(metrics[0][2][0]), {1: [-1.5]})
+
+        metric_type, metrics = families['test_histogram']
+        self.assertEqual(metric_type, protobuf.HISTOGRAM)
+        self.assertEqual(metric_labels(metrics[0]), {'a': 'y'})
+        histogram = decode_message(metrics[0][7][0])
+        self.assertEqual(histogram[1], [4])
+        self.assertEqual(histogram[2], [20.0])
+        # The +Inf bucket is implied by the count.
+        self.assertEqual([decode_message(bucket) for bucket in histogram[3]],
+                         [{1: [2], 2: [1.0]}, {1: [3], 2: [10.0]}])
+
+        metric_type, metrics = families['test_summary']
+        self.assertEqual(metric_type, protobuf.SUMMARY)
+        self.assertEqual(decode_message(metrics[0][4][0]), {1: [5], 2: [2.5]})
+
+    def test_native_histogram(self):
+        """The series of exponential histograms should be encoded as native
+           histograms, without classic buckets.
+        """
+        exponential_histogram = ExponentialHistogram(schema=0, zero_threshold=0.5)
+        exponential_histogram.observe([0, 1, 2, 2, 16, -4])
+        family = ExponentialHistogramMetricFamily('test', 'Test.', labels=['a'])
+        family.add_metric(['x'], exponential_histogram)
+        metric_type, metrics = decode_delimited(
+            protobuf.generate_latest(StaticRegistry([family])))['test']
+
+        self.assertEqual(metric_type, protobuf.HISTOGRAM)
+        histogram = decode_message(metrics[0][7][0])
+        self.assertNotIn(3, histogram)
+        self.assertEqual(histogram[1], [6])
+        self.assertEqual(histogram[2], [17.0])
+        self.assertEqual(unzigzag(histogram[5][0]), 0)
+        self.assertEqual(histogram[6], [0.5])
+        self.assertEqual(histogram[7], [1])
+        spans = [decode_message(span) for span in histogram[12]]
+        self.assertEqual([(unzigzag(span[1][0]), span[2][0]) for span in spans],
+                         [(0, 2), (2, 1)])
+        self.assertEqual(decode_packed_sint(histogram[13][0]), [1, 1, -1])
+        self.assertNotIn(8, histogram)
+        spans = [decode_message(span) for span in histogram[9]]
+        self.assertEqual([(unzigzag(span[1][0]), span[2][0]) for span in spans], [(2, 1)])
+        self.assertEqual(decode_packed_sint(histogram[10][0]), [1])
+
+    @unittest.skipIf(message_factory is None, 'protobuf is not installed')
+    def test_upstream_schema(self):
+        """The exposition should be parsed by a real protobuf decoder with the
+           io.prometheus.client schema.
+        """
+        counter = CounterMetricFamily('test_counter', 'Counter.', labels=['a'])
+        counter.add_metric(['x'], 3)
+        histogram = HistogramMetricFamily('test_histogram', 'Histogram.')
+        histogram.add_metric([], buckets=[('1', 2), ('+Inf', 4)], sum_value=20)
+        summary = SummaryMetricFamily('test_summary', 'Summary.', count_value=5, sum_value=2.5)
+        exponential_histogram = ExponentialHistogram(schema=0, zero_threshold=0.5)
+        exponential_histogram.observe([0, 1, 2, 2, 16, -4, -0.25])
+        native = ExponentialHistogramMetricFamily('test_native', 'Native.', labels=['a'])
+        native.add_metric(['x'], exponential_histogram)
+        data = protobuf.generate_latest(
+            StaticRegistry([counter, histogram, summary, native]))
+
+        metric_family_class = upstream_metric_family_class()
+        families = {}
+        pos = 0
+        while pos < len(data):
+            length, pos = read_varint(data, pos)
+            family = metric_family_class.FromString(data[pos:pos + length])
+            families[family.name] = family
+            pos += length
+
+        self.assertEqual(families['test_counter_total'].metric[0].counter.value, 3)
+        self.assertEqual(families['test_histogram'].metric[0].histogram.sample_count, 4)
+        self.assertEqual(families['test_summary'].metric[0].summary.sample_sum, 2.5)
+        native_histogram = families['test_native'].metric[0].histogram
+        self.assertEqual(native_histogram.sample_count, 7)
+        self.assertEqual(native_histogram.zero_count, 2)
+        self.assertFalse(native_histogram.HasField('zero_count_float'))
+        self.assertEqual([(span.offset, span.length) for span in native_histogram.negative_span],
+                         [(2, 1)])
+        self.assertEqual(list(native_histogram.negative_delta), [1])
+        self.assertEqual([(span.offset, span.length) for span in native_histogram.positive_span],
+                         [(0, 2), (2, 1)])
+        self.assertEqual(list(native_histogram.positive_delta), [1, 1, -1])
+
+    def test_merge_by_concatenation(self):
+        """Concatenating two MetricFamily messages should merge their metrics."""
+        messages = []
+        for value in ('a', 'b'):
+            gauge = GaugeMetricFamily('test_gauge', 'Gauge.', labels=['l'])
+            gauge.add_metric([value], 1)
+            messages.append(protobuf.encode_metric_family(gauge))
+        metric_type, metrics = decode_delimited(protobuf.delimited(b''.join(messages)))[
+            'test_gauge']
+        self.assertEqual([metric_labels(metric) for metric in metrics],
+                         [{'l': 'a'}, {'l': 'b'}])
@@ -0,0 +1,95 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import random
+import unittest
+
+from druid_exporter.quantiles import DDSketch, QuantileSummary
+
+
+class TestDDSketch(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(42)
+        self.values = [random.lognormvariate(3, 1.5) for _ in range(20000)]
+        self.sorted_values = sorted(self.values)
+
+    def exact_quantile(self, quantile):
+        return self.sorted_values[int(quantile * (len(self.sorted_values) - 1))]
+
+    def test_relative_accuracy(self):
+        sketch = DDSketch(relative_accuracy=0.01)
+        sketch.add(self.values)
+        for quantile in (0, 0.25, 0.5, 0.9, 0.99, 0.999, 1):
+            exact = self.exact_quantile(quantile)
+            self.assertLessEqual(abs(sketch.quantile(quantile) - exact), exact * 0.01)
+
+    def test_collapse(self):
+        """With a limited number of bins, the highest quantiles should keep
+           their accuracy.
+        """
+        sketch = DDSketch(relative_accuracy=0.01, max_bins=200)
+        for start in range(0, len(self.values), 1000):
+            sketch.add(self.values[start:start + 1000])
+        self.assertLessEqual(len(sketch.positive), 200)
+        self.assertEqual(sketch.count, len(self.values))
+        for quantile in (0.99, 0.999):
+            exact = self.exact_quantile(quantile)
+            self.assertLessEqual(abs(sketch.quantile(quantile) - exact), exact * 0.01)
+
+    def test_special_values(self):
+        sketch = DDSketch()
+        sketch.add([-10, -1, 0, 0, 1, 10, float('nan'), float('inf')])
+        self.assertEqual(sketch.count, 6)
+        self.assertAlmostEqual(sketch.quantile(0), -10, delta=0.1)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        self.assertAlmostEqual(sketch.quantile(1), 10, delta=0.1)
+        self.assertTrue(math.isnan(DDSketch().quantile(0.5)))
+
+    def test_merge(self):
+        sketch = DDSketch()
+        for start in range(0, len(self.values), 5000):
+            other = DDSketch()
+            other.add(self.values[start:start + 5000])
+            sketch.merge(other)
+        whole = DDSketch()
+        whole.add(self.values)
+        self.assertEqual(sketch.positive, whole.positive)
+        self.assertEqual(sketch.count, whole.count)
+
+
+class TestQuantileSummary(unittest.TestCase):
+
+    def test_time_window(self):
+        """The quantiles should only reflect the samples of the last max_age
+           seconds, while count and sum include all of them.
+        """
+        summary = QuantileSummary(quantiles=(0.5, 1), max_age=60, age_buckets=3, now=0)
+        summary.observe([1000] * 10, now=1)
+        summary.observe([1, 2, 3], now=30)
+        self.assertAlmostEqual(summary.quantile_values(now=39)[0][1], 1000, delta=10)
+
+        # The first sketch (samples from 0 to 20s) is dropped at 60s.
+        quantiles = dict(summary.quantile_values(now=61))
+        self.assertAlmostEqual(quantiles[0.5], 2, delta=0.02)
+        self.assertAlmostEqual(quantiles[1], 3, delta=0.03)
+        self.assertEqual(summary.count, 13)
+        self.assertEqual(summary.sum, 10006)
+
+        copy = summary.copy()
+        self.assertTrue(all(math.isnan(value) for _, value in copy.quantile_values(now=1000)))
+        # The copy doesn't share the sketches of the original.
+        self.assertAlmostEqual(dict(summary.quantile_values(now=61))[1], 3, delta=0.03)
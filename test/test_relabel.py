@@ -0,0 +1,93 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from druid_exporter.relabel import Relabeler, check_relabel_rules, merged_aggregation
+
+
+LABELS = ['dataSource', 'taskId', 'host']
+
+
+class TestRelabeler(unittest.TestCase):
+
+    def test_label_values(self):
+        relabeler = Relabeler(LABELS, [
+            {'label': 'taskId', 'action': 'replace', 'regex': 'index_([a-z]+)_.*'},
+            {'label': 'dataSource', 'action': 'drop', 'values': ['test'], 'replacement': 'other'},
+            {'label': 'host', 'action': 'labeldrop'},
+        ])
+        self.assertEqual(relabeler.labels, ('dataSource', 'taskId'))
+        self.assertEqual(relabeler.dropped_labels, ('host',))
+        datapoint = {'dataSource': 'wikidata', 'host': 'druid1001:8200',
+                     'taskId': ['index_kafka_wikidata_ee74c5a5820837c_hedlopdm']}
+        self.assertEqual(relabeler.label_values(datapoint), ('wikidata', 'kafka'))
+        self.assertEqual(relabeler.dropped_label_values(datapoint), ('druid1001:8200',))
+        datapoint.update(dataSource='test', taskId='compact_test_2020')
+        self.assertEqual(relabeler.label_values(datapoint), ('other', 'compact_test_2020'))
+        del datapoint['taskId']
+        with self.assertRaises(KeyError):
+            relabeler.label_values(datapoint)
+        datapoint['taskId'] = 'index_kafka_test_2020'
+        del datapoint['host']
+        with self.assertRaises(KeyError):
+            relabeler.label_values(datapoint)
+
+    def test_keep(self):
+        relabeler = Relabeler(['dataSource'], [
+            {'label': 'dataSource', 'action': 'keep', 'values': ['wikidata', 'webrequest']}])
+        self.assertEqual(relabeler.label_values({'dataSource': 'wikidata'}), ('wikidata',))
+        self.assertIsNone(relabeler.label_values({'dataSource': 'test'}))
+
+    def test_memoized(self):
+        relabeler = Relabeler(['taskId'], [
+            {'label': 'taskId', 'regex': 'index_([a-z]+)_.*'}], cache_size=2)
+        transform = relabeler.transforms[0][1]
+        for index in range(10):
+            relabeler.label_values({'taskId': 'index_kafka_{}'.format(index % 3)})
+        cache_info = transform.cache_info()
+        self.assertEqual(cache_info.currsize, 2)
+        self.assertEqual(cache_info.misses, 10)
+        relabeler.label_values({'taskId': 'index_kafka_0'})
+        self.assertEqual(transform.cache_info().hits, 1)
+
+    def test_merged_aggregation(self):
+        labeldrop = {'label': 'taskId', 'action': 'labeldrop'}
+        for metric_type, rules, aggregation in (
+                ('counter', [labeldrop], 'sum'),
+                ('gauge', [labeldrop], 'last'),
+                ('gauge', [dict(labeldrop, aggregation='sum')], 'sum'),
+                ('counter', [dict(labeldrop, aggregation='last')], 'last'),
+                ('histogram', [labeldrop], None),
+                ('counter', [{'label': 'taskId', 'regex': '(.*)'}], None)):
+            self.assertEqual(merged_aggregation(
+                {'type': metric_type, 'labels': LABELS, 'relabel': rules}), aggregation)
+
+    def test_check_relabel_rules(self):
+        for rules in (
+                {'label': 'taskId'},
+                [{'label': 'id', 'regex': '.*'}],
+                [{'label': 'taskId', 'action': 'hashmod'}],
+                [{'label': 'taskId', 'regex': '('}],
+                [{'label': 'taskId', 'regex': '(.*)', 'replacement': '\\2'}],
+                [{'label': 'taskId', 'regex': '(?P<type>.*)', 'replacement': '\\g<kind>'}],
+                [{'label': 'taskId', 'action': 'keep', 'values': 'index'}],
+                [{'label': 'taskId', 'action': 'labeldrop', 'aggregation': 'max'}],
+                [{'label': 'taskId', 'action': 'labeldrop', 'aggregation': 'sum'},
+                 {'label': 'host', 'action': 'labeldrop', 'aggregation': 'last'}]):
+            with self.assertRaises(ValueError):
+                check_relabel_rules(LABELS, rules)
+        check_relabel_rules(LABELS, [
+            {'label': 'taskId', 'regex': '(?P<type>[a-z]+)_.*', 'replacement': '\\g<type>'}])
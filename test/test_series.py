@@ -0,0 +1,59 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from druid_exporter.series import SeriesIndex, intern_label_values
+
+
+class TestSeriesIndex(unittest.TestCase):
+
+    def test_lookup(self):
+        """Series are found by the label values of the datapoints, even when
+           they are not strings.
+        """
+        series = SeriesIndex()
+        series_id = series.add(intern_label_values(('test', 1)), 10)
+        self.assertEqual(series.lookup(('test', '1')), series_id)
+        self.assertEqual(series.lookup(('test', 1)), series_id)
+        self.assertIsNone(series.lookup(('test', 2)))
+        self.assertIsNone(series.lookup((['test'], 1)))
+        self.assertEqual(series, {('test', '1'): 10.0})
+
+    def test_intern_label_values(self):
+        first = intern_label_values([''.join(['data', 'source'])])
+        second = intern_label_values([''.join(['data', 'sour', 'ce'])])
+        self.assertIs(first[0], second[0])
+
+    def test_ids_reused(self):
+        """The IDs of the removed series are reused, keeping the values dense."""
+        series = SeriesIndex()
+        for index in range(3):
+            series.add((str(index),), index)
+        self.assertEqual(series.pop(('1',)), 1.0)
+        self.assertIsNone(series.pop(('1',)))
+        self.assertEqual(list(series.items()), [(('0',), 0.0), (('2',), 2.0)])
+        self.assertEqual(series.add(('3',), 3), 1)
+        self.assertEqual(len(series.values), 3)
+        self.assertEqual(dict(series), {('0',): 0.0, ('2',): 2.0, ('3',): 3.0})
+
+    def test_copy(self):
+        series = SeriesIndex()
+        series.add(('a',), 1)
+        copy = series.copy()
+        series.values[series.lookup(('a',))] = 2
+        series.add(('b',), 3)
+        self.assertEqual(copy, {('a',): 1.0})
+        self.assertEqual(series, {('a',): 2.0, ('b',): 3.0})
@@ -0,0 +1,147 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import queue
+import time
+import unittest
+
+from druid_exporter import protobuf
+from druid_exporter.collector import compile_metrics_config
+from druid_exporter.sharding import ShardedCollector, ShardRouter
+from test_protobuf import decode_delimited, metric_labels
+
+
+METRICS_CONFIG = {
+    'broker': {
+        "query/time": {
+            "prometheus_metric_name": "druid_broker_query_time_ms",
+            "type": "histogram",
+            "buckets": ["10", "100", "1000", "inf", "sum"],
+            "labels": ["dataSource"],
+            "description": "Milliseconds taken to complete a query."
+        },
+        "query/cache/total/numEntries": {
+            "prometheus_metric_name": "druid_broker_query_cache_numentries_count",
+            "type": "gauge",
+            "labels": [],
+            "description": "Number of cache entries."
+        },
+    },
+    'historical': {
+        "segment/count": {
+            "prometheus_metric_name": "druid_historical_segment_count",
+            "type": "gauge",
+            "labels": ["tier", "dataSource"],
+            "description": "Segments count."
+        },
+    },
+}
+
+
+class TestShardRouter(unittest.TestCase):
+
+    def test_route(self):
+        """Every series should be routed to a single shard."""
+        metrics_plan = compile_metrics_config(METRICS_CONFIG)
+        plan = metrics_plan[('broker', 'query/time')]
+        inboxes = [queue.Queue() for _ in range(3)]
+        local_queue = queue.Queue()
+        router = ShardRouter(1, inboxes)
+
+        batch = [(plan, {'dataSource': 'test{}'.format(i % 10), 'value': i})
+                 for i in range(100)]
+        router.route(batch, local_queue.put)
+
+        owners = {}
+        routed = 0
+        for index, shard_queue in enumerate(inboxes):
+            if index == router.index:
+                self.assertTrue(shard_queue.empty())
+                shard_queue = local_queue
+                items = [(metric_plan.key, datapoint)
+                         for metric_plan, datapoint in shard_queue.get()]
+            else:
+                message = shard_queue.get()
+                self.assertEqual(message[0], 'datapoints')
+                items = message[1]
+            for family_key, datapoint in items:
+                self.assertEqual(family_key, plan.key)
+                self.assertEqual(owners.setdefault(datapoint['dataSource'], index), index)
+                routed += 1
+        self.assertEqual(routed, 100)
+
+
+class TestShardedCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = ShardedCollector(METRICS_CONFIG, 2)
+
+    def tearDown(self):
+        self.collector.stop_running_threads()
+        for process in self.collector.processes:
+            process.join(5)
+
+    def test_merged_exposition(self):
+        """The exposition should contain every series exactly once, with a
+           single header for each metric family.
+        """
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test{}'.format(i),
+             'metric': 'query/time', 'value': 50}
+            for i in range(20)]
+        datapoints.append(
+            {'feed': 'metrics', 'service': 'druid/broker',
+             'metric': 'query/cache/total/numEntries', 'value': 5})
+        datapoints.append(
+            {'feed': 'metrics', 'service': 'druid/historical', 'dataSource': 'test',
+             'tier': '_default_tier', 'metric': 'segment/count', 'value': 7})
+        # Send the same payload to both workers.
+        for _ in range(2):
+            self.collector.register_payload(json.dumps(datapoints).encode())
+        time.sleep(1)
+
+        output = self.collector.generate_latest().decode()
+        self.assertEqual(output.count('# HELP druid_broker_query_time_ms '), 1)
+        self.assertEqual(output.count('# TYPE druid_broker_query_time_ms '), 1)
+        for i in range(20):
+            self.assertEqual(
+                output.count('druid_broker_query_time_ms_count{{datasource="test{}"}} 2.0'
+                             .format(i)), 1)
+        self.assertEqual(output.count('druid_broker_query_cache_numentries_count 5.0'), 1)
+        self.assertEqual(output.count(
+            'druid_historical_segment_count{datasource="test",tier="_default_tier"} 7.0'), 1)
+        self.assertIn('druid_exporter_datapoints_registered_total 44.0', output)
+        # The order of the families follows the metrics config.
+        self.assertLess(output.index('druid_broker_query_time_ms'),
+                        output.index('druid_historical_segment_count'))
+
+    def test_merged_protobuf_exposition(self):
+        """The protobuf messages of the same family rendered by different
+           shards should be merged in a single MetricFamily.
+        """
+        datapoints = [
+            {'feed': 'metrics', 'service': 'druid/broker', 'dataSource': 'test{}'.format(i),
+             'metric': 'query/time', 'value': 50}
+            for i in range(20)]
+        self.collector.register_payload(json.dumps(datapoints).encode())
+        time.sleep(1)
+
+        families = decode_delimited(self.collector.generate_latest(use_protobuf=True))
+        metric_type, metrics = families['druid_broker_query_time_ms']
+        self.assertEqual(metric_type, protobuf.HISTOGRAM)
+        self.assertEqual(sorted(metric_labels(metric)['datasource'] for metric in metrics),
+                         sorted('test{}'.format(i) for i in range(20)))
+        self.assertIn('druid_exporter_datapoints_registered_total', families)
@@ -0,0 +1,189 @@
+# Copyright 2017 Luca Toscano
+#                Filippo Giunchedi
+#                Wikimedia Foundation
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from druid_exporter.collector import DruidCollector
+from druid_exporter.snapshots import SnapshotError, load_snapshot, save_snapshot, save_snapshots
+
+
+METRICS_CONFIG = {
+    'broker': {
+        "query/time": {
+            "prometheus_metric_name": "druid_broker_query_time_ms",
+            "type": "histogram",
+            "buckets": ["10", "100", "1000", "inf", "sum"],
+            "labels": ["dataSource"],
+            "description": "Milliseconds taken to complete a query."
+        },
+        "query/bytes": {
+            "prometheus_metric_name": "druid_broker_query_bytes",
+            "type": "exponential_histogram",
+            "labels": ["dataSource"],
+            "description": "Number of bytes returned in query response."
+        },
+        "query/node/ttfb": {
+            "prometheus_metric_name": "druid_broker_query_node_ttfb_ms",
+            "type": "summary",
+            "labels": ["dataSource"],
+            "description": "Time to first byte."
+        },
+    },
+    'coordinator': {
+        "segment/count": {
+            "prometheus_metric_name": "druid_coordinator_segment_count",
+            "type": "gauge",
+            "labels": ["dataSource"],
+            "description": "Segments count.",
+            "ttl": 600
+        },
+    },
+}
+
+
+def datapoint(service, metric, value, **labels):
+    return dict({'feed': 'metrics', 'service': 'druid/' + service,
+                 'host': 'druid1001:8082', 'metric': metric, 'value': value}, **labels)
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'snapshot')
+
+    def make_collector(self, metrics_config=METRICS_CONFIG, **kwargs):
+        """Create a collector with its processing thread stopped, the
+           datapoints being processed by process_datapoints_batch.
+        """
+        collector = DruidCollector(metrics_config, **kwargs)
+        collector.stop_running_threads()
+        return collector
+
+    def register(self, collector, datapoints):
+        collector.process_datapoints_batch(
+            [(collector.get_metric_plan(datapoint), datapoint) for datapoint in datapoints])
+
+    @staticmethod
+    def druid_metrics(collector):
+        return b''.join(text for _, text in collector.render_families())
+
+    def test_save_and_load(self):
+        collector = self.make_collector(host_liveness_window=60)
+        datapoints = []
+        for index in range(10):
+            datasource = 'datasource{}'.format(index)
+            datapoints.extend([
+                datapoint('broker', 'query/time', index * 50, dataSource=datasource),
+                datapoint('broker', 'query/bytes', index * 1000 + 1, dataSource=datasource),
+                datapoint('broker', 'query/node/ttfb', index + 0.5, dataSource=datasource),
+                datapoint('coordinator', 'segment/count', index, dataSource=datasource),
+            ])
+        self.register(collector, datapoints)
+        self.assertEqual(save_snapshot(collector, self.path), 40)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+        restored = self.make_collector(host_liveness_window=60)
+        self.assertEqual(load_snapshot(restored, self.path), 40)
+        self.assertEqual(restored.series_count, 40)
+        self.assertEqual(self.druid_metrics(restored), self.druid_metrics(collector))
+        self.assertEqual(len(restored.series_last_update[('coordinator', 'segment/count')]), 10)
+        self.assertEqual(len(restored.host_series[('broker', 'druid1001:8082')]), 3)
+
+        # The restored series keep being updated by new datapoints.
+        self.register(restored, [
+            datapoint('broker', 'query/time', 5, dataSource='datasource0'),
+            datapoint('coordinator', 'segment/count', 42, dataSource='datasource0')])
+        output = self.druid_metrics(restored).decode()
+        self.assertIn('druid_broker_query_time_ms_count{datasource="datasource0"} 2.0', output)
+        self.assertIn('druid_coordinator_segment_count{datasource="datasource0"} 42.0', output)
+        self.assertEqual(restored.series_count, 40)
+
+    def test_config_changed(self):
+        """The series of the metrics stored differently by the new config
+           should not be restored.
+        """
+        collector = self.make_collector()
+        self.register(collector, [
+            datapoint('broker', 'query/time', 10, dataSource='test'),
+            datapoint('coordinator', 'segment/count', 1, dataSource='test')])
+        save_snapshot(collector, self.path)
+
+        metrics_config = copy.deepcopy(METRICS_CONFIG)
+        metrics_config['broker']['query/time']['buckets'] = ['10', 'inf', 'sum']
+        metrics_config['coordinator']['segment/count']['description'] = 'Number of segments.'
+        restored = self.make_collector(metrics_config)
+        self.assertEqual(load_snapshot(restored, self.path), 1)
+        self.assertEqual(dict(restored.counters['segment/count']['coordinator']),
+                         {('test',): 1.0})
+        self.assertNotIn('query/time', restored.histograms)
+
+    def test_save_snapshots(self):
+        """The snapshot thread should save a last snapshot when stopped, even
+           if the storage lock was held (for example by a scrape) when asked
+           to stop.
+        """
+        collector = self.make_collector()
+        self.register(collector, [datapoint('coordinator', 'segment/count', 1, dataSource='test')])
+        stop = threading.Event()
+        writer = threading.Thread(target=save_snapshots, args=(collector, self.path, 3600, stop))
+        writer.start()
+        with collector.storage_lock:
+            stop.set()
+            time.sleep(0.1)
+            self.assertFalse(os.path.exists(self.path))
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual(load_snapshot(self.make_collector(), self.path), 1)
+
+    def test_malformed_snapshot(self):
+        collector = self.make_collector()
+        for content in (b'', b'not a snapshot', b'DRUIDSNP\x00\x01\x80\x05'):
+            with open(self.path, 'wb') as snapshot_file:
+                snapshot_file.write(content)
+            with self.assertRaises(SnapshotError):
+                load_snapshot(collector, self.path)
+
+    def test_restart_time(self):
+        """Restoring 100k series should take a fraction of the time needed
+           by Druid to emit them again.
+        """
+        collector = self.make_collector()
+        datapoints = [
+            datapoint('coordinator', 'segment/count', index,
+                      dataSource='datasource{}'.format(index))
+            for index in range(90000)]
+        datapoints.extend(
+            datapoint('broker', 'query/time', index,
+                      dataSource='datasource{}'.format(index))
+            for index in range(10000))
+        self.register(collector, datapoints)
+        start = time.monotonic()
+        self.assertEqual(save_snapshot(collector, self.path), 100000)
+        save_duration = time.monotonic() - start
+
+        start = time.monotonic()
+        restored = self.make_collector()
+        load_snapshot(restored, self.path)
+        restart_duration = time.monotonic() - start
+        self.assertEqual(restored.series_count, 100000)
+        self.assertLess(save_duration, 5)
+        self.assertLess(restart_duration, 5)